@@ -5,37 +5,36 @@
         -   perfom spatial queries
 """
 
-#   first import some python libraries
-import psycopg2     #   this is the most important one, used to perform all the SQL commands
+#   first import some python libraries, psycopg2 (used to perform all the SQL commands) is imported by geowat_db.py
 import pandas as pd
 import geopandas as gpd
-import rasterio
+
+from geowat_db import GeowatPool, connect_to_dtbase, db_config_from_env, extract_mean_gwh
+from geowat_cache import query_cache_from_env
+from geowat_export import write_geoparquet
+from instrumentation import bytes_of, stage
+from litho_reclass import litho_4class
+from raster_sampling import sample_raster
+from spatial_query import nearest_wells, wells_in_bbox
 
 #   now define the database information for connecting, this is a read-only account so you wont be able to change anything
 #   also you have to be in the UU domain - so either sitting in the office or use VPN to connect to UU network..
-db_name = 'geowat'
-db_user = 'geowat_user'
-db_host = 'ages-db01.geo.uu.nl'
-db_pass = 'utrecht1994'
-db_port = 5432
-
-#   lets connect to the database now! create a connection string and then use psycopg to connect
+#   The values are read from the GEOWAT_DB_NAME, GEOWAT_DB_USER, GEOWAT_DB_HOST, GEOWAT_DB_PASS and GEOWAT_DB_PORT
+#   environment variables, if they are not set the read-only account is used.
+db_config = db_config_from_env()
+db_name = db_config['dbname']
+db_user = db_config['dbuser']
+db_host = db_config['dbhost']
+db_pass = db_config['dbpass']
+db_port = db_config['dbport']
+
+#   to connect we use a simple function, it lives in geowat_db.py (connect_to_dtbase) so the other scripts can use it
+#   as well. It makes the connection string, connects with psycopg2 and returns the connection and a cursor that we
+#   use for navigating the database tables, rows etc..
 #   Note: if you perform a wrong SQL query or anything that throws back an error the cursor closes and then you need
-#         to make a new database connection.
-conn_string = str("dbname=%s port=%s user=%s host=%s password=%s") % (db_name, db_port, db_user, db_host, db_pass)
-conn = psycopg2.connect(conn_string)
-#   set the cursor, this we will use for navigating the database tables, rows etc..
-cur = conn.cursor()
-
-#   to avoid that we can just make a simple function that we can use to connect to the database
-def connect_to_dtbase(dbname, dbuser, dbhost, dbpass, dbport):
-    #   create connection string
-    connstring = str("dbname=%s port=%s user=%s host=%s password=%s") % (dbname, dbport, dbuser, dbhost, dbpass)
-    connection = psycopg2.connect(connstring)
-    print("Successfully connected to database : " + str(dbname))
-    #   set the cursor and return both
-    cursor = connection.cursor()
-    return connection, cursor
+#         to make a new database connection (or roll back). If you run many small queries have a look at GeowatPool
+#         in the same file, it keeps connections open and rolls back a failed query for you - see the per-country
+#         example below.
 
 
 """     --------------------------------------------------------------------------------------------------
@@ -49,7 +48,8 @@ def connect_to_dtbase(dbname, dbuser, dbhost, dbpass, dbport):
 #   for some reason (my brain) so the table full name is gerbil._lookup_tb, finally we specify the condition so
 #   we just say the that column country_name has to be equal to Afghanistan
 
-#   First connect to the database
+#   First connect to the database. To work without the VPN you can make a local copy of the tables once with
+#   snapshot.py and open it with connect_snapshot instead, the query functions of geowat_db.py work the same on it
 db_con, db_cur = connect_to_dtbase(db_name, db_user, db_host, db_pass, db_port)
 
 #   Now make an SQL query to find all rows in the _lookup_tb (gerbil is the name of the database schema.. not important
@@ -62,8 +62,8 @@ dbase_ids_sql = db_cur.fetchall()
 #   lets see what we got
 print(dbase_ids_sql)
 
-#   would be a good idea to add the column names to the output dataframe as well
-db_con, db_cur = connect_to_dtbase(db_name, db_user, db_host, db_pass, db_port)
+#   would be a good idea to add the column names to the output dataframe as well, the connection is still fine so we
+#   can just reuse the same cursor
 sql_cmd = "SELECT * FROM gerbil._lookup_tb"
 db_cur.execute(sql_cmd)
 
@@ -75,6 +75,23 @@ for elt in db_cur.description:
 #   we can also make a dataframe out of it.. then you can export it as csv or whatever (geo)pandas output format you want
 df = pd.DataFrame(dbase_ids_sql, columns = col_names)
 
+#   Spatial queries can also be done by the database (PostGIS) so only the wells in your region are sent back, see
+#   spatial_query.py. For example all wells in a bounding box (xmin, ymin, xmax, ymax) or the 10 wells closest to a
+#   point, both as GeoDataFrames - wells_in_polygon works the same way with a shapely polygon or a GeoDataFrame
+gdf_bbox = wells_in_bbox(db_cur, 60.5, 29.4, 74.9, 38.5)
+gdf_nearest = nearest_wells(db_cur, 69.2, 34.5, k=10)
+print(gdf_nearest[['id_gerbil', 'distance_m']])
+
+#   Many small queries, for example one per country, each pay for a new connection handshake when you use
+#   connect_to_dtbase. GeowatPool keeps a few read-only connections open and hands them out with pool.cursor(), the
+#   connection goes back into the pool after every block (also after a failed query, which is rolled back)
+with GeowatPool(maxconn=4, config=db_config) as pool:
+    wells_per_country = {}
+    for country in ['Afghanistan', 'Pakistan', 'Iran']:
+        with pool.cursor() as cur:
+            wells_per_country[country] = extract_mean_gwh(cur, country=country)
+print({country: len(wells) for country, wells in wells_per_country.items()})
+
 
 #   Now lets try something more complicated and extract some groundwater well data. We will try to get total average
 #   groundwater level (in meters below surface level) for all the wells in the database. Additional information will be
@@ -82,55 +99,72 @@ df = pd.DataFrame(dbase_ids_sql, columns = col_names)
 #   of surface elevation measurmenet - either original from the IGRAC dbase or GLO_90m_DEM, and lithology type - we will
 #   add that in the end by extracting values from a raster..
 
-#   Make new connection to the database
-db_con, db_cur = connect_to_dtbase(db_name, db_user, db_host, db_pass, db_port)
-
-#   First lets grap all the rows from the table that contains yearly groundwater head data - that will be the
-#   in the _gwh_yearly_tb table
-sql_cmd = "SELECT * FROM gerbil._gwh_yearly_tb"
-db_cur.execute(sql_cmd)
-gwh_yearly = db_cur.fetchall()
-
-#   Extract the column names
-col_names = []
-for elt in db_cur.description:
-    col_names.append(elt[0])
-
-#   Lets make a datafram out of the database, some further post-processing is easier in (geo)pandas..
-df_raw = pd.DataFrame(gwh_yearly, columns = col_names)
-
-#   To get the mean GWH value lets just use the groupby function in pandas and group the rows by id_gerbil
-df_raw['mean_gwh_mbsl'] = df_raw.groupby('id_gerbil')['gw_head_m'].transform('mean')
-
-#   The raw data are in centimeters (it takes less space to store integer values in the database..)
-#   so transform from centimeters to meters
-df_raw['mean_gwh_mbsl'] = df_raw['mean_gwh_mbsl'].round(0) / 100.
-
-#   Now lets get the number of yearly measurements for each well
-df_raw['n_years'] = df_raw.groupby('id_gerbil')['year'].transform('size')
-
-#   Finally we can now trim the dataframe to only get one row per well (id_gerbil)
-df_gwh = df_raw.drop_duplicates(subset = 'id_gerbil', keep = "last")
-
-#   We can also drop the redundant columns now, no need to keep the year and gwh_head_m columns from the raw data
-df_gwh = df_gwh.drop(columns=['year', 'gw_head_m'])
-
-#   The rest of the information we want to include in our dataframe output is stored in another table - the _lookup_tb.
-#   First we can just get all the rows from the lookup_tb and then use pandas to join with the previous dataframe.
-sql_cmd = "SELECT id_gerbil, id_orig_src, x_wgs84, y_wgs84, orig_elev_m_asl, glo90_elev_m_asl FROM gerbil._lookup_tb"
-db_cur.execute(sql_cmd)
-lookup_vals = db_cur.fetchall()
-
-#   Extract the column names
-col_names = []
-for elt in db_cur.description:
-    col_names.append(elt[0])
-
-#   Make a dataframe from the values
-df_lookup = pd.DataFrame(lookup_vals, columns = col_names)
-
-#   We can now join the two dataframes by matching ID_gerbil values and in that way we will have all the columns we needed
-df_out = pd.merge(df_gwh, df_lookup, on = 'id_gerbil').drop_duplicates().reset_index(drop = True)
+#   We keep using the same connection, only after a failed query you would have to reconnect (or roll back)
+
+#   Pulling every yearly row into python and averaging with pandas works, but on the full table it is slow and needs a
+#   lot of memory. The database can do the averaging, counting and joining with the _lookup_tb for us and only send
+#   back one row per well - that is what extract_mean_gwh in geowat_db.py does. It also takes optional filters
+#   (country, bbox, year_range, min_years). Set this to False to follow the step by step pandas version below.
+#   If you point the GEOWAT_CACHE_DIR environment variable to a local folder the result is kept there (see
+#   geowat_cache.py) and only downloaded again when the table changed in the database.
+aggregate_in_database = True
+
+#   Each step below runs inside stage() from instrumentation.py, which prints how long it took, how many rows came out
+#   and the peak memory. Set GEOWAT_TRACE to a file name to also keep these numbers as JSON lines.
+if aggregate_in_database:
+    with stage('extract_mean_gwh') as st:
+        df_out = extract_mean_gwh(db_cur, cache=query_cache_from_env())
+        st.set(rows_out=len(df_out), bytes_fetched=bytes_of(df_out))
+else:
+    #   First lets grap all the rows from the table that contains yearly groundwater head data - that will be the
+    #   in the _gwh_yearly_tb table
+    sql_cmd = "SELECT * FROM gerbil._gwh_yearly_tb"
+    db_cur.execute(sql_cmd)
+    gwh_yearly = db_cur.fetchall()
+
+    #   Extract the column names
+    col_names = []
+    for elt in db_cur.description:
+        col_names.append(elt[0])
+
+    #   Lets make a datafram out of the database, some further post-processing is easier in (geo)pandas..
+    df_raw = pd.DataFrame(gwh_yearly, columns = col_names)
+
+    #   To get the mean GWH value lets just use the groupby function in pandas and group the rows by id_gerbil
+    df_raw['mean_gwh_mbsl'] = df_raw.groupby('id_gerbil')['gw_head_m'].transform('mean')
+
+    #   The raw data are in centimeters (it takes less space to store integer values in the database..)
+    #   so transform from centimeters to meters
+    df_raw['mean_gwh_mbsl'] = df_raw['mean_gwh_mbsl'].round(0) / 100.
+
+    #   Now lets get the number of yearly measurements for each well
+    df_raw['n_years'] = df_raw.groupby('id_gerbil')['year'].transform('size')
+
+    #   Finally we can now trim the dataframe to only get one row per well (id_gerbil)
+    df_gwh = df_raw.drop_duplicates(subset = 'id_gerbil', keep = "last")
+
+    #   We can also drop the redundant columns now, no need to keep the year and gwh_head_m columns from the raw data
+    df_gwh = df_gwh.drop(columns=['year', 'gw_head_m'])
+
+    #   The rest of the information we want to include in our dataframe output is stored in another table - the _lookup_tb.
+    #   First we can just get all the rows from the lookup_tb and then use pandas to join with the previous dataframe.
+    sql_cmd = "SELECT id_gerbil, id_orig_src, x_wgs84, y_wgs84, orig_elev_m_asl, glo90_elev_m_asl FROM gerbil._lookup_tb"
+    db_cur.execute(sql_cmd)
+    lookup_vals = db_cur.fetchall()
+
+    #   Extract the column names
+    col_names = []
+    for elt in db_cur.description:
+        col_names.append(elt[0])
+
+    #   Make a dataframe from the values
+    df_lookup = pd.DataFrame(lookup_vals, columns = col_names)
+
+    #   We can now join the two dataframes by matching ID_gerbil values and in that way we will have all the columns we needed
+    df_out = pd.merge(df_gwh, df_lookup, on = 'id_gerbil').drop_duplicates().reset_index(drop = True)
+
+#   That was the last query, close the connection
+db_con.close()
 
 #   Finally we can export the dataframe as a shapefile, first make it a geodataframe
 geometry = gpd.points_from_xy(df_out.x_wgs84, df_out.y_wgs84, crs = "EPSG:4326")
@@ -140,52 +174,33 @@ gdf = gpd.GeoDataFrame(df_out, geometry = geometry)
 #   with the same name as the one below
 glim_dir = r'g:\_ORIGINAL_DATA\GLIM\glim_world2_wb.tif'
 
-#   get the elevation values (rounded up to 2 decimal points from the DEM tile)
-glim_raw_lst = []
-coord_lst = list(zip(gdf.x_wgs84, gdf.y_wgs84))
-with rasterio.open(glim_dir, 'r') as src:
-    for val in src.sample(coord_lst):
-        #print(val[0])
-        glim_raw_lst.append(int(val[0]))
-
-#   The reclassification key is in the dictionary below.. nevermind the color and hatch that is for plotting (for other scripts)
-litho_class_styles = {'su': {'lith' : 'su', 'lith_full' : 'unconsolidated sediments', 'lith_num' : 100, 'hatch': '', 'color': 'gold'},
-                      'su_ad': {'lith' : 'su_ad', 'lith_full' : 'alluvial deposits', 'lith_num' : 101, 'hatch': '-.', 'color': '#ffd757'},
-                      'su_ds': {'lith' : 'su_ds', 'lith_full' : 'dune sands', 'lith_num' : 102, 'hatch': '-.', 'color': '#fcc100'},
-                      'su_lo': {'lith' : 'su_lo', 'lith_full' : 'loess', 'lith_num' : 103, 'hatch': '-.', 'color': '#8a6a00'},
-                      'su_mx': {'lith' : 'su_mx', 'lith_full' : 'sand - mixed grain size', 'lith_num' : 104, 'hatch': 'O', 'color': '#ffd95f'},
-                      'su_ss': {'lith' : 'su_ss', 'lith_full' : 'sand - coarse grained', 'lith_num' : 105, 'hatch': 'o', 'color': '#ffd95f'},
-                      'su_sh': {'lith' : 'su_sh', 'lith_full' : 'sand - fine grained', 'lith_num' : 106, 'hatch': '.', 'color': '#ffd95f'},
-                      'su_cl': {'lith' : 'su_cl', 'lith_full' : 'clay', 'lith_num' : 107, 'hatch': '.', 'color': 'grey'},
-                      'su_gr': {'lith' : 'su_gr', 'lith_full' : 'gravel', 'lith_num' : 108, 'hatch': 'o', 'color': 'olivedrab'},
-                      'su_sl': {'lith' : 'su_sl', 'lith_full' : 'silt', 'lith_num' : 109, 'hatch': '..', 'color': 'lawngreen'},
-                      'ss': {'lith' : 'ss', 'lith_full' : 'siliclastic sedimentary rocks', 'lith_num' : 200, 'hatch': 'o-', 'color': 'forestgreen'},
-                      'sm': {'lith' : 'sm', 'lith_full' : 'mixed sedimentary rocks', 'lith_num' : 210, 'hatch': 'o-', 'color': 'turquoise'},
-                      'sc': {'lith' : 'sc', 'lith_full' : 'carbonate sedimentary rocks', 'lith_num' : 220, 'hatch': 'o-', 'color': 'aqua'},
-                      'vb': {'lith' : 'vb', 'lith_full' : 'basic volcanic rocks', 'lith_num' : 300, 'hatch': 'o', 'color': 'darkorange'},
-                      'vi': {'lith' : 'vi', 'lith_full' : 'intermediate volcanic rocks', 'lith_num' : 310, 'hatch': 'O', 'color': 'darkorange'},
-                      'va': {'lith' : 'va', 'lith_full' : 'acid volcanic rocks', 'lith_num' : 320, 'hatch': 'oo', 'color': 'darkorange'},
-                      'pb': {'lith' : 'pb', 'lith_full' : 'basic plutonic rocks', 'lith_num' : 400, 'hatch': 'o', 'color': 'fuchsia'},
-                      'pi': {'lith' : 'pi', 'lith_full' : 'intermediate plutonic rocks', 'lith_num' : 410, 'hatch': 'O', 'color': 'fuchsia'},
-                      'pa': {'lith' : 'pa', 'lith_full' : 'acid plutonic rocks', 'lith_num' : 420, 'hatch': 'oo', 'color': 'fuchsia'},
-                      'mt': {'lith' : 'mt', 'lith_full' : 'metamorphic rocks', 'lith_num' : 500, 'hatch': '-|', 'color': 'plum'},
-                      'py': {'lith' : 'py', 'lith_full' : 'pyroclastics', 'lith_num' : 600, 'hatch': 'x', 'color': 'crimson'},
-                      'ev': {'lith' : 'ev', 'lith_full' : 'evaporites', 'lith_num' : 700, 'hatch': 'o', 'color': 'darkorchid'},
-                      'rock': {'lith' : 'rock', 'lith_full' : 'rocks', 'lith_num' : 800, 'hatch': '++', 'color': 'dimgrey'},
-                      'soil': {'lith' : 'soil', 'lith_full' : 'soil', 'lith_num' : 900, 'hatch': 'o', 'color': 'tan'},
-                      'coal': {'lith' : 'coal', 'lith_full' : 'coal', 'lith_num' : 1000, 'hatch': '-|', 'color': 'black'},
-                      'nd': {'lith' : 'nd', 'lith_full' : 'not defined', 'lith_num' : 0, 'hatch': 'x', 'color': 'snow'}}
+#   get the lithology values at the well locations. sample_raster (raster_sampling.py) converts all coordinates to pixel
+#   indices at once and reads every raster block only once, instead of asking rasterio for one well at a time
+with stage('sample_raster', rows_in=len(gdf)) as st:
+    glim_raw = sample_raster(glim_dir, gdf.x_wgs84.values, gdf.y_wgs84.values, max_workers=4)
+    st.set(rows_out=len(glim_raw))
 
+#   The reclassification key is the litho_class_styles dictionary, it now lives in litho_reclass.py together with the
+#   reclassification schemes so all scripts use the same definition (the color and hatch are for plotting).
 #   For this case we are interested only in 4 classes - Unconsolidated sediments fine (1) and coarse (2), sedimentary rocks (3) and rocks (4).
 #   We will also add fifth one which is not-defined or no data (-1). But first add a column to the geodataframe.
-gdf['glim_raw'] = glim_raw_lst
-
-#   Now we can reclassify the column into our 5 categories, create new column first, set all values to NaN
-gdf['litho_class'] = -1
-gdf.loc[gdf['glim_raw'].isin([100, 101, 102, 104, 108, 900]), 'litho_class'] = 1
-gdf.loc[gdf['glim_raw'].isin([103, 105, 106, 107, 109]), 'litho_class'] = 2
-gdf.loc[gdf['glim_raw'].between(199, 299), 'litho_class'] = 3
-gdf.loc[gdf['glim_raw'].between(299, 801), 'litho_class'] = 4
-
-#   Now we can finally export the geodataframe to shapefile
-gdf.to_file(r'\scratch\depfg\otoo0001\data\_HyGS\_database\_output\_gwh_mean.shp', driver = 'ESRI Shapefile')
\ No newline at end of file
+gdf['glim_raw'] = glim_raw.astype('int64')
+
+#   Now we can reclassify the column into our 5 categories. litho_4class looks the class up for the whole column at once
+with stage('litho_reclass', rows_in=len(gdf)) as st:
+    gdf['litho_class'] = litho_4class(gdf['glim_raw'].values)
+    st.set(rows_out=len(gdf))
+
+#   Now we can finally export the geodataframe. The shapefile is the classic option, but it is slow to write and it cuts
+#   the column names to 10 characters (mean_gwh_mbsl becomes mean_gwh_m). GeoParquet (write_geoparquet in
+#   geowat_export.py) is much faster, keeps the full names and can be read back with geopandas.read_parquet. If you
+#   do not need the lithology you can also skip python altogether with export_mean_gwh, which streams the query result
+#   from the database straight into a GeoParquet file.
+export_format = 'shapefile'
+
+with stage('export_' + export_format, rows_in=len(gdf)) as st:
+    if export_format == 'parquet':
+        write_geoparquet(gdf, r'\scratch\depfg\otoo0001\data\_HyGS\_database\_output\_gwh_mean.parquet')
+    else:
+        gdf.to_file(r'\scratch\depfg\otoo0001\data\_HyGS\_database\_output\_gwh_mean.shp', driver = 'ESRI Shapefile')
+    st.set(rows_out=len(gdf))
\ No newline at end of file
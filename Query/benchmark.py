@@ -0,0 +1,305 @@
+"""
+    Benchmark of the processing stages on synthetic data, so the scripts can be timed without the database or the
+    /scratch shapefiles. For every number of wells it generates:
+        -   gerbil tables (_lookup_tb and _gwh_yearly_tb) in a local DuckDB snapshot (see snapshot.py)
+        -   a global GLiM-like raster with lithology codes
+        -   a well table with the shapefile columns (mean_gwh_m, sim_gw_mea, n_years, x_wgs84, y_wgs84)
+        -   a country boundary shapefile
+    and times the database extraction, raster sampling, reclassification, declustering, bias/CDF, gridding and map
+    rendering. The results are written as JSON, compare two result files with --compare.
+
+    Usage:
+        python benchmark.py --sizes 10000 100000 1000000 --output benchmark.json
+        python benchmark.py --sizes 100000 --compare old_benchmark.json --output new_benchmark.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import duckdb
+import geopandas as gpd
+import matplotlib
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely
+
+matplotlib.use('Agg')
+
+from bias_evaluation import evaluate_pairs
+from declustering import compute_weights, weighting_schemes
+from geowat_db import extract_mean_gwh, gerbil_schema
+from instrumentation import stage
+from gridded import grid_well_statistics, plot_bias_cdf, reclassify_glim_raw
+from litho_reclass import litho_4class, litho_class_styles
+from map_rendering import load_boundary_lines
+from plotting import plot_litho_class, plot_mean_gwh, plot_n_years, plot_well_weight
+from raster_sampling import sample_raster
+from snapshot import connect_snapshot
+
+#   stages in the order they run
+benchmark_stages = ('db_extraction', 'raster_sampling', 'reclassification', 'declustering', 'bias_cdf', 'gridding',
+                    'plotting')
+
+#   wells generated per batch when filling the synthetic database
+generate_batch_size = 1000000
+
+#   resolution of the synthetic GLiM raster in degrees (5 arcmin)
+raster_resolution = 5. / 60.
+
+
+def synthetic_wells(n_wells, seed=0, n_clusters=500):
+    """
+    Well table with the columns of the well shapefiles. The wells are clustered around random centers like the
+    real database, so the declustering and the density maps have something to do.
+
+    Returns:
+    - DataFrame: id_gerbil, x_wgs84, y_wgs84, n_years, mean_gwh_m, sim_gw_mea.
+    """
+    rng = np.random.default_rng(seed)
+    centers_x = rng.uniform(-170., 170., n_clusters)
+    centers_y = rng.uniform(-55., 70., n_clusters)
+    spread = rng.uniform(0.2, 3., n_clusters)
+    cluster = rng.integers(0, n_clusters, n_wells)
+    x = np.clip(centers_x[cluster] + rng.normal(0., 1., n_wells) * spread[cluster], -179.99, 179.99)
+    y = np.clip(centers_y[cluster] + rng.normal(0., 1., n_wells) * spread[cluster], -89.99, 89.99)
+    mean_gwh = np.round(rng.gamma(2., 8., n_wells) - 5., 2)
+    return pd.DataFrame({'id_gerbil': np.arange(1, n_wells + 1, dtype='int64'), 'x_wgs84': x, 'y_wgs84': y,
+                         'n_years': rng.integers(1, 41, n_wells).astype('int32'), 'mean_gwh_m': mean_gwh,
+                         'sim_gw_mea': mean_gwh + rng.normal(0., 5., n_wells)})
+
+
+def write_synthetic_snapshot(snapshot_path, wells, first_year=1980, seed=0):
+    """
+    Write _lookup_tb and _gwh_yearly_tb for the wells into a DuckDB snapshot, with n_years yearly values (in
+    centimeters) per well.
+    """
+    rng = np.random.default_rng(seed)
+    duck = duckdb.connect(snapshot_path)
+    try:
+        duck.execute("CREATE SCHEMA IF NOT EXISTS %s" % gerbil_schema)
+        duck.execute("DROP TABLE IF EXISTS %s._lookup_tb" % gerbil_schema)
+        duck.execute("DROP TABLE IF EXISTS %s._gwh_yearly_tb" % gerbil_schema)
+        for start in range(0, len(wells), generate_batch_size):
+            part = wells.iloc[start:start + generate_batch_size]
+            lookup = pd.DataFrame({'id_gerbil': part['id_gerbil'].to_numpy(),
+                                   'country_name': np.where(part['x_wgs84'] < 0, 'West', 'East'),
+                                   'id_orig_src': part['id_gerbil'].astype(str).to_numpy(),
+                                   'x_wgs84': part['x_wgs84'].to_numpy(), 'y_wgs84': part['y_wgs84'].to_numpy(),
+                                   'orig_elev_m_asl': rng.uniform(0., 2000., len(part)),
+                                   'glo90_elev_m_asl': rng.uniform(0., 2000., len(part))})
+            n_years = part['n_years'].to_numpy()
+            ids = np.repeat(part['id_gerbil'].to_numpy(), n_years)
+            first = np.repeat(np.cumsum(n_years) - n_years, n_years)
+            yearly = pd.DataFrame({'id_gerbil': ids,
+                                   'year': (first_year + np.arange(len(ids)) - first).astype('int32'),
+                                   'gw_head_m': np.round(np.repeat(part['mean_gwh_m'].to_numpy() * 100., n_years) +
+                                                         rng.normal(0., 50., len(ids))).astype('int32')})
+            if start == 0:
+                duck.execute("CREATE TABLE %s._lookup_tb AS SELECT * FROM lookup" % gerbil_schema)
+                duck.execute("CREATE TABLE %s._gwh_yearly_tb AS SELECT * FROM yearly" % gerbil_schema)
+            else:
+                duck.execute("INSERT INTO %s._lookup_tb SELECT * FROM lookup" % gerbil_schema)
+                duck.execute("INSERT INTO %s._gwh_yearly_tb SELECT * FROM yearly" % gerbil_schema)
+    finally:
+        duck.close()
+
+
+def write_synthetic_glim(raster_path, seed=0, resolution_deg=raster_resolution, block_deg=2.):
+    """
+    Global GLiM-like GeoTIFF with lithology codes (lith_num of litho_class_styles) in patches of block_deg degrees,
+    some patches are no data.
+    """
+    rng = np.random.default_rng(seed)
+    codes = np.array(sorted({style['lith_num'] for style in litho_class_styles.values()}), dtype='int16')
+    factor = int(round(block_deg / resolution_deg))
+    coarse = codes[rng.integers(0, len(codes), (int(180 / block_deg), int(360 / block_deg)))]
+    coarse[rng.random(coarse.shape) < 0.1] = -1
+    data = np.repeat(np.repeat(coarse, factor, axis=0), factor, axis=1)
+    profile = {'driver': 'GTiff', 'height': data.shape[0], 'width': data.shape[1], 'count': 1, 'dtype': 'int16',
+               'crs': 'EPSG:4326', 'transform': rasterio.transform.from_origin(-180., 90., resolution_deg,
+                                                                                 resolution_deg),
+               'nodata': -1, 'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'compress': 'deflate'}
+    with rasterio.open(raster_path, 'w', **profile) as dst:
+        dst.write(data, 1)
+
+
+def write_synthetic_boundary(boundary_path, n_countries=400, seed=0):
+    """
+    Boundary shapefile with n_countries random rectangles standing in for the countries.
+    """
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(-175., 165., n_countries)
+    y = rng.uniform(-55., 60., n_countries)
+    size = rng.uniform(1., 15., n_countries)
+    boxes = shapely.box(x, y, x + size, y + size * 0.7)
+    gpd.GeoDataFrame({'name': [f'country_{i}' for i in range(n_countries)]}, geometry=boxes,
+                     crs='EPSG:4326').to_file(boundary_path)
+
+
+def _time_stage(name, func, repeat):
+    #   best of repeat runs, every run is a stage in the trace (see instrumentation.py). The result and the record of
+    #   the fastest run are returned
+    best = None
+    for _ in range(repeat):
+        with stage(name, benchmark=True) as current:
+            result = func()
+            current.set(rows_out=len(result) if hasattr(result, '__len__') and not isinstance(result, tuple)
+                        else None)
+        if best is None or current.record['wall_seconds'] < best[1]['wall_seconds']:
+            best = (result, current.record)
+    return best
+
+
+def run_benchmark(n_wells, workdir, stages=benchmark_stages, repeat=1, seed=0, scheme='nearest_neighbour'):
+    """
+    Generate the synthetic data for n_wells wells and time the stages.
+
+    Parameters:
+    - n_wells (int): Number of wells.
+    - workdir (str): Folder for the synthetic files and plots.
+    - stages (list of str): Stages to time, see benchmark_stages.
+    - repeat (int): Runs per stage, the fastest one is reported.
+    - seed (int): Random seed of the generator.
+    - scheme (str): Weighting scheme of the declustering stage, see weighting_schemes in declustering.py.
+
+    Returns:
+    - dict: n_wells, scheme, setup_seconds and a list with seconds, rows and peak_rss_mb per stage.
+    """
+    os.makedirs(workdir, exist_ok=True)
+    start = time.perf_counter()
+    wells = synthetic_wells(n_wells, seed=seed)
+    raster_path = os.path.join(workdir, 'glim_synthetic.tif')
+    boundary_path = os.path.join(workdir, 'boundary_synthetic.shp')
+    snapshot_path = os.path.join(workdir, f'gerbil_{n_wells}.duckdb')
+    if not os.path.exists(raster_path):
+        write_synthetic_glim(raster_path, seed=seed)
+    if not os.path.exists(boundary_path):
+        write_synthetic_boundary(boundary_path, seed=seed)
+    if 'db_extraction' in stages and not os.path.exists(snapshot_path):
+        write_synthetic_snapshot(snapshot_path, wells, seed=seed)
+    setup_seconds = time.perf_counter() - start
+
+    x = wells['x_wgs84'].to_numpy()
+    y = wells['y_wgs84'].to_numpy()
+    plot_folder = os.path.join(workdir, f'plots_{n_wells}')
+    os.makedirs(plot_folder, exist_ok=True)
+
+    def db_extraction():
+        connection, cursor = connect_snapshot(snapshot_path)
+        try:
+            return extract_mean_gwh(cursor)
+        finally:
+            connection.close()
+
+    def raster_sampling():
+        wells['glim_raw'] = sample_raster(raster_path, x, y, max_workers=4)
+        return wells['glim_raw']
+
+    def reclassification():
+        wells['litho_class'] = litho_4class(wells['glim_raw'].values)
+        return reclassify_glim_raw(wells)
+
+    def declustering():
+        #   the same call as well_weighting.main and the pipeline
+        return compute_weights(wells, scheme=scheme)
+
+    def bias_cdf():
+        wells['bias'] = wells['mean_gwh_m'] - wells['sim_gw_mea']
+        metrics = evaluate_pairs(wells, [('mean_gwh_m', 'sim_gw_mea')])
+        plot_bias_cdf(wells['bias'].values, os.path.join(plot_folder, 'bias_cdf.png'))
+        return metrics
+
+    def gridding():
+        return grid_well_statistics(wells, ['mean_gwh_m', 'bias'])
+
+    def plotting():
+        boundary_lines = load_boundary_lines(boundary_path, cache_dir=plot_folder)
+        plot_n_years(wells, boundary_lines, plot_folder)
+        plot_well_weight(wells, boundary_lines, plot_folder)
+        plot_mean_gwh(wells, boundary_lines, plot_folder)
+        plot_litho_class(wells, boundary_lines, plot_folder)
+        return wells
+
+    stage_functions = {'db_extraction': db_extraction, 'raster_sampling': raster_sampling,
+                       'reclassification': reclassification, 'declustering': declustering, 'bias_cdf': bias_cdf,
+                       'gridding': gridding, 'plotting': plotting}
+    #   later stages need the columns of the earlier ones, those run untimed when they are not selected
+    results = []
+    for stage_name in benchmark_stages:
+        if stage_name not in stages:
+            if stage_name in ('raster_sampling', 'reclassification', 'declustering', 'bias_cdf'):
+                stage_functions[stage_name]()
+            continue
+        _, record = _time_stage(stage_name, stage_functions[stage_name], repeat)
+        results.append({'stage': stage_name, 'seconds': round(record['wall_seconds'], 4),
+                        'cpu_seconds': round(record['cpu_seconds'], 4), 'rows': int(record['rows_out'] or n_wells),
+                        'peak_rss_mb': record['peak_rss_mb']})
+        print("%10d wells  %-18s %9.3f s" % (n_wells, stage_name, record['wall_seconds']))
+
+    return {'n_wells': int(n_wells), 'scheme': scheme, 'setup_seconds': round(setup_seconds, 3), 'stages': results}
+
+
+def environment_info():
+    """
+    Versions and machine information stored with the results.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__,
+            'pandas': pd.__version__, 'geopandas': gpd.__version__, 'duckdb': duckdb.__version__,
+            'rasterio': rasterio.__version__, 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def compare_results(old, new):
+    """
+    Speed ratio (old / new seconds, above 1 is faster) for every size and stage present in both result dicts.
+
+    Returns:
+    - DataFrame: n_wells, stage, old_seconds, new_seconds and speedup.
+    """
+    def flatten(results):
+        return pd.DataFrame([{'n_wells': run['n_wells'], 'stage': record['stage'], 'seconds': record['seconds']}
+                             for run in results['runs'] for record in run['stages']])
+
+    merged = flatten(old).merge(flatten(new), on=['n_wells', 'stage'], suffixes=('_old', '_new'))
+    merged = merged.rename(columns={'seconds_old': 'old_seconds', 'seconds_new': 'new_seconds'})
+    merged['speedup'] = merged['old_seconds'] / merged['new_seconds']
+    return merged
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the geowat processing stages on synthetic data.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000], help="numbers of wells")
+    parser.add_argument('--stages', nargs='+', default=list(benchmark_stages), choices=benchmark_stages)
+    parser.add_argument('--repeat', type=int, default=1, help="runs per stage, the fastest is reported")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scheme', default='nearest_neighbour', choices=list(weighting_schemes),
+                        help="weighting scheme of the declustering stage")
+    parser.add_argument('--workdir', help="folder for the synthetic data, a temporary folder when not given")
+    parser.add_argument('--output', default='benchmark.json', help="JSON file for the results")
+    parser.add_argument('--compare', metavar='JSON', help="earlier results to compare with")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        workdir = args.workdir or tmp_dir
+        runs = [run_benchmark(n_wells, workdir, stages=args.stages, repeat=args.repeat, seed=args.seed,
+                              scheme=args.scheme)
+                for n_wells in args.sizes]
+    results = {'environment': environment_info(), 'runs': runs}
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare_results(json.load(f), results).to_string(index=False))
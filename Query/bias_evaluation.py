@@ -0,0 +1,173 @@
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from instrumentation import instrumented
+
+# Columns of the metrics table written by evaluate_files
+metric_columns = ['source', 'observed', 'simulated', 'group', 'n', 'weighted', 'mean_bias', 'rmse', 'r', 'alpha',
+                  'beta', 'kge']
+
+def load_well_table(path, columns):
+    """
+    Load only the needed columns of a well table, without building any geometries.
+
+    Parameters:
+    - path (str): Shapefile (or any OGR format) or Parquet/GeoParquet file.
+    - columns (list of str): Columns to read, columns that are not in the file are skipped.
+
+    Returns:
+    - DataFrame: Table with the requested columns that exist in the file.
+    """
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        available = set(pq.read_schema(path).names)
+        return pd.read_parquet(path, columns=[col for col in columns if col in available])
+    available = set(gpd.read_file(path, rows=0, ignore_geometry=True).columns)
+    return gpd.read_file(path, columns=[col for col in columns if col in available], ignore_geometry=True)
+
+def _grouped_sums(codes, n_groups, w, obs, sim):
+    # Weighted sums per group that all the metrics are built from, with one extra row for all wells together. Wells
+    # without a group (code n_groups) only count for all wells
+    terms = [w, w * obs, w * sim, w * obs * obs, w * sim * sim, w * obs * sim, w * (obs - sim) ** 2]
+    sums = np.array([np.bincount(codes, weights=term, minlength=n_groups + 1) for term in terms])
+    return np.column_stack((sums[:, :n_groups], sums.sum(axis=1)))
+
+def bias_metrics(obs, sim, weights=None, codes=None, n_groups=1):
+    """
+    Mean bias (obs - sim), RMSE and Kling-Gupta efficiency per group, computed from weighted sums in one pass.
+
+    Parameters:
+    - obs, sim (array): Observed and simulated values, wells with NaN in either are left out.
+    - weights (array): Weight per well, None gives every well the same weight.
+    - codes (array): Group code per well (0 .. n_groups - 1), None puts all wells in one group. Wells with code -1
+      (no group, for example NaN in pd.factorize) are only included in the value for all wells.
+    - n_groups (int): Number of groups.
+
+    Returns:
+    - dict: Metric name to array with one value per group plus a last value for all wells.
+    """
+    obs = np.asarray(obs, dtype='float64')
+    sim = np.asarray(sim, dtype='float64')
+    w = np.ones(len(obs)) if weights is None else np.asarray(weights, dtype='float64')
+    codes = np.zeros(len(obs), dtype='int64') if codes is None else np.asarray(codes)
+    valid = np.isfinite(obs) & np.isfinite(sim) & np.isfinite(w)
+    codes = np.where(codes >= 0, codes, n_groups)
+
+    n = np.bincount(codes[valid], minlength=n_groups + 1)
+    n = np.append(n[:n_groups], n.sum())
+    w_sum, wo, ws, woo, wss, wos, wdd = _grouped_sums(codes[valid], n_groups, w[valid], obs[valid], sim[valid])
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_obs = wo / w_sum
+        mean_sim = ws / w_sum
+        std_obs = np.sqrt(np.maximum(woo / w_sum - mean_obs ** 2, 0.))
+        std_sim = np.sqrt(np.maximum(wss / w_sum - mean_sim ** 2, 0.))
+        r = (wos / w_sum - mean_obs * mean_sim) / (std_obs * std_sim)
+        alpha = std_sim / std_obs
+        beta = mean_sim / mean_obs
+        kge = 1. - np.sqrt((r - 1.) ** 2 + (alpha - 1.) ** 2 + (beta - 1.) ** 2)
+        rmse = np.sqrt(wdd / w_sum)
+
+    return {'n': n, 'mean_bias': mean_obs - mean_sim, 'rmse': rmse, 'r': r, 'alpha': alpha, 'beta': beta, 'kge': kge}
+
+def evaluate_pairs(df, pairs, weight_column='weight', group_column='litho_class', source=''):
+    """
+    Bias metrics for many observed/simulated attribute pairs of one well table.
+
+    Parameters:
+    - df (DataFrame): Well table.
+    - pairs (list of tuple): (observed, simulated) column names, for example [('mean_gwh_m', 'sim_gw_mea')].
+    - weight_column (str): Column with well weights, the metrics are unweighted when it is not in df.
+    - group_column (str): Column to split the metrics by, only 'all' is reported when it is not in df.
+    - source (str): Name of the table, written in the 'source' column.
+
+    Returns:
+    - DataFrame: One row per pair and group, columns as metric_columns.
+    """
+    weights = df[weight_column].values if weight_column in df.columns else None
+    if group_column in df.columns:
+        codes, groups = pd.factorize(df[group_column], sort=True)
+        groups = [str(group) for group in groups]
+    else:
+        codes, groups = None, []
+    group_names = groups + ['all']
+
+    frames = []
+    for observed, simulated in pairs:
+        metrics = bias_metrics(df[observed].values, df[simulated].values, weights=weights, codes=codes,
+                               n_groups=max(len(groups), 1))
+        if not groups:
+            metrics = {name: values[-1:] for name, values in metrics.items()}
+        frame = pd.DataFrame(metrics)
+        frame.insert(0, 'group', group_names)
+        frame.insert(0, 'simulated', simulated)
+        frame.insert(0, 'observed', observed)
+        frame.insert(0, 'source', source)
+        frame['weighted'] = weights is not None
+        frames.append(frame[metric_columns])
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=metric_columns)
+
+def _resolve_column(df, column):
+    # ESRI Shapefiles cut column names to 10 characters (litho_class becomes litho_clas)
+    return column if column in df.columns or column[:10] not in df.columns else column[:10]
+
+@instrumented()
+def evaluate_file(path, pairs, weight_column='weight', group_column='litho_class'):
+    """
+    Load the needed columns of one well table and evaluate all attribute pairs, see evaluate_pairs. Column names
+    that were truncated in a shapefile are found as well.
+    """
+    columns = {col for pair in pairs for col in pair} | {weight_column, group_column}
+    df = load_well_table(path, sorted(columns | {col[:10] for col in columns}))
+    pairs = [(_resolve_column(df, obs), _resolve_column(df, sim)) for obs, sim in pairs]
+    pairs = [pair for pair in pairs if pair[0] in df.columns and pair[1] in df.columns]
+    return evaluate_pairs(df, pairs, weight_column=_resolve_column(df, weight_column),
+                          group_column=_resolve_column(df, group_column), source=os.path.basename(path))
+
+@instrumented()
+def evaluate_files(paths, pairs, output_path=None, max_workers=None, weight_column='weight',
+                   group_column='litho_class'):
+    """
+    Evaluate many model runs (one well table per run) in a process pool and collect all metrics in one table.
+
+    Parameters:
+    - paths (list of str): Well tables, see load_well_table.
+    - pairs (list of tuple): (observed, simulated) column names to evaluate in every table.
+    - output_path (str): Where to write the metrics table (.parquet or .csv), nothing is written when None.
+    - max_workers (int): Number of processes, None uses all cores.
+    - weight_column, group_column (str): See evaluate_pairs.
+
+    Returns:
+    - DataFrame: Metrics of all tables.
+    """
+    if max_workers == 1 or len(paths) <= 1:
+        frames = [evaluate_file(path, pairs, weight_column, group_column) for path in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            frames = list(pool.map(evaluate_file, paths, [pairs] * len(paths), [weight_column] * len(paths),
+                                   [group_column] * len(paths)))
+    metrics = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=metric_columns)
+
+    if output_path is not None:
+        if output_path.endswith('.parquet'):
+            metrics.to_parquet(output_path, index=False)
+        else:
+            metrics.to_csv(output_path, index=False)
+    return metrics
+
+if __name__ == '__main__':
+    # Define input and output folders
+    input_folder = '/scratch/depfg/otoo0001/data/Daniel_develop/Hygs/shapefile/output/new/'
+    output_folder = '/scratch/depfg/otoo0001/data/Daniel_develop/Hygs/shapefile/output/plots/'
+
+    # All model runs in the input folder and the attribute pairs to evaluate (observed, simulated)
+    paths = sorted(glob.glob(os.path.join(input_folder, '*.shp')))
+    pairs = [('mean_gwh_m', 'sim_gw_mea')]
+
+    metrics = evaluate_files(paths, pairs, output_path=os.path.join(output_folder, 'bias_metrics.csv'))
+    print(metrics)
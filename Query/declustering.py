@@ -0,0 +1,197 @@
+"""
+    Declustering of well locations. The KD-tree is built on 3D unit-sphere (ECEF) coordinates instead of lon/lat
+    degrees, so neighbour distances are true great-circle distances, also near the poles and across the dateline.
+    Queries run on all cores (workers=-1) and in chunks of wells, so memory stays bounded for millions of wells.
+
+    The declustering rate is turned into a well weight by one of the weighting_schemes, 'nearest_neighbour' is the
+    original formula from well_weighting.py.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from grid_aggregation import cell_declustering_weights
+
+#   mean earth radius in km
+earth_radius_km = 6371.0088
+
+#   wells per tree query, bounds the size of the temporary distance/count arrays
+default_chunk_size = 1000000
+
+
+def lonlat_to_xyz(lon, lat):
+    """
+    Convert longitude/latitude in degrees to points on the unit sphere.
+
+    Returns:
+    - numpy array: (n, 3) array of x, y, z.
+    """
+    lon = np.radians(np.asarray(lon, dtype='float64'))
+    lat = np.radians(np.asarray(lat, dtype='float64'))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+
+def chord_to_km(chord):
+    """
+    Convert a straight-line distance between two points on the unit sphere to a great-circle distance in km.
+    """
+    return 2. * np.arcsin(np.clip(np.asarray(chord) / 2., 0., 1.)) * earth_radius_km
+
+
+def km_to_chord(distance_km):
+    """
+    Convert a great-circle distance in km to the straight-line distance on the unit sphere.
+    """
+    return 2. * np.sin(np.minimum(np.asarray(distance_km) / earth_radius_km, np.pi) / 2.)
+
+
+def _chunks(n, chunk_size):
+    for start in range(0, n, chunk_size):
+        yield slice(start, min(start + chunk_size, n))
+
+
+def nearest_neighbour_distance(lon, lat, k=2, chunk_size=default_chunk_size, workers=-1):
+    """
+    Great-circle distance from every well to its (k-1)-th nearest other well. With the default k=2 this is the
+    distance to the nearest neighbour, the first hit of the query is always the well itself.
+
+    Parameters:
+    - lon, lat (array): Well coordinates in degrees (WGS84).
+    - k (int): Number of points returned by the tree query, including the well itself.
+    - chunk_size (int): Wells per query.
+    - workers (int): Threads for the tree query, -1 uses all cores.
+
+    Returns:
+    - numpy array: Distance in km, inf when there are fewer than k wells.
+    """
+    xyz = lonlat_to_xyz(lon, lat)
+    tree = cKDTree(xyz)
+    distances = np.empty(len(xyz), dtype='float64')
+    for chunk in _chunks(len(xyz), chunk_size):
+        chord, _ = tree.query(xyz[chunk], k=k, workers=workers)
+        chord = chord[:, -1] if k > 1 else chord
+        #   the tree returns inf when there are fewer than k wells, chord_to_km would clip that to half the globe
+        distances[chunk] = np.where(np.isfinite(chord), chord_to_km(chord), np.inf)
+    return distances
+
+
+def neighbour_count(lon, lat, radius_km=50., chunk_size=default_chunk_size, workers=-1):
+    """
+    Number of other wells within radius_km (great-circle distance) of every well.
+
+    Parameters:
+    - lon, lat (array): Well coordinates in degrees (WGS84).
+    - radius_km (float): Search radius in km.
+    - chunk_size (int): Wells per query.
+    - workers (int): Threads for the tree query, -1 uses all cores.
+
+    Returns:
+    - numpy array: Neighbour counts (the well itself is not counted).
+    """
+    xyz = lonlat_to_xyz(lon, lat)
+    tree = cKDTree(xyz)
+    counts = np.empty(len(xyz), dtype='int64')
+    radius = float(km_to_chord(radius_km))
+    for chunk in _chunks(len(xyz), chunk_size):
+        counts[chunk] = tree.query_ball_point(xyz[chunk], r=radius, workers=workers, return_length=True) - 1
+    return counts
+
+
+def _min_max(values, constant=0.):
+    #   normalize to 0-1, when all values are the same there is nothing to normalize and every well gets constant
+    values = np.asarray(values, dtype='float64')
+    if len(values) == 0:
+        return values
+    value_range = values.max() - values.min()
+    if value_range == 0:
+        return np.full(len(values), constant, dtype='float64')
+    return (values - values.min()) / value_range
+
+
+def weight_nearest_neighbour(dcl_rate, n_years):
+    """
+    Original weighting from well_weighting.py: the declustering rate (distance to the nearest well) is normalized to
+    0-1, added to n_years, divided by the total over all wells and normalized to 0-1 again. When all wells have the
+    same rate the normalized rate is 0, when all weights are the same every well gets weight 1.
+
+    Parameters:
+    - dcl_rate (array): Distance to the nearest well.
+    - n_years (array): Number of yearly values per well.
+
+    Returns:
+    - tuple: (normalized dcl_rate, weight).
+    """
+    dcl_rate = _min_max(dcl_rate)
+    weight = (dcl_rate + n_years) / np.sum(dcl_rate + n_years)
+    return dcl_rate, _min_max(weight, constant=1.)
+
+
+def weight_inverse_density(neighbours, n_years):
+    """
+    Density based weighting: wells with many neighbours within the search radius get a low declustering rate,
+    dcl_rate = 1 / (1 + neighbours). The rate is then combined with n_years like weight_nearest_neighbour.
+
+    Parameters:
+    - neighbours (array): Number of other wells within the search radius.
+    - n_years (array): Number of yearly values per well.
+
+    Returns:
+    - tuple: (normalized dcl_rate, weight).
+    """
+    return weight_nearest_neighbour(1. / (1. + np.asarray(neighbours, dtype='float64')), n_years)
+
+
+def weight_cell(cell_weights, n_years):
+    """
+    Classic cell declustering: the weight is the cell-declustering weight of grid_aggregation.py (every occupied cell
+    gets the same total weight, shared by its wells, the weights sum to 1), n_years is not used.
+
+    Parameters:
+    - cell_weights (array): Weights from cell_declustering_weights.
+    - n_years (array): Number of yearly values per well (not used, for the same signature as the other schemes).
+
+    Returns:
+    - tuple: (dcl_rate, weight). dcl_rate is the weight relative to the largest one, 1 for wells alone in their
+      cell. When all cells hold the same number of wells every well has dcl_rate 1 and the same weight.
+    """
+    weight = np.asarray(cell_weights, dtype='float64')
+    max_weight = weight.max() if len(weight) else 0.
+    if max_weight == 0:
+        #   no well inside the grid
+        return np.zeros(len(weight), dtype='float64'), weight
+    return weight / max_weight, weight
+
+
+#   weighting scheme name to the function that computes the declustering rate from the coordinates and the function
+#   that turns the rate into a weight. 'cell' is cell declustering on a grid of resolution_deg, see
+#   grid_aggregation.py
+weighting_schemes = {'nearest_neighbour': (nearest_neighbour_distance, weight_nearest_neighbour),
+                     'inverse_density': (neighbour_count, weight_inverse_density),
+                     'cell': (cell_declustering_weights, weight_cell)}
+
+
+def compute_weights(gdf, scheme='nearest_neighbour', x_col='x_wgs84', y_col='y_wgs84', **kwargs):
+    """
+    Add the 'dcl_rate' and 'weight' columns to a (Geo)DataFrame of wells.
+
+    Parameters:
+    - gdf (GeoDataFrame): Wells with coordinate columns and 'n_years'.
+    - scheme (str): Key of weighting_schemes.
+    - x_col, y_col (str): Longitude and latitude columns.
+    - kwargs: Passed to the declustering rate function (k, radius_km, resolution_deg, chunk_size, workers).
+
+    Returns:
+    - GeoDataFrame: Input with 'dcl_rate' (normalized) and 'weight' columns. The 'cell' weights sum to 1, the other
+      schemes are normalized to 0-1.
+    """
+    if scheme not in weighting_schemes:
+        raise ValueError(f"Unknown weighting scheme '{scheme}', expected one of {list(weighting_schemes)}")
+    if 'n_years' not in gdf.columns:
+        raise ValueError("Column 'n_years' is required for calculating well weights.")
+    rate_func, weight_func = weighting_schemes[scheme]
+    rate = rate_func(gdf[x_col].values, gdf[y_col].values, **kwargs)
+    #   a single well has no neighbour, give it a large finite rate like before
+    rate = np.where(np.isinf(rate), 1e6, rate)
+    gdf['dcl_rate'], gdf['weight'] = weight_func(rate, gdf['n_years'].values)
+    return gdf
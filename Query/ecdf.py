@@ -0,0 +1,193 @@
+"""
+    Empirical CDFs of large value sets (bias of millions of wells over many model runs). Small inputs get the exact
+    ECDF, large or streamed inputs go into a fixed-bin histogram sketch. Sketches with the same bins can be filled
+    chunk by chunk, in different processes, and merged afterwards; the CDF is then drawn from a few hundred quantiles
+    instead of one marker per well.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+#   inputs up to this size use the exact ECDF by default
+exact_limit = 100000
+
+#   number of quantiles used to draw a CDF from a sketch
+default_n_quantiles = 500
+
+
+def exact_ecdf(values):
+    """
+    Exact empirical CDF, NaN values are left out.
+
+    Parameters:
+    - values (array): Values.
+
+    Returns:
+    - tuple: (x, y) with x the sorted values and y = i / n for i = 1 .. n, so a single value gives ([v], [1.]).
+    """
+    values = np.asarray(values, dtype='float64')
+    x = np.sort(values[~np.isnan(values)])
+    y = np.arange(1, len(x) + 1) / float(max(len(x), 1))
+    return x, y
+
+
+class HistogramSketch:
+    """
+    Mergeable fixed-bin histogram for quantiles and CDFs of a stream of values.
+
+    Values below lo or above hi are counted in an under/overflow bin and the exact minimum and maximum are kept, so
+    quantiles are always within the data range. Quantiles inside [lo, hi] are accurate to one bin width.
+
+    Parameters:
+    - lo, hi (float): Range covered by the regular bins.
+    - n_bins (int): Number of regular bins.
+    """
+
+    def __init__(self, lo=-1000., hi=1000., n_bins=40000):
+        self.lo = float(lo)
+        self.hi = float(hi)
+        self.n_bins = int(n_bins)
+        self.counts = np.zeros(self.n_bins + 2, dtype='int64')
+        self.min = np.inf
+        self.max = -np.inf
+        self.n_nan = 0
+
+    @property
+    def n(self):
+        return int(self.counts.sum())
+
+    def update(self, values):
+        """
+        Add a chunk of values, NaN values are only counted in n_nan.
+        """
+        values = np.asarray(values, dtype='float64').ravel()
+        nan = np.isnan(values)
+        self.n_nan += int(nan.sum())
+        values = values[~nan]
+        if len(values) == 0:
+            return self
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        #   bin 0 is the underflow bin and bin n_bins + 1 the overflow bin
+        idx = np.floor((values - self.lo) / (self.hi - self.lo) * self.n_bins).astype('int64') + 1
+        np.clip(idx, 0, self.n_bins + 1, out=idx)
+        idx[values >= self.hi] = self.n_bins + 1
+        self.counts += np.bincount(idx, minlength=self.n_bins + 2)
+        return self
+
+    def merge(self, other):
+        """
+        Add the counts of another sketch with the same bins.
+        """
+        if (self.lo, self.hi, self.n_bins) != (other.lo, other.hi, other.n_bins):
+            raise ValueError("Only sketches with the same bins can be merged")
+        self.counts += other.counts
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.n_nan += other.n_nan
+        return self
+
+    def _edges(self):
+        #   edges of the underflow, regular and overflow bins, the outer bins end at the data minimum/maximum
+        edges = np.linspace(self.lo, self.hi, self.n_bins + 1)
+        return np.concatenate(([min(self.min, self.lo)], edges, [max(self.max, self.hi)]))
+
+    def quantiles(self, probs):
+        """
+        Quantiles by linear interpolation inside the bins.
+
+        Parameters:
+        - probs (array): Probabilities between 0 and 1.
+
+        Returns:
+        - numpy array: Quantile values, NaN when the sketch is empty.
+        """
+        probs = np.asarray(probs, dtype='float64')
+        n = self.n
+        if n == 0:
+            return np.full(probs.shape, np.nan)
+        edges = self._edges()
+        cum = np.cumsum(self.counts)
+        target = np.clip(probs, 0., 1.) * n
+        idx = np.minimum(np.searchsorted(cum, target, side='left'), len(self.counts) - 1)
+        before = np.where(idx > 0, cum[idx - 1], 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = np.where(self.counts[idx] > 0, (target - before) / self.counts[idx], 0.)
+        values = edges[idx] + frac * (edges[idx + 1] - edges[idx])
+        return np.clip(values, self.min, self.max)
+
+    def cdf(self, n_quantiles=default_n_quantiles):
+        """
+        CDF curve (x, y) from n_quantiles evenly spaced quantiles.
+        """
+        probs = np.linspace(0., 1., n_quantiles)
+        return self.quantiles(probs), probs
+
+
+def merge_sketches(sketches):
+    """
+    Merge a list of sketches with the same bins into a new sketch.
+    """
+    sketches = list(sketches)
+    merged = HistogramSketch(sketches[0].lo, sketches[0].hi, sketches[0].n_bins)
+    for sketch in sketches:
+        merged.merge(sketch)
+    return merged
+
+
+def sketch_from_chunks(chunks, **sketch_kwargs):
+    """
+    Fill one sketch from an iterable of value chunks (for example the bias column of each chunk from
+    geowat_db.iter_query_chunks).
+    """
+    sketch = HistogramSketch(**sketch_kwargs)
+    for chunk in chunks:
+        sketch.update(chunk)
+    return sketch
+
+
+def _sketch_values(args):
+    values, sketch_kwargs = args
+    return HistogramSketch(**sketch_kwargs).update(values)
+
+
+def parallel_sketch(value_sets, max_workers=None, **sketch_kwargs):
+    """
+    Build one sketch per value set in a process pool, for example one per model run or lithology class.
+
+    Parameters:
+    - value_sets (dict): Name to array of values.
+    - max_workers (int): Number of processes, None uses all cores.
+    - sketch_kwargs: Bins of the sketches (lo, hi, n_bins).
+
+    Returns:
+    - dict: Name to HistogramSketch, merge them with merge_sketches for a combined CDF.
+    """
+    names = list(value_sets)
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        sketches = pool.map(_sketch_values, [(value_sets[name], sketch_kwargs) for name in names])
+        return dict(zip(names, sketches))
+
+
+def ecdf_curve(values, n_quantiles=default_n_quantiles, exact=None, **sketch_kwargs):
+    """
+    CDF curve of an array or a sketch, exact for small arrays and from quantiles otherwise.
+
+    Parameters:
+    - values (array or HistogramSketch): Values, NaN values are left out.
+    - n_quantiles (int): Points on the curve when it is drawn from a sketch.
+    - exact (bool): Force the exact (True) or the sketch (False) mode, by default exact up to exact_limit values.
+    - sketch_kwargs: Bins of the sketch when one is built.
+
+    Returns:
+    - tuple: (x, y) of the curve.
+    """
+    if isinstance(values, HistogramSketch):
+        return values.cdf(n_quantiles)
+    values = np.asarray(values, dtype='float64')
+    if exact is None:
+        exact = len(values) <= exact_limit
+    if exact:
+        return exact_ecdf(values)
+    return HistogramSketch(**sketch_kwargs).update(values).cdf(n_quantiles)
@@ -0,0 +1,238 @@
+"""
+    Local on-disk cache for query results, so re-running an analysis against the same database snapshot does not
+    download the same tables over the VPN again and again.
+
+    Results are stored as Parquet files keyed on the database they came from (server or snapshot file), the
+    (whitespace normalized) SQL text and its parameters. An entry is used again while it is younger than the TTL and a
+    cheap freshness probe on the tables in the query (the insert, update and delete counters postgres keeps in
+    pg_stat_all_tables) shows no change. When the cache grows over its size limit the least recently used entries are
+    removed.
+"""
+
+import hashlib
+import json
+import os
+import re
+import time
+
+import pandas as pd
+import psycopg2
+
+from geowat_db import gerbil_schema, query_to_dataframe
+
+#   environment variables that switch the cache on for the scripts
+cache_env_vars = {'cache_dir': 'GEOWAT_CACHE_DIR', 'ttl': 'GEOWAT_CACHE_TTL', 'max_bytes': 'GEOWAT_CACHE_MAX_BYTES'}
+
+#   freshness probes, one row per table.. 'stats' only reads the postgres statistics counters and costs nothing,
+#   'count' really counts the rows and is exact but has to scan the table
+probe_sql = {'stats': "SELECT n_tup_ins, n_tup_upd, n_tup_del FROM pg_stat_all_tables "
+                      "WHERE schemaname = %s AND relname = %s",
+             'count': "SELECT COUNT(*), MAX(id_gerbil) FROM {schema}.{table}"}
+
+_quoted_re = re.compile(r"('(?:[^']|'')*')")
+_table_re = re.compile(r"\b%s\.(\w+)" % gerbil_schema)
+
+
+def normalize_sql(sql_cmd):
+    """
+    Collapse all whitespace outside quoted strings, so the same query written differently gets the same cache key.
+    """
+    parts = _quoted_re.split(sql_cmd.strip().rstrip(';'))
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r'\s+', ' ', parts[i])
+    return ''.join(parts).strip()
+
+
+def tables_in_sql(sql_cmd):
+    """
+    Names of the gerbil tables used in an SQL command.
+    """
+    return sorted(set(_table_re.findall(sql_cmd)))
+
+
+def backend_identity(cursor):
+    """
+    Name of the database a cursor reads from: host, port and database name of a server, or the absolute path of a
+    snapshot (see snapshot.py), so results of different databases never share a cache entry.
+    """
+    connection = cursor.connection
+    #   a SnapshotConnection knows its file, a psycopg2 connection its server
+    snapshot_path = getattr(connection, 'path', None)
+    if snapshot_path is not None:
+        return 'snapshot:' + os.path.abspath(snapshot_path)
+    info = connection.info
+    return 'postgresql://%s:%s/%s' % (info.host, info.port, info.dbname)
+
+
+class QueryCache:
+    """
+    Parquet cache for query results.
+
+    Parameters:
+    - cache_dir (str): Folder for the parquet files and the index, created when it does not exist.
+    - ttl (float): Seconds an entry stays valid, None to keep entries until the data changes.
+    - max_bytes (int): Size limit of all cached files together.
+    - probe (str): Freshness probe, a key of probe_sql, or None to rely on the TTL only.
+    """
+
+    def __init__(self, cache_dir, ttl=7 * 24 * 3600, max_bytes=10 * 1024 ** 3, probe='stats'):
+        if probe is not None and probe not in probe_sql:
+            raise ValueError(f"Unknown probe '{probe}', expected one of {list(probe_sql)} or None")
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.probe = probe
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.counters = {'hits': 0, 'misses': 0, 'expired': 0, 'stale': 0, 'evictions': 0}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(sql_cmd, params=None, backend=None):
+        text = json.dumps([backend, normalize_sql(sql_cmd), params], default=str, sort_keys=True)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def _save_index(self, index):
+        #   write next to the index first and swap it in, so a crash never leaves half an index behind
+        tmp_path = self.index_path + '.%d.tmp' % os.getpid()
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _remove(self, index, key):
+        entry = index.pop(key)
+        try:
+            os.remove(os.path.join(self.cache_dir, entry['file']))
+        except FileNotFoundError:
+            pass
+
+    def freshness(self, cursor, tables):
+        """
+        Run the freshness probe for a list of tables.
+
+        Parameters:
+        - cursor: Open database cursor.
+        - tables (list of str): Table names in the gerbil schema.
+
+        Returns:
+        - dict: Table name to probe result, or None when there is no probe or it failed.
+        """
+        if self.probe is None or not tables:
+            return None
+        token = {}
+        try:
+            for table in tables:
+                if self.probe == 'stats':
+                    cursor.execute(probe_sql['stats'], (gerbil_schema, table))
+                else:
+                    cursor.execute(probe_sql['count'].format(schema=gerbil_schema, table=table))
+                token[table] = [str(val) for val in (cursor.fetchone() or [])]
+        except psycopg2.Error:
+            #   no rights on the statistics or a table without id_gerbil, fall back to the TTL only
+            cursor.connection.rollback()
+            return None
+        return token
+
+    def read_sql(self, cursor, sql_cmd, params=None, tables=None):
+        """
+        Return the result of an SQL command from the cache, or run it and store the result.
+
+        Parameters:
+        - cursor: Open database cursor.
+        - sql_cmd (str): SQL command with %s placeholders.
+        - params (tuple or dict): Values for the placeholders in sql_cmd.
+        - tables (list of str): Tables to probe for changes, taken from the SQL text when None.
+
+        Returns:
+        - DataFrame: Query result.
+        """
+        backend = backend_identity(cursor)
+        key = self.make_key(sql_cmd, params, backend=backend)
+        tables = tables_in_sql(sql_cmd) if tables is None else tables
+        token = self.freshness(cursor, tables)
+        now = time.time()
+
+        index = self._load_index()
+        entry = index.get(key)
+        if entry is not None:
+            path = os.path.join(self.cache_dir, entry['file'])
+            if self.ttl is not None and now - entry['created'] > self.ttl:
+                self.counters['expired'] += 1
+            elif token is not None and token != entry['freshness']:
+                self.counters['stale'] += 1
+            elif os.path.exists(path):
+                self.counters['hits'] += 1
+                entry['last_access'] = now
+                self._save_index(index)
+                return pd.read_parquet(path, memory_map=True)
+            self._remove(index, key)
+
+        self.counters['misses'] += 1
+        df = query_to_dataframe(cursor, sql_cmd, params)
+
+        file_name = key + '.parquet'
+        df.to_parquet(os.path.join(self.cache_dir, file_name), index=False)
+        index = self._load_index()
+        index[key] = {'file': file_name, 'backend': backend, 'sql': normalize_sql(sql_cmd), 'tables': tables, 'freshness': token,
+                      'created': now, 'last_access': now,
+                      'size': os.path.getsize(os.path.join(self.cache_dir, file_name))}
+        self._evict(index)
+        self._save_index(index)
+        return df
+
+    def _evict(self, index):
+        #   drop the least recently used entries until everything fits in max_bytes again
+        total = sum(entry['size'] for entry in index.values())
+        for key in sorted(index, key=lambda k: index[k]['last_access']):
+            if total <= self.max_bytes:
+                break
+            total -= index[key]['size']
+            self._remove(index, key)
+            self.counters['evictions'] += 1
+
+    def invalidate(self, table=None):
+        """
+        Remove all entries, or only the ones that use the given table.
+        """
+        index = self._load_index()
+        for key in [k for k, entry in index.items() if table is None or table in entry['tables']]:
+            self._remove(index, key)
+        self._save_index(index)
+
+    def stats(self):
+        """
+        Cache statistics of this session plus the current content of the cache folder.
+
+        Returns:
+        - dict: hits, misses, expired, stale, evictions, hit_rate, entries and bytes.
+        """
+        index = self._load_index()
+        lookups = self.counters['hits'] + self.counters['misses']
+        return {**self.counters,
+                'hit_rate': self.counters['hits'] / lookups if lookups else 0.,
+                'entries': len(index),
+                'bytes': sum(entry['size'] for entry in index.values())}
+
+
+def query_cache_from_env():
+    """
+    QueryCache configured with the GEOWAT_CACHE_DIR, GEOWAT_CACHE_TTL and GEOWAT_CACHE_MAX_BYTES environment
+    variables.
+
+    Returns:
+    - QueryCache or None: None when GEOWAT_CACHE_DIR is not set, so caching stays off by default.
+    """
+    cache_dir = os.environ.get(cache_env_vars['cache_dir'])
+    if not cache_dir:
+        return None
+    kwargs = {}
+    if os.environ.get(cache_env_vars['ttl']):
+        kwargs['ttl'] = float(os.environ[cache_env_vars['ttl']])
+    if os.environ.get(cache_env_vars['max_bytes']):
+        kwargs['max_bytes'] = int(os.environ[cache_env_vars['max_bytes']])
+    return QueryCache(cache_dir, **kwargs)
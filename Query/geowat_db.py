@@ -0,0 +1,339 @@
+"""
+    Reusable query functions for the geowat database. The SQL_geowat.py script walks through the same steps one by
+    one, here they are wrapped up so other scripts can import them without running the whole example.
+"""
+
+import os
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import psycopg2
+import psycopg2.pool
+
+#   default connection settings, this is the read-only account from the README. Every value can be overridden with an
+#   environment variable so batch jobs do not need to edit any script
+db_defaults = {'dbname': 'geowat', 'dbuser': 'geowat_user', 'dbhost': 'ages-db01.geo.uu.nl', 'dbpass': 'utrecht1994',
+               'dbport': 5432}
+db_env_vars = {'dbname': 'GEOWAT_DB_NAME', 'dbuser': 'GEOWAT_DB_USER', 'dbhost': 'GEOWAT_DB_HOST',
+               'dbpass': 'GEOWAT_DB_PASS', 'dbport': 'GEOWAT_DB_PORT'}
+
+#   tables that the query builders are allowed to use, everything lives in the gerbil schema
+gerbil_schema = 'gerbil'
+yearly_tables = ('_gwh_yearly_tb', '_gwe_yearly_tb', '_gws_yearly_tb')
+monthly_tables = ('_gwh_monthly_tb', '_gwe_monthly_tb', '_gws_monthly_tb')
+
+#   number of rows that a server-side cursor sends over per round trip
+default_itersize = 100000
+
+#   postgres type oids (cursor.description type_code) and the numpy/pandas dtype we give the column.. integers get the
+#   nullable pandas type so a missing value does not turn the whole column into floats
+pg_type_dtypes = {16: 'boolean', 20: 'Int64', 21: 'Int16', 23: 'Int32', 700: 'float32', 701: 'float64',
+                  1700: 'float64'}
+
+#   round a value to whole centimeters half to even, like pandas .round(0) in SQL_geowat.py and stream_mean_per_well.
+#   ROUND() in PostgreSQL (numeric) and DuckDB rounds half away from zero, which differs by 0.01 m on exact halves
+round_half_even_sql = ("(CASE WHEN {v} - FLOOR({v}) = 0.5 AND FLOOR({v}) = 2 * FLOOR(FLOOR({v}) / 2) "
+                       "THEN FLOOR({v}) ELSE FLOOR({v} + 0.5) END)")
+
+#   columns of the _lookup_tb that we attach to every well
+lookup_columns = ['id_orig_src', 'x_wgs84', 'y_wgs84', 'orig_elev_m_asl', 'glo90_elev_m_asl']
+
+
+def db_config_from_env():
+    """
+    Database connection settings taken from the GEOWAT_DB_* environment variables, falling back to db_defaults.
+
+    Returns:
+    - dict: Keyword arguments for connect_to_dtbase (dbname, dbuser, dbhost, dbpass, dbport).
+    """
+    return {key: os.environ.get(env_var, db_defaults[key]) for key, env_var in db_env_vars.items()}
+
+
+def make_conn_string(dbname, dbuser, dbhost, dbpass, dbport):
+    """
+    Build the libpq connection string used by connect_to_dtbase and GeowatPool.
+    """
+    return str("dbname=%s port=%s user=%s host=%s password=%s") % (dbname, dbport, dbuser, dbhost, dbpass)
+
+
+def connect_to_dtbase(dbname, dbuser, dbhost, dbpass, dbport):
+    #   create connection string
+    connstring = make_conn_string(dbname, dbuser, dbhost, dbpass, dbport)
+    connection = psycopg2.connect(connstring)
+    print("Successfully connected to database : " + str(dbname))
+    #   set the cursor and return both
+    cursor = connection.cursor()
+    return connection, cursor
+
+
+class GeowatPool:
+    """
+    Pool of open database connections, so many small queries (for example one per country) do not each pay for a
+    new connection handshake.
+
+    Connections are handed out with the connection() and cursor() context managers. When the block finishes the
+    transaction is committed, when it raises the transaction is rolled back and the connection goes back into the
+    pool ready for the next query - only connections that were actually lost are thrown away.
+
+    Parameters:
+    - minconn (int): Connections opened straight away.
+    - maxconn (int): Maximum number of connections open at the same time.
+    - readonly (bool): Run all transactions read-only.
+    - config (dict): Settings as returned by db_config_from_env, which is used when None.
+    """
+
+    def __init__(self, minconn=1, maxconn=8, readonly=True, config=None):
+        config = config or db_config_from_env()
+        self.readonly = readonly
+        self._pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, make_conn_string(**config))
+        print("Connection pool ready for database : " + str(config['dbname']))
+
+    @contextmanager
+    def connection(self):
+        conn = self._pool.getconn()
+        lost = False
+        try:
+            if conn.readonly != self.readonly:
+                conn.set_session(readonly=self.readonly)
+            yield conn
+            conn.commit()
+        except Exception:
+            #   a failed query leaves the transaction aborted, roll back so the connection can be used again
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                lost = True
+            raise
+        finally:
+            self._pool.putconn(conn, close=lost or conn.closed != 0)
+
+    @contextmanager
+    def cursor(self, name=None):
+        with self.connection() as conn:
+            cur = conn.cursor(name=name) if name else conn.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+
+    def closeall(self):
+        self._pool.closeall()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.closeall()
+
+
+def query_to_dataframe(cursor, sql_cmd, params=None, cache=None):
+    """
+    Run an SQL command and return the result as a DataFrame with the column names from the cursor.
+
+    Parameters:
+    - cursor: Open database cursor.
+    - sql_cmd (str): SQL command, values should be passed as %s placeholders and not pasted into the string.
+    - params (tuple or dict): Values for the placeholders in sql_cmd.
+    - cache (QueryCache): Optional cache from geowat_cache.py, the query only runs when there is no valid entry.
+
+    Returns:
+    - DataFrame: One row per returned record.
+    """
+    if cache is not None:
+        return cache.read_sql(cursor, sql_cmd, params)
+    cursor.execute(sql_cmd, params)
+    rows = cursor.fetchall()
+    col_names = [elt[0] for elt in cursor.description]
+    return pd.DataFrame(rows, columns=col_names)
+
+
+def build_mean_gwh_query(table='_gwh_yearly_tb', value_col='gw_head_m', country=None, bbox=None, year_range=None,
+                         min_years=None):
+    """
+    Build the SQL that computes the mean groundwater head per well inside the database.
+
+    The yearly rows are grouped by id_gerbil first and only then joined with the _lookup_tb, so a well with
+    duplicate lookup rows does not get its n_years counted twice. The country and bbox filters are applied before
+    the aggregation, so a filtered extraction only reads the yearly rows of the matching wells. The mean is rounded
+    to centimeters half to even, the same as the pandas version in SQL_geowat.py and stream_mean_per_well.
+
+    Parameters:
+    - table (str): Yearly table to aggregate, one of yearly_tables.
+    - value_col (str): Column with the yearly values in centimeters.
+    - country (str or list of str): Only keep wells in these countries (country_name in _lookup_tb).
+    - bbox (tuple): (xmin, ymin, xmax, ymax) in WGS84 degrees.
+    - year_range (tuple): (first_year, last_year), both included. Either end can be None.
+    - min_years (int): Only keep wells with at least this many yearly values.
+
+    Returns:
+    - tuple: (sql_cmd, params) ready to be passed to cursor.execute.
+    """
+    if table not in yearly_tables:
+        raise ValueError(f"Unknown yearly table '{table}', expected one of {yearly_tables}")
+    if not value_col.isidentifier():
+        raise ValueError(f"Invalid column name '{value_col}'")
+
+    #   filters on the yearly table go into the inner (aggregating) query
+    yearly_where = []
+    yearly_params = []
+    if year_range is not None:
+        first_year, last_year = year_range
+        if first_year is not None:
+            yearly_where.append("year >= %s")
+            yearly_params.append(int(first_year))
+        if last_year is not None:
+            yearly_where.append("year <= %s")
+            yearly_params.append(int(last_year))
+
+    having = ""
+    having_params = []
+    if min_years is not None:
+        having = " HAVING COUNT(*) >= %s"
+        having_params.append(int(min_years))
+
+    #   filters on the lookup table go into the join, and also into the yearly query as a list of wells, otherwise
+    #   PostgreSQL still aggregates the whole yearly table (it does not push the join into the GROUP BY)
+    lookup_where = []
+    lookup_params = []
+    if country is not None:
+        if isinstance(country, str):
+            country = [country]
+        lookup_where.append("country_name IN (%s)" % ", ".join(["%s"] * len(country)))
+        lookup_params.extend(country)
+    if bbox is not None:
+        xmin, ymin, xmax, ymax = bbox
+        lookup_where.append("x_wgs84 BETWEEN %s AND %s AND y_wgs84 BETWEEN %s AND %s")
+        lookup_params.extend([float(xmin), float(xmax), float(ymin), float(ymax)])
+
+    if lookup_where:
+        yearly_where.append("id_gerbil IN (SELECT id_gerbil FROM %s._lookup_tb WHERE %s)"
+                            % (gerbil_schema, " AND ".join(lookup_where)))
+        yearly_params.extend(lookup_params)
+
+    mean_sql = round_half_even_sql.format(v="AVG(%s)::double precision" % value_col)
+    yearly_sql = ("SELECT id_gerbil, (%s / 100.)::double precision AS mean_gwh_mbsl, COUNT(*) AS n_years FROM %s.%s"
+                  % (mean_sql, gerbil_schema, table))
+    if yearly_where:
+        yearly_sql += " WHERE " + " AND ".join(yearly_where)
+    yearly_sql += " GROUP BY id_gerbil" + having
+
+    lookup_sql = "SELECT DISTINCT id_gerbil, %s FROM %s._lookup_tb" % (", ".join(lookup_columns), gerbil_schema)
+    if lookup_where:
+        lookup_sql += " WHERE " + " AND ".join(lookup_where)
+
+    sql_cmd = ("SELECT g.id_gerbil, g.mean_gwh_mbsl, g.n_years, %s FROM (%s) g JOIN (%s) l ON l.id_gerbil = g.id_gerbil "
+               "ORDER BY g.id_gerbil" % (", ".join("l." + col for col in lookup_columns), yearly_sql, lookup_sql))
+    params = tuple(yearly_params + having_params + lookup_params)
+    return sql_cmd, params
+
+
+def extract_mean_gwh(cursor, table='_gwh_yearly_tb', value_col='gw_head_m', country=None, bbox=None,
+                     year_range=None, min_years=None, cache=None):
+    """
+    Get the mean groundwater head, number of yearly values and lookup information for every well, with the
+    aggregation and the join done by PostgreSQL so only one row per well is sent back.
+
+    Parameters:
+    - cursor: Open database cursor.
+    - cache (QueryCache): Optional result cache, see query_to_dataframe.
+    - other parameters: See build_mean_gwh_query.
+
+    Returns:
+    - DataFrame: Columns id_gerbil, mean_gwh_mbsl (meters), n_years and the lookup_columns.
+    """
+    sql_cmd, params = build_mean_gwh_query(table=table, value_col=value_col, country=country, bbox=bbox,
+                                           year_range=year_range, min_years=min_years)
+    df = query_to_dataframe(cursor, sql_cmd, params, cache=cache)
+    df['n_years'] = df['n_years'].astype('int32')
+    return df
+
+
+def iter_query_chunks(connection, sql_cmd, params=None, itersize=default_itersize, dtypes=None):
+    """
+    Run an SQL command with a named (server-side) cursor and yield the result in chunks, so the full result never
+    has to fit in memory as python tuples.
+
+    Parameters:
+    - connection: Open database connection. The named cursor lives inside the current transaction.
+    - sql_cmd (str): SQL command with %s placeholders.
+    - params (tuple or dict): Values for the placeholders in sql_cmd.
+    - itersize (int): Number of rows fetched per round trip and yielded per chunk.
+    - dtypes (dict): Column name to dtype, overrides the dtype derived from the postgres column type.
+
+    Yields:
+    - DataFrame: Typed chunk of at most itersize rows.
+    """
+    cursor = connection.cursor(name='geowat_stream_%s' % uuid.uuid4().hex)
+    cursor.itersize = itersize
+    try:
+        cursor.execute(sql_cmd, params)
+        col_names = None
+        col_dtypes = None
+        while True:
+            rows = cursor.fetchmany(itersize)
+            if not rows:
+                break
+            #   a named cursor only knows its description after the first fetch, we only need to read it once
+            if col_names is None:
+                col_names = [elt[0] for elt in cursor.description]
+                col_dtypes = {elt[0]: pg_type_dtypes[elt[1]] for elt in cursor.description if elt[1] in pg_type_dtypes}
+                col_dtypes.update(dtypes or {})
+            chunk = pd.DataFrame.from_records(rows, columns=col_names, coerce_float=True)
+            yield chunk.astype(col_dtypes)
+    finally:
+        cursor.close()
+
+
+def _merge_partial_sums(totals, parts):
+    #   add up per-well sums that may contain the same well more than once
+    return pd.concat(([] if totals is None else [totals]) + parts).groupby(level=0).sum()
+
+
+def stream_mean_per_well(connection, table='_gwh_yearly_tb', value_col='gw_head_m', itersize=default_itersize):
+    """
+    Mean value and number of records per well computed while streaming through a yearly or monthly table. Only the
+    running sums and counts per well are kept in memory, not the rows themselves.
+
+    Parameters:
+    - connection: Open database connection.
+    - table (str): One of yearly_tables or monthly_tables.
+    - value_col (str): Column with the values in centimeters.
+    - itersize (int): Rows per chunk.
+
+    Returns:
+    - DataFrame: Columns id_gerbil, mean_gwh_mbsl (meters, same rounding as SQL_geowat.py) and n_years (number of
+      records per well, so months for a monthly table).
+    """
+    if table not in yearly_tables + monthly_tables:
+        raise ValueError(f"Unknown table '{table}', expected one of {yearly_tables + monthly_tables}")
+    if not value_col.isidentifier():
+        raise ValueError(f"Invalid column name '{value_col}'")
+
+    sql_cmd = "SELECT id_gerbil, %s FROM %s.%s" % (value_col, gerbil_schema, table)
+    #   the per-chunk sums are collected and only merged once they hold as many rows as the merged table, so every
+    #   partial row is merged a bounded number of times instead of realigning all wells on every chunk
+    totals = None
+    parts = []
+    n_pending = 0
+    for chunk in iter_query_chunks(connection, sql_cmd, itersize=itersize):
+        part = chunk[value_col].astype('float64').groupby(chunk['id_gerbil']).agg(['sum', 'count', 'size'])
+        parts.append(part.set_axis(['total', 'n_valid', 'n_years'], axis=1))
+        n_pending += len(part)
+        if n_pending >= max(itersize, 0 if totals is None else len(totals)):
+            totals = _merge_partial_sums(totals, parts)
+            parts, n_pending = [], 0
+    if parts:
+        totals = _merge_partial_sums(totals, parts)
+
+    if totals is None:
+        return pd.DataFrame({'id_gerbil': pd.Series(dtype='int64'), 'mean_gwh_mbsl': pd.Series(dtype='float64'),
+                             'n_years': pd.Series(dtype='int32')})
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = totals['total'] / totals['n_valid']
+    df = pd.DataFrame({'id_gerbil': totals.index.to_numpy(),
+                       'mean_gwh_mbsl': mean.round(0).to_numpy() / 100.,
+                       'n_years': totals['n_years'].to_numpy().astype('int32')})
+    return df
@@ -0,0 +1,222 @@
+"""
+    Fast export of query results to (Geo)Parquet. Instead of fetching python tuples and going through pandas and
+    geopandas, the query result is streamed out of PostgreSQL with COPY ... TO STDOUT and read straight into Arrow
+    record batches. The point geometry is built from the x_wgs84/y_wgs84 columns as WKB in one numpy step.
+
+    Parquet keeps the full column names (no 10 character limit like the ESRI Shapefile, so mean_gwh_mbsl stays
+    mean_gwh_mbsl) and the file can be read back with geopandas.read_parquet.
+"""
+
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from geowat_db import build_mean_gwh_query
+
+#   arrow types for the postgres type oids (cursor.description type_code), anything else is read as text
+pg_type_arrow = {16: pa.bool_(), 20: pa.int64(), 21: pa.int16(), 23: pa.int32(), 700: pa.float32(),
+                 701: pa.float64(), 1700: pa.float64()}
+
+#   size of the csv blocks that are converted to one record batch / parquet row group
+default_block_size = 1 << 24
+
+#   byte layout of a little endian 2D WKB point: byte order, geometry type, x, y
+wkb_point_dtype = np.dtype([('byte_order', 'u1'), ('geom_type', '<u4'), ('x', '<f8'), ('y', '<f8')])
+
+
+def points_to_wkb(x, y):
+    """
+    Encode point coordinates as a WKB binary array without creating any python geometry objects.
+
+    Parameters:
+    - x (array): Longitudes.
+    - y (array): Latitudes.
+
+    Returns:
+    - pyarrow.BinaryArray: One WKB point per coordinate pair.
+    """
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    wkb = np.empty(len(x), dtype=wkb_point_dtype)
+    wkb['byte_order'] = 1
+    wkb['geom_type'] = 1
+    wkb['x'] = x
+    wkb['y'] = y
+    offsets = np.arange(0, (len(x) + 1) * wkb_point_dtype.itemsize, wkb_point_dtype.itemsize, dtype='int32')
+    return pa.Array.from_buffers(pa.binary(), len(x), [None, pa.py_buffer(offsets), pa.py_buffer(wkb.tobytes())])
+
+
+def geoparquet_metadata(bbox=None):
+    """
+    GeoParquet file metadata for a WKB point column named geometry in WGS84 (lon/lat).
+
+    Parameters:
+    - bbox (list): [xmin, ymin, xmax, ymax] of all points, only written when given.
+
+    Returns:
+    - dict: Schema metadata with the 'geo' key.
+    """
+    column = {'encoding': 'WKB', 'geometry_types': ['Point'], 'crs': 'EPSG:4326'}
+    #   the GeoParquet spec wants PROJJSON, pyproj is always installed next to geopandas so use it when we can
+    try:
+        from pyproj import CRS
+        column['crs'] = CRS.from_epsg(4326).to_json_dict()
+    except ImportError:
+        del column['crs']
+    if bbox is not None:
+        column['bbox'] = [float(val) for val in bbox]
+    geo = {'version': '1.0.0', 'primary_column': 'geometry', 'columns': {'geometry': column}}
+    return {b'geo': json.dumps(geo).encode('utf-8')}
+
+
+def add_point_geometry(table, x_col='x_wgs84', y_col='y_wgs84'):
+    """
+    Append a WKB geometry column built from the coordinate columns of an Arrow table.
+
+    Parameters:
+    - table (pyarrow.Table): Table with the coordinate columns.
+    - x_col (str): Name of the longitude column.
+    - y_col (str): Name of the latitude column.
+
+    Returns:
+    - pyarrow.Table: Input table with an extra 'geometry' column.
+    """
+    x = table.column(x_col).to_numpy(zero_copy_only=False)
+    y = table.column(y_col).to_numpy(zero_copy_only=False)
+    return table.append_column('geometry', points_to_wkb(x, y))
+
+
+def _prepare_table(table, geometry, x_col, y_col, bbox=None):
+    #   add the geometry column and the GeoParquet metadata (the bbox is optional in the spec, when streaming we do not
+    #   know it before the first row group is written)
+    if not geometry:
+        return table
+    table = add_point_geometry(table, x_col, y_col)
+    return table.replace_schema_metadata({**(table.schema.metadata or {}), **geoparquet_metadata(bbox)})
+
+
+def _arrow_column_types(connection, sql_cmd):
+    #   run the query with LIMIT 0 to get the column types, so every csv block is parsed with the same schema
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT * FROM (%s) q LIMIT 0" % sql_cmd)
+        return {elt[0]: pg_type_arrow.get(elt[1], pa.string()) for elt in cursor.description}
+    finally:
+        cursor.close()
+
+
+def copy_query_to_parquet(connection, sql_cmd, output_path, params=None, geometry=True, x_col='x_wgs84',
+                          y_col='y_wgs84', block_size=default_block_size):
+    """
+    Stream the result of an SQL query into a (Geo)Parquet file using COPY ... TO STDOUT.
+
+    PostgreSQL writes the rows as CSV into a pipe from a background thread while Arrow parses the other end block by
+    block, so the result never has to fit in memory. Booleans arrive as t/f in the CSV. When the query fails no
+    output file is left behind.
+
+    Parameters:
+    - connection: Open database connection.
+    - sql_cmd (str): SELECT statement, with %s placeholders for params.
+    - output_path (str): Path of the parquet file.
+    - params (tuple or dict): Values for the placeholders in sql_cmd.
+    - geometry (bool): Add a WKB point geometry column and GeoParquet metadata.
+    - x_col, y_col (str): Coordinate columns used for the geometry.
+    - block_size (int): Bytes of CSV parsed per record batch.
+
+    Returns:
+    - int: Number of rows written.
+    """
+    cursor = connection.cursor()
+    sql_cmd = cursor.mogrify(sql_cmd, params).decode('utf-8')
+    column_types = _arrow_column_types(connection, sql_cmd)
+    copy_sql = "COPY (%s) TO STDOUT WITH (FORMAT csv, HEADER true)" % sql_cmd
+
+    read_fd, write_fd = os.pipe()
+    copy_errors = []
+
+    def run_copy():
+        try:
+            with os.fdopen(write_fd, 'wb') as pipe_out:
+                cursor.copy_expert(copy_sql, pipe_out)
+        except Exception as e:
+            copy_errors.append(e)
+
+    copy_thread = threading.Thread(target=run_copy, daemon=True)
+    copy_thread.start()
+
+    n_rows = 0
+    writer = None
+    failed = True
+    try:
+        with os.fdopen(read_fd, 'rb') as pipe_in:
+            reader = pa_csv.open_csv(pipe_in,
+                                     read_options=pa_csv.ReadOptions(block_size=block_size),
+                                     convert_options=pa_csv.ConvertOptions(column_types=column_types,
+                                                                           strings_can_be_null=True,
+                                                                           quoted_strings_can_be_null=False,
+                                                                           true_values=['t'],
+                                                                           false_values=['f']))
+            for batch in reader:
+                table = _prepare_table(pa.Table.from_batches([batch]), geometry, x_col, y_col)
+                if writer is None:
+                    writer = pq.ParquetWriter(output_path, table.schema)
+                writer.write_table(table)
+                n_rows += table.num_rows
+        failed = False
+    finally:
+        copy_thread.join()
+        cursor.close()
+        if writer is not None:
+            writer.close()
+        #   do not leave a partial file behind when the COPY or the parsing failed
+        if (failed or copy_errors) and os.path.exists(output_path):
+            os.remove(output_path)
+
+    if copy_errors:
+        raise copy_errors[0]
+
+    if writer is None:
+        #   empty result, still write a file with the right columns
+        table = pa.schema(list(column_types.items())).empty_table()
+        pq.write_table(_prepare_table(table, geometry, x_col, y_col), output_path)
+    return n_rows
+
+
+def export_mean_gwh(connection, output_path, **filters):
+    """
+    Export the per-well mean groundwater head (see geowat_db.extract_mean_gwh) straight to GeoParquet.
+
+    Parameters:
+    - connection: Open database connection.
+    - output_path (str): Path of the parquet file.
+    - filters: Keyword arguments for geowat_db.build_mean_gwh_query.
+
+    Returns:
+    - int: Number of wells written.
+    """
+    sql_cmd, params = build_mean_gwh_query(**filters)
+    return copy_query_to_parquet(connection, sql_cmd, output_path, params=params)
+
+
+def write_geoparquet(df, output_path, x_col='x_wgs84', y_col='y_wgs84'):
+    """
+    Write a (Geo)DataFrame with coordinate columns to GeoParquet, as a replacement for
+    gdf.to_file(..., driver='ESRI Shapefile').
+
+    Parameters:
+    - df (DataFrame or GeoDataFrame): Data to write, an existing geometry column is rebuilt from x_col/y_col.
+    - output_path (str): Path of the parquet file.
+    - x_col, y_col (str): Coordinate columns.
+    """
+    df = df.drop(columns='geometry', errors='ignore')
+    bbox = None
+    if len(df) and df[x_col].notna().any():
+        bbox = [df[x_col].min(), df[y_col].min(), df[x_col].max(), df[y_col].max()]
+    table = pa.Table.from_pandas(pd.DataFrame(df), preserve_index=False)
+    pq.write_table(_prepare_table(table, True, x_col, y_col, bbox=bbox), output_path)
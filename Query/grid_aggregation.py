@@ -0,0 +1,175 @@
+"""
+    Aggregation of well values onto a regular lat/lon grid (for example 5 or 30 arcmin, the resolution of the model
+    output) with plain index arithmetic: every well gets a cell index, the per-cell statistics are accumulated with
+    np.bincount and reduceat over the occupied cells only, and the result is scattered into dense grids.
+
+    The same binning gives cell-declustering weights, an alternative to the nearest-neighbour weights in
+    declustering.py.
+"""
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+#   global extent (xmin, ymin, xmax, ymax) in degrees
+global_extent = (-180., -90., 180., 90.)
+
+#   common resolutions in degrees
+arcmin_5 = 5. / 60.
+arcmin_30 = 30. / 60.
+
+
+def grid_shape(resolution_deg, extent=global_extent):
+    """
+    Number of (rows, cols) of a grid with the given resolution and extent.
+    """
+    xmin, ymin, xmax, ymax = extent
+    return int(round((ymax - ymin) / resolution_deg)), int(round((xmax - xmin) / resolution_deg))
+
+
+def grid_cell_index(lon, lat, resolution_deg, extent=global_extent):
+    """
+    Flat cell index (row * n_cols + col, row 0 at the top) of every point.
+
+    Parameters:
+    - lon, lat (array): Coordinates in degrees.
+    - resolution_deg (float): Cell size in degrees.
+    - extent (tuple): (xmin, ymin, xmax, ymax) of the grid.
+
+    Returns:
+    - numpy array: int64 cell index, -1 for points outside the grid or without coordinates.
+    """
+    lon = np.asarray(lon, dtype='float64')
+    lat = np.asarray(lat, dtype='float64')
+    xmin, ymin, xmax, ymax = extent
+    n_rows, n_cols = grid_shape(resolution_deg, extent)
+    inside = (lon >= xmin) & (lon <= xmax) & (lat >= ymin) & (lat <= ymax)
+    cells = np.full(len(lon), -1, dtype='int64')
+    #   points exactly on the right or bottom edge go into the last column/row
+    rows = np.minimum(((ymax - lat[inside]) / resolution_deg).astype('int64'), n_rows - 1)
+    cols = np.minimum(((lon[inside] - xmin) / resolution_deg).astype('int64'), n_cols - 1)
+    cells[inside] = rows * n_cols + cols
+    return cells
+
+
+def _scatter(occupied, values, n_cells, shape, fill=np.nan, dtype='float32'):
+    grid = np.full(n_cells, fill, dtype=dtype)
+    grid[occupied] = values
+    return grid.reshape(shape)
+
+
+def aggregate_to_grid(lon, lat, columns, weights=None, resolution_deg=arcmin_30, extent=global_extent):
+    """
+    Per-cell count, (weighted) mean, minimum and maximum of one or more well attributes.
+
+    Parameters:
+    - lon, lat (array): Well coordinates in degrees.
+    - columns (dict): Attribute name to array of values, NaN values are left out.
+    - weights (array): Weight per well for the means, None for plain means. Cells where all weights are zero get
+      the plain mean.
+    - resolution_deg (float): Cell size in degrees.
+    - extent (tuple): (xmin, ymin, xmax, ymax) of the grid.
+
+    Returns:
+    - tuple: (layers, transform). layers is a dict of 2D float32 grids ('count' and '<name>_mean', '<name>_min',
+      '<name>_max' per attribute, NaN in empty cells), transform the Affine of the grid.
+    """
+    shape = grid_shape(resolution_deg, extent)
+    n_cells = shape[0] * shape[1]
+    cells = grid_cell_index(lon, lat, resolution_deg, extent)
+    use = cells >= 0
+    occupied, inverse = np.unique(cells[use], return_inverse=True)
+    n_occupied = len(occupied)
+
+    layers = {'count': _scatter(occupied, np.bincount(inverse, minlength=n_occupied), n_cells, shape, fill=0,
+                                dtype='int32')}
+    weights = None if weights is None else np.asarray(weights, dtype='float64')[use]
+
+    for name, values in columns.items():
+        values = np.asarray(values, dtype='float64')[use]
+        valid = np.isfinite(values)
+        cell = inverse[valid]
+        vals = values[valid]
+
+        n_valid = np.bincount(cell, minlength=n_occupied)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.bincount(cell, weights=vals, minlength=n_occupied) / n_valid
+            if weights is not None:
+                w = weights[valid]
+                w_sum = np.bincount(cell, weights=w, minlength=n_occupied)
+                w_mean = np.bincount(cell, weights=w * vals, minlength=n_occupied) / w_sum
+                mean = np.where(w_sum > 0, w_mean, mean)
+
+        #   min and max: sort the values by cell and reduce every run of equal cells
+        cell_min = np.full(n_occupied, np.nan)
+        cell_max = np.full(n_occupied, np.nan)
+        if len(cell):
+            order = np.argsort(cell, kind='stable')
+            sorted_cells = cell[order]
+            starts = np.flatnonzero(np.r_[True, sorted_cells[1:] != sorted_cells[:-1]])
+            cell_min[sorted_cells[starts]] = np.minimum.reduceat(vals[order], starts)
+            cell_max[sorted_cells[starts]] = np.maximum.reduceat(vals[order], starts)
+
+        layers[f'{name}_mean'] = _scatter(occupied, mean, n_cells, shape)
+        layers[f'{name}_min'] = _scatter(occupied, cell_min, n_cells, shape)
+        layers[f'{name}_max'] = _scatter(occupied, cell_max, n_cells, shape)
+
+    xmin, ymin, xmax, ymax = extent
+    return layers, from_origin(xmin, ymax, resolution_deg, resolution_deg)
+
+
+def write_grid_geotiff(layers, transform, output_path, crs='EPSG:4326'):
+    """
+    Write the grids from aggregate_to_grid to one multi-band GeoTIFF, the layer names are stored as band
+    descriptions.
+
+    Parameters:
+    - layers (dict): Name to 2D array, all with the same shape.
+    - transform (Affine): Grid transform.
+    - output_path (str): Path of the GeoTIFF.
+    - crs (str): Coordinate reference system.
+    """
+    names = list(layers)
+    height, width = layers[names[0]].shape
+    profile = {'driver': 'GTiff', 'height': height, 'width': width, 'count': len(names), 'dtype': 'float32',
+               'crs': crs, 'transform': transform, 'nodata': np.nan, 'compress': 'deflate', 'tiled': True,
+               'blockxsize': 256, 'blockysize': 256}
+    with rasterio.open(output_path, 'w', **profile) as dst:
+        for band, name in enumerate(names, start=1):
+            dst.write(layers[name].astype('float32'), band)
+            dst.set_band_description(band, name)
+
+
+def _cell_counts(cells):
+    counts = np.zeros(len(cells), dtype='int64')
+    use = cells >= 0
+    _, inverse, cell_counts = np.unique(cells[use], return_inverse=True, return_counts=True)
+    counts[use] = cell_counts[inverse]
+    return counts
+
+
+def cell_well_count(lon, lat, resolution_deg=arcmin_30, extent=global_extent):
+    """
+    Number of other wells in the same grid cell as every well.
+
+    Returns:
+    - numpy array: int64 count per well, 0 for wells outside the grid.
+    """
+    return np.maximum(_cell_counts(grid_cell_index(lon, lat, resolution_deg, extent)) - 1, 0)
+
+
+def cell_declustering_weights(lon, lat, resolution_deg=arcmin_30, extent=global_extent):
+    """
+    Classic cell-declustering weights: every occupied cell gets the same total weight, shared equally by the wells in
+    it, w = 1 / (wells in cell * occupied cells). The weights sum to 1.
+
+    Returns:
+    - numpy array: Weight per well, 0 for wells outside the grid.
+    """
+    cells = grid_cell_index(lon, lat, resolution_deg, extent)
+    n_in_cell = _cell_counts(cells)
+    use = cells >= 0
+    n_occupied = len(np.unique(cells[use]))
+    weights = np.zeros(len(cells), dtype='float64')
+    weights[use] = 1. / (n_in_cell[use] * n_occupied)
+    return weights
@@ -1,11 +1,13 @@
 import geopandas as gpd
 import matplotlib.pyplot as plt
-import numpy as np
-from scipy import stats
 import os
-from tqdm import tqdm
-import pandas as pd
 
+from ecdf import ecdf_curve
+from grid_aggregation import aggregate_to_grid, arcmin_30, write_grid_geotiff
+from instrumentation import instrumented, stage
+from litho_reclass import glim_su_class
+
+@instrumented()
 def calculate_bias(shapefile_path, attribute1, attribute2):
     """
     Calculate the bias (difference) between two attributes in a shapefile.
@@ -26,6 +28,7 @@ def calculate_bias(shapefile_path, attribute1, attribute2):
 
     return gdf
 
+@instrumented()
 def reclassify_glim_raw(gdf):
     """
     Reclassify 'glim_raw' values in a GeoDataFrame.
@@ -34,35 +37,65 @@ def reclassify_glim_raw(gdf):
     - gdf (GeoDataFrame): Input GeoDataFrame.
 
     Returns:
-    - GeoDataFrame: GeoDataFrame with added 'reclassified_glim' column.
+    - GeoDataFrame: GeoDataFrame with added 'reclassified_glim' column (1 unconsolidated sediments, 2 any other value,
+      -1 no data), see glim_su_class in litho_reclass.py.
     """
-    gdf['reclassified_glim'] = gdf['glim_raw'].apply(lambda x: 1 if x == 100 else (2 if pd.notnull(x) else -1))
+    gdf['reclassified_glim'] = glim_su_class(gdf['glim_raw'].values)
     return gdf
 
-def plot_bias_cdf(bias_values, plot_output_path):
+@instrumented()
+def plot_bias_cdf(bias_values, plot_output_path, label=None, show=False):
     """
     Plot the cumulative distribution function (CDF) of bias values.
 
     Parameters:
-    - bias_values (numpy array): Array of bias values.
+    - bias_values (numpy array, HistogramSketch or dict): Array of bias values, a sketch from ecdf.py, or a dict of
+      name to array/sketch to draw one CDF per model run or lithology class in the same plot. NaN values are left out.
     - plot_output_path (str): Path to save the plot.
+    - label (str): Legend label when a single array or sketch is given.
+    - show (bool): Also show the plot on screen, the figure is closed afterwards either way.
     """
-    sorted_bias = np.sort(bias_values)
-    yvals = np.arange(len(sorted_bias)) / float(len(sorted_bias) - 1)
+    curves = bias_values if isinstance(bias_values, dict) else {label: bias_values}
 
-    plt.figure(figsize=(8, 6))
-    plt.plot(sorted_bias, yvals, marker='.', linestyle='none', markersize=3)
+    fig = plt.figure(figsize=(8, 6))
+    for name, values in curves.items():
+        # Exact ECDF for small inputs, a few hundred quantiles of a histogram sketch for large ones
+        x, y = ecdf_curve(values)
+        plt.plot(x, y, drawstyle='steps-post', linewidth=1.5, label=name)
     plt.title('Cumulative Distribution Function (CDF) of Bias')
     plt.xlabel('Bias')
     plt.ylabel('Cumulative Probability')
     plt.grid(True)
+    if any(name is not None for name in curves):
+        plt.legend(loc='best')
     plt.tight_layout()
 
     # Save the plot
     plt.savefig(plot_output_path)
-    plt.show()
+    if show:
+        plt.show()
+    plt.close(fig)
+
+@instrumented()
+def grid_well_statistics(gdf, attributes, resolution_deg=arcmin_30, weight_column='weight'):
+    """
+    Aggregate well attributes onto a regular lat/lon grid, for comparison with the gridded model output.
+
+    Parameters:
+    - gdf (GeoDataFrame): Wells with 'x_wgs84' and 'y_wgs84' columns.
+    - attributes (list of str): Columns to aggregate, for example ['mean_gwh_m', 'bias'].
+    - resolution_deg (float): Cell size in degrees (arcmin_5 or arcmin_30 from grid_aggregation.py).
+    - weight_column (str): Column with well weights for the cell means, plain means when it is not in gdf.
+
+    Returns:
+    - tuple: (layers, transform), per cell count, mean, min and max of every attribute, see aggregate_to_grid.
+    """
+    weights = gdf[weight_column].values if weight_column in gdf.columns else None
+    columns = {attribute: gdf[attribute].values for attribute in attributes}
+    return aggregate_to_grid(gdf['x_wgs84'].values, gdf['y_wgs84'].values, columns, weights=weights,
+                             resolution_deg=resolution_deg)
 
-def main(input_folder, output_folder, shapefile_name, attribute1, attribute2):
+def main(input_folder, output_folder, shapefile_name, attribute1, attribute2, grid_resolution=None):
     """
     Main function to calculate bias, save results, reclassify 'glim_raw', and plot CDF.
 
@@ -72,6 +105,8 @@ def main(input_folder, output_folder, shapefile_name, attribute1, attribute2):
     - shapefile_name (str): Name of the shapefile (without extension).
     - attribute1 (str): Name of the first attribute.
     - attribute2 (str): Name of the second attribute.
+    - grid_resolution (float): When given, also write the gridded well statistics of attribute1 and the bias at this
+      resolution (degrees) as a GeoTIFF.
     """
     # Input shapefile path
     shapefile_path = os.path.join(input_folder, f'{shapefile_name}.shp')
@@ -89,7 +124,14 @@ def main(input_folder, output_folder, shapefile_name, attribute1, attribute2):
     gdf = reclassify_glim_raw(gdf)
 
     # Save GeoDataFrame with bias and reclassified 'glim_raw' as a new shapefile
-    gdf.to_file(output_shapefile_path)
+    with stage('write_wells', rows_in=len(gdf), path=output_shapefile_path) as st:
+        gdf.to_file(output_shapefile_path)
+        st.set(rows_out=len(gdf))
+
+    # Grid the well values and the bias
+    if grid_resolution is not None:
+        layers, transform = grid_well_statistics(gdf, [attribute1, 'bias'], resolution_deg=grid_resolution)
+        write_grid_geotiff(layers, transform, os.path.join(output_folder, f'{shapefile_name}_grid.tif'))
 
     # Plot CDF of bias values
     plot_bias_cdf(gdf['bias'].values, plot_output_path)
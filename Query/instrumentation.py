@@ -0,0 +1,284 @@
+"""
+    Stage level instrumentation for the scripts. Wrap a step in the stage() context manager (or decorate a function
+    with instrumented) and it records the wall and cpu time, rows in and out, bytes read or fetched and the peak
+    memory of that step. Every record is printed as a short line and, when GEOWAT_TRACE points to a file, appended to
+    it as one JSON object per line, so traces of many cluster jobs can be concatenated and compared with load_trace
+    and summarize_trace.
+
+    Environment variables:
+    - GEOWAT_TRACE: JSON lines file the stage records are appended to.
+    - GEOWAT_TRACE_QUIET: set to 1 to stop printing a line per stage.
+    - GEOWAT_PROFILE_DIR: folder for a cProfile dump (<stage>_<pid>_<n>.prof) of every stage.
+    - GEOWAT_TRACEMALLOC: set to 1 to also record the peak of python/numpy allocations per stage (slower).
+
+    The peak memory is the peak resident set size during the stage. On linux the kernel peak counter is reset at the
+    start of every stage, on other unix systems it is the peak of the process so far and on windows it is not
+    recorded (None).
+"""
+
+import cProfile
+import functools
+import itertools
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+trace_env_vars = {'trace': 'GEOWAT_TRACE', 'quiet': 'GEOWAT_TRACE_QUIET', 'profile_dir': 'GEOWAT_PROFILE_DIR',
+                  'tracemalloc': 'GEOWAT_TRACEMALLOC'}
+
+#   records of this process, also kept when no trace file is set
+trace_records = []
+
+_lock = threading.Lock()
+_active = []
+_counter = itertools.count()
+
+
+def _read_hwm_mb():
+    #   peak resident memory (VmHWM) in MB, from the process lifetime peak when /proc is not available and None when
+    #   there is no peak counter at all (windows)
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024. ** 2 if sys.platform == 'darwin' else peak / 1024.
+
+
+def _max_peak(a, b):
+    #   larger of two peaks, a peak that is not known (None) is ignored
+    if a is None or b is None:
+        return b if a is None else a
+    return max(a, b)
+
+
+def _reset_hwm():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def rows_of(obj):
+    """
+    Number of rows of a DataFrame, array or any sized object, None for everything else.
+    """
+    if obj is None or isinstance(obj, (str, bytes, dict, tuple)):
+        return None
+    try:
+        return len(obj)
+    except TypeError:
+        return None
+
+
+def bytes_of(obj):
+    """
+    Memory size of a DataFrame or numpy array in bytes, None for other objects.
+    """
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=False, deep=False).sum())
+    return getattr(obj, 'nbytes', None)
+
+
+def file_bytes(path):
+    """
+    Size of a file in bytes, for a shapefile the .dbf/.shx/.prj/.cpg side files are included.
+    """
+    if not os.path.exists(path):
+        return None
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)
+                   if os.path.isfile(os.path.join(path, name)))
+    size = os.path.getsize(path)
+    base, ext = os.path.splitext(path)
+    if ext.lower() == '.shp':
+        size += sum(os.path.getsize(base + side) for side in ('.dbf', '.shx', '.prj', '.cpg')
+                    if os.path.exists(base + side))
+    return size
+
+
+class Stage:
+    """
+    Running stage, returned by stage(). Set rows_out and bytes_fetched while the stage runs (or with set()), the
+    other values are filled in when it ends.
+    """
+
+    def __init__(self, name, rows_in=None, **extra):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.bytes_fetched = None
+        self.extra = extra
+        self.peak_mb = None
+        self.traced_peak_mb = None
+        self.profiler = None
+        self.record = None
+
+    def set(self, rows_out=None, bytes_fetched=None, **extra):
+        if rows_out is not None:
+            self.rows_out = rows_out
+        if bytes_fetched is not None:
+            self.bytes_fetched = bytes_fetched
+        self.extra.update(extra)
+        return self
+
+
+def _write_record(record):
+    with _lock:
+        trace_records.append(record)
+        trace_path = os.environ.get(trace_env_vars['trace'])
+        if trace_path:
+            with open(trace_path, 'a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+    if os.environ.get(trace_env_vars['quiet'], '0') in ('0', ''):
+        rows = '' if record['rows_out'] is None else f", rows {record['rows_in']} -> {record['rows_out']}"
+        peak = '' if record['peak_rss_mb'] is None else f", peak {record['peak_rss_mb']:.0f} MB"
+        print(f"[{record['stage']}] {record['wall_seconds']:.3f} s{rows}{peak}")
+
+
+@contextmanager
+def stage(name, rows_in=None, profile=None, trace_memory=None, **extra):
+    """
+    Measure one processing step.
+
+    Parameters:
+    - name (str): Stage name, nested stages are recorded with their parent.
+    - rows_in (int): Number of input rows.
+    - profile (bool): Write a cProfile dump, by default when GEOWAT_PROFILE_DIR is set.
+    - trace_memory (bool): Record the tracemalloc peak, by default when GEOWAT_TRACEMALLOC is 1.
+    - extra: Other values stored in the record (for example the input path).
+
+    Yields:
+    - Stage: Set rows_out and bytes_fetched on it.
+    """
+    profile_dir = os.environ.get(trace_env_vars['profile_dir'])
+    profile = bool(profile_dir) if profile is None else profile
+    trace_memory = os.environ.get(trace_env_vars['tracemalloc']) == '1' if trace_memory is None else trace_memory
+
+    current = Stage(name, rows_in=rows_in, **extra)
+    with _lock:
+        #   the peak counter is shared by the process, hand the peak so far to the running stages before resetting it
+        hwm = _read_hwm_mb()
+        for running in _active:
+            running.peak_mb = _max_peak(running.peak_mb, hwm)
+        parent = _active[-1].name if _active else None
+        #   only one profiler can run at a time, a nested stage is part of the profile of the outer one
+        if profile and not any(running.profiler is not None for running in _active):
+            current.profiler = cProfile.Profile()
+        if tracemalloc.is_tracing():
+            traced = tracemalloc.get_traced_memory()[1] / 1024. ** 2
+            for running in _active:
+                if running.traced_peak_mb is not None:
+                    running.traced_peak_mb = max(running.traced_peak_mb, traced)
+        _active.append(current)
+        _reset_hwm()
+        current.peak_mb = _read_hwm_mb()
+
+    started_tracemalloc = trace_memory and not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start()
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+        current.traced_peak_mb = 0. if trace_memory else None
+    profiler = current.profiler
+    if profiler is not None:
+        profiler.enable()
+
+    start_time = time.time()
+    start = time.perf_counter()
+    start_cpu = time.process_time()
+    status, error = 'ok', None
+    try:
+        yield current
+    except BaseException as e:
+        status, error = 'error', f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        wall = time.perf_counter() - start
+        cpu = time.process_time() - start_cpu
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(profile_dir or '.', exist_ok=True)
+            profiler.dump_stats(os.path.join(profile_dir or '.', f'{name}_{os.getpid()}_{next(_counter)}.prof'))
+        with _lock:
+            current.peak_mb = _max_peak(current.peak_mb, _read_hwm_mb())
+            if current.traced_peak_mb is not None:
+                current.traced_peak_mb = max(current.traced_peak_mb,
+                                             tracemalloc.get_traced_memory()[1] / 1024. ** 2)
+            _active.remove(current)
+            for running in _active:
+                running.peak_mb = _max_peak(running.peak_mb, current.peak_mb)
+                if running.traced_peak_mb is not None and current.traced_peak_mb is not None:
+                    running.traced_peak_mb = max(running.traced_peak_mb, current.traced_peak_mb)
+        traced_peak = current.traced_peak_mb
+        if started_tracemalloc:
+            tracemalloc.stop()
+
+        record = {'stage': name, 'parent': parent, 'status': status, 'error': error,
+                  'start': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(start_time)),
+                  'wall_seconds': round(wall, 6), 'cpu_seconds': round(cpu, 6), 'rows_in': current.rows_in,
+                  'rows_out': current.rows_out, 'bytes_fetched': current.bytes_fetched,
+                  'peak_rss_mb': None if current.peak_mb is None else round(current.peak_mb, 1),
+                  'tracemalloc_peak_mb': None if traced_peak is None else round(traced_peak, 1),
+                  'host': socket.gethostname(), 'pid': os.getpid(), 'job_id': os.environ.get('SLURM_JOB_ID'),
+                  **current.extra}
+        current.record = record
+        _write_record(record)
+
+
+def instrumented(name=None):
+    """
+    Decorator that runs the function inside stage(). rows_in is the length of the first argument and rows_out the
+    length of the result, when they have one.
+
+    Parameters:
+    - name (str): Stage name, the function name when None.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name or func.__name__, rows_in=rows_of(args[0]) if args else None) as current:
+                result = func(*args, **kwargs)
+                current.set(rows_out=rows_of(result))
+                return result
+        return wrapper
+    return decorator
+
+
+def load_trace(paths):
+    """
+    Read one or more JSON lines trace files into a DataFrame.
+    """
+    paths = [paths] if isinstance(paths, str) else paths
+    records = []
+    for path in paths:
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return pd.DataFrame(records)
+
+
+def summarize_trace(trace):
+    """
+    Totals per stage of a trace DataFrame: number of runs, total/mean/max wall time, total rows out, bytes and the
+    highest peak memory, sorted by total wall time.
+    """
+    summary = trace.groupby('stage').agg(runs=('wall_seconds', 'size'), wall_total=('wall_seconds', 'sum'),
+                                         wall_mean=('wall_seconds', 'mean'), wall_max=('wall_seconds', 'max'),
+                                         rows_out=('rows_out', 'sum'), bytes_fetched=('bytes_fetched', 'sum'),
+                                         peak_rss_mb=('peak_rss_mb', 'max'))
+    return summary.sort_values('wall_total', ascending=False)
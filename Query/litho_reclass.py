@@ -0,0 +1,107 @@
+"""
+    Reclassification of GLiM lithology codes. All schemes are defined once, on top of the litho_class_styles
+    dictionary, and compiled into a dense lookup array indexed by GLiM code, so reclassifying a column is a single
+    vectorized array index instead of chained isin/between passes or a python lambda per row.
+"""
+
+import numpy as np
+
+from raster_sampling import apply_lookup_table
+
+#   The reclassification key is in the dictionary below.. nevermind the color and hatch that is for plotting (for other scripts)
+litho_class_styles = {'su': {'lith' : 'su', 'lith_full' : 'unconsolidated sediments', 'lith_num' : 100, 'hatch': '', 'color': 'gold'},
+                      'su_ad': {'lith' : 'su_ad', 'lith_full' : 'alluvial deposits', 'lith_num' : 101, 'hatch': '-.', 'color': '#ffd757'},
+                      'su_ds': {'lith' : 'su_ds', 'lith_full' : 'dune sands', 'lith_num' : 102, 'hatch': '-.', 'color': '#fcc100'},
+                      'su_lo': {'lith' : 'su_lo', 'lith_full' : 'loess', 'lith_num' : 103, 'hatch': '-.', 'color': '#8a6a00'},
+                      'su_mx': {'lith' : 'su_mx', 'lith_full' : 'sand - mixed grain size', 'lith_num' : 104, 'hatch': 'O', 'color': '#ffd95f'},
+                      'su_ss': {'lith' : 'su_ss', 'lith_full' : 'sand - coarse grained', 'lith_num' : 105, 'hatch': 'o', 'color': '#ffd95f'},
+                      'su_sh': {'lith' : 'su_sh', 'lith_full' : 'sand - fine grained', 'lith_num' : 106, 'hatch': '.', 'color': '#ffd95f'},
+                      'su_cl': {'lith' : 'su_cl', 'lith_full' : 'clay', 'lith_num' : 107, 'hatch': '.', 'color': 'grey'},
+                      'su_gr': {'lith' : 'su_gr', 'lith_full' : 'gravel', 'lith_num' : 108, 'hatch': 'o', 'color': 'olivedrab'},
+                      'su_sl': {'lith' : 'su_sl', 'lith_full' : 'silt', 'lith_num' : 109, 'hatch': '..', 'color': 'lawngreen'},
+                      'ss': {'lith' : 'ss', 'lith_full' : 'siliclastic sedimentary rocks', 'lith_num' : 200, 'hatch': 'o-', 'color': 'forestgreen'},
+                      'sm': {'lith' : 'sm', 'lith_full' : 'mixed sedimentary rocks', 'lith_num' : 210, 'hatch': 'o-', 'color': 'turquoise'},
+                      'sc': {'lith' : 'sc', 'lith_full' : 'carbonate sedimentary rocks', 'lith_num' : 220, 'hatch': 'o-', 'color': 'aqua'},
+                      'vb': {'lith' : 'vb', 'lith_full' : 'basic volcanic rocks', 'lith_num' : 300, 'hatch': 'o', 'color': 'darkorange'},
+                      'vi': {'lith' : 'vi', 'lith_full' : 'intermediate volcanic rocks', 'lith_num' : 310, 'hatch': 'O', 'color': 'darkorange'},
+                      'va': {'lith' : 'va', 'lith_full' : 'acid volcanic rocks', 'lith_num' : 320, 'hatch': 'oo', 'color': 'darkorange'},
+                      'pb': {'lith' : 'pb', 'lith_full' : 'basic plutonic rocks', 'lith_num' : 400, 'hatch': 'o', 'color': 'fuchsia'},
+                      'pi': {'lith' : 'pi', 'lith_full' : 'intermediate plutonic rocks', 'lith_num' : 410, 'hatch': 'O', 'color': 'fuchsia'},
+                      'pa': {'lith' : 'pa', 'lith_full' : 'acid plutonic rocks', 'lith_num' : 420, 'hatch': 'oo', 'color': 'fuchsia'},
+                      'mt': {'lith' : 'mt', 'lith_full' : 'metamorphic rocks', 'lith_num' : 500, 'hatch': '-|', 'color': 'plum'},
+                      'py': {'lith' : 'py', 'lith_full' : 'pyroclastics', 'lith_num' : 600, 'hatch': 'x', 'color': 'crimson'},
+                      'ev': {'lith' : 'ev', 'lith_full' : 'evaporites', 'lith_num' : 700, 'hatch': 'o', 'color': 'darkorchid'},
+                      'rock': {'lith' : 'rock', 'lith_full' : 'rocks', 'lith_num' : 800, 'hatch': '++', 'color': 'dimgrey'},
+                      'soil': {'lith' : 'soil', 'lith_full' : 'soil', 'lith_num' : 900, 'hatch': 'o', 'color': 'tan'},
+                      'coal': {'lith' : 'coal', 'lith_full' : 'coal', 'lith_num' : 1000, 'hatch': '-|', 'color': 'black'},
+                      'nd': {'lith' : 'nd', 'lith_full' : 'not defined', 'lith_num' : 0, 'hatch': 'x', 'color': 'snow'}}
+
+#   Classes used for the well database (SQL_geowat.py): unconsolidated sediments fine (1) and coarse (2), sedimentary
+#   rocks (3) and rocks (4). Everything else (not defined, coal, no data) becomes -1. The classes are given by the keys
+#   of litho_class_styles, so there are no overlapping code ranges.
+litho_4class_scheme = {1: ['su', 'su_ad', 'su_ds', 'su_mx', 'su_gr', 'soil'],
+                       2: ['su_lo', 'su_ss', 'su_sh', 'su_cl', 'su_sl'],
+                       3: ['ss', 'sm', 'sc'],
+                       4: ['vb', 'vi', 'va', 'pb', 'pi', 'pa', 'mt', 'py', 'ev', 'rock']}
+
+#   Classes used in gridded.py: unconsolidated sediments (1), any other value (2) and no data (-1)
+glim_su_scheme = {1: ['su']}
+
+
+def compile_lut(scheme, styles=litho_class_styles, unmapped=-1, dtype='int64'):
+    """
+    Compile a reclassification scheme into a lookup array indexed by GLiM code.
+
+    Parameters:
+    - scheme (dict): New class to a list of keys of styles.
+    - styles (dict): Lithology definitions with a 'lith_num' code per key.
+    - unmapped: Class for codes that are not in the scheme.
+    - dtype (str): Data type of the lookup array.
+
+    Returns:
+    - numpy array: lut[code] = class.
+    """
+    codes = {}
+    for new_class, liths in scheme.items():
+        for lith in liths:
+            if lith not in styles:
+                raise ValueError(f"Unknown lithology '{lith}' in reclassification scheme")
+            if lith in codes:
+                raise ValueError(f"Lithology '{lith}' is in more than one class")
+            codes[lith] = new_class
+    lut = np.full(max(style['lith_num'] for style in styles.values()) + 1, unmapped, dtype=dtype)
+    for lith, new_class in codes.items():
+        lut[styles[lith]['lith_num']] = new_class
+    return lut
+
+
+class LithoReclassifier:
+    """
+    Compiled reclassification scheme, call it with an array of GLiM codes to get the new classes.
+
+    Parameters:
+    - scheme (dict): New class to a list of keys of styles.
+    - styles (dict): Lithology definitions with a 'lith_num' code per key.
+    - unmapped: Class for codes that are not in the scheme, including codes that are not in styles at all.
+    - nodata_class: Class for missing values (NaN) and for nodata_value.
+    - nodata_value: Raster nodata value, None when the raster has none.
+    """
+
+    def __init__(self, scheme, styles=litho_class_styles, unmapped=-1, nodata_class=-1, nodata_value=None):
+        self.lut = compile_lut(scheme, styles=styles, unmapped=unmapped)
+        self.unmapped = unmapped
+        self.nodata_class = nodata_class
+        self.nodata_value = nodata_value
+
+    def __call__(self, values):
+        values = np.asarray(values)
+        out = apply_lookup_table(values, self.lut, fill_value=self.unmapped)
+        missing = np.isnan(values) if values.dtype.kind == 'f' else np.zeros(values.shape, dtype=bool)
+        if self.nodata_value is not None:
+            missing |= values == self.nodata_value
+        out[missing] = self.nodata_class
+        return out
+
+
+litho_4class = LithoReclassifier(litho_4class_scheme)
+glim_su_class = LithoReclassifier(glim_su_scheme, unmapped=2)
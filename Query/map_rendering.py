@@ -0,0 +1,176 @@
+"""
+    Fast rendering of continental/global well maps. Every layer is drawn with a single matplotlib call: the country
+    boundaries as one LineCollection (simplified and cached on disk the first time), the wells as one scatter, or for
+    very dense point sets as one image of the per-pixel mean value or majority class.
+"""
+
+import hashlib
+import os
+import tempfile
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from matplotlib.collections import LineCollection
+from matplotlib.colors import ListedColormap, to_rgba
+from matplotlib.lines import Line2D
+
+from grid_aggregation import aggregate_to_grid, grid_cell_index, grid_shape
+
+#   above this number of points the wells are drawn as an image instead of a scatter
+density_threshold = 200000
+
+#   width of the density image in pixels
+density_pixels = 2000
+
+#   default folder for the simplified boundaries, the boundary shapefiles often sit in a read-only shared folder
+boundary_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'geowat')
+
+
+def _save_lines(cache_path, coords, index):
+    #   write to a temporary file first and move it in place, so a crashed or parallel job never leaves half a file
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(cache_path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, coords=coords, index=index)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_boundary_lines(boundary_path, cache_dir=None, tolerance=0.02, crs='EPSG:4326'):
+    """
+    Country boundaries as a list of line coordinate arrays, simplified and projected once and cached as .npz.
+
+    Parameters:
+    - boundary_path (str): Boundary shapefile (polygons).
+    - cache_dir (str): Folder for the cache, boundary_cache_dir (~/.cache/geowat) when None. When the folder is not
+      writable the temporary folder is used, and when that fails too the lines are not cached.
+    - tolerance (float): Simplification tolerance in degrees, 0.02 is invisible on a global or continental map.
+    - crs (str): CRS of the map, the boundaries are projected to it before simplifying.
+
+    Returns:
+    - list of numpy arrays: One (n, 2) array per boundary line.
+    """
+    stat = os.stat(boundary_path)
+    key = hashlib.sha256(repr((os.path.abspath(boundary_path), stat.st_mtime, stat.st_size, tolerance,
+                               crs)).encode('utf-8')).hexdigest()[:16]
+    file_name = f'{os.path.splitext(os.path.basename(boundary_path))[0]}_lines_{key}.npz'
+    cache_paths = [os.path.join(folder, file_name)
+                   for folder in (cache_dir or boundary_cache_dir, tempfile.gettempdir())]
+
+    cache_path = next((path for path in cache_paths if os.path.exists(path)), None)
+    if cache_path is not None:
+        cached = np.load(cache_path)
+        coords, index = cached['coords'], cached['index']
+    else:
+        boundary_gdf = gpd.read_file(boundary_path).to_crs(crs)
+        lines = shapely.get_parts(boundary_gdf.geometry.simplify(tolerance).boundary.values)
+        coords, index = shapely.get_coordinates(lines, return_index=True)
+        for path in cache_paths:
+            try:
+                _save_lines(path, coords, index)
+                break
+            except OSError as e:
+                print(f"Could not cache the boundary lines in {os.path.dirname(path)}: {e}")
+    return np.split(coords, np.flatnonzero(np.diff(index)) + 1) if len(coords) else []
+
+
+def draw_boundary(ax, lines, edgecolor='black', linewidth=1):
+    """
+    Draw boundary lines from load_boundary_lines as one LineCollection.
+    """
+    ax.add_collection(LineCollection(lines, colors=edgecolor, linewidths=linewidth))
+    ax.autoscale_view()
+
+
+def _density_grid(x, y, resolution_deg=None):
+    #   grid covering the points with density_pixels columns
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    extent = (np.nanmin(x), np.nanmin(y), np.nanmax(x), np.nanmax(y))
+    if resolution_deg is None:
+        resolution_deg = max(extent[2] - extent[0], extent[3] - extent[1], 1e-6) / density_pixels
+    n_rows = max(int(np.ceil((extent[3] - extent[1]) / resolution_deg)), 1)
+    n_cols = max(int(np.ceil((extent[2] - extent[0]) / resolution_deg)), 1)
+    return (extent[0], extent[3] - n_rows * resolution_deg, extent[0] + n_cols * resolution_deg, extent[3]), \
+        resolution_deg
+
+
+def plot_values(ax, x, y, values, cmap='viridis', vmin=None, vmax=None, s=20, alpha=0.7, dense=None):
+    """
+    Draw wells colored by a continuous value in one call.
+
+    Parameters:
+    - ax: Matplotlib axes.
+    - x, y (array): Well coordinates.
+    - values (array): Value per well.
+    - cmap, vmin, vmax, s, alpha: As in plt.scatter.
+    - dense (bool): Draw an image of the per-pixel mean value instead of a scatter, by default when there are more
+      than density_threshold wells.
+
+    Returns:
+    - The scatter or image, for plt.colorbar.
+    """
+    if dense is None:
+        dense = len(x) > density_threshold
+    if not dense:
+        return ax.scatter(x, y, c=values, cmap=cmap, vmin=vmin, vmax=vmax, s=s, alpha=alpha, rasterized=True)
+
+    extent, resolution_deg = _density_grid(x, y)
+    layers, _ = aggregate_to_grid(x, y, {'value': values}, resolution_deg=resolution_deg, extent=extent)
+    return ax.imshow(layers['value_mean'], cmap=cmap, vmin=vmin, vmax=vmax, interpolation='nearest',
+                     extent=(extent[0], extent[2], extent[1], extent[3]), origin='upper')
+
+
+def plot_categories(ax, x, y, categories, colors, labels=None, s=20, alpha=0.7, dense=None):
+    """
+    Draw wells colored by class in one call, with a legend entry per class.
+
+    Parameters:
+    - ax: Matplotlib axes.
+    - x, y (array): Well coordinates.
+    - categories (array): Class per well.
+    - colors (dict): Class to color, wells of other classes are not drawn.
+    - labels (dict): Class to legend label, the class itself when None.
+    - s, alpha: As in plt.scatter.
+    - dense (bool): Draw an image of the majority class per pixel instead of a scatter, by default when there are
+      more than density_threshold wells.
+
+    Returns:
+    - list: Legend handles.
+    """
+    labels = labels or {cat: str(cat) for cat in colors}
+    classes = list(colors)
+    categories = np.asarray(categories)
+    codes = np.full(len(categories), -1, dtype='int64')
+    for code, cat in enumerate(classes):
+        codes[categories == cat] = code
+    keep = codes >= 0
+    x = np.asarray(x)[keep]
+    y = np.asarray(y)[keep]
+    codes = codes[keep]
+    if dense is None:
+        dense = len(x) > density_threshold
+
+    if not dense:
+        rgba = np.array([to_rgba(colors[cat]) for cat in classes])
+        ax.scatter(x, y, c=rgba[codes], s=s, alpha=alpha, rasterized=True)
+    elif len(x):
+        #   majority class per pixel: count wells per (pixel, class) and take the class with the highest count
+        extent, resolution_deg = _density_grid(x, y)
+        shape = grid_shape(resolution_deg, extent)
+        cells = grid_cell_index(x, y, resolution_deg, extent)
+        inside = cells >= 0
+        counts = np.bincount(cells[inside] * len(classes) + codes[inside], minlength=shape[0] * shape[1] * len(classes))
+        counts = counts.reshape(-1, len(classes))
+        image = np.where(counts.sum(axis=1) > 0, counts.argmax(axis=1), np.nan).reshape(shape)
+        ax.imshow(image, cmap=ListedColormap([colors[cat] for cat in classes]), vmin=-0.5,
+                  vmax=len(classes) - 0.5, interpolation='nearest', alpha=alpha,
+                  extent=(extent[0], extent[2], extent[1], extent[3]), origin='upper')
+
+    return [Line2D([], [], marker='o', linestyle='none', color=colors[cat], label=labels[cat]) for cat in classes]
+
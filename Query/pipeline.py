@@ -0,0 +1,439 @@
+"""
+    End-to-end pipeline that replaces the chain of scripts (SQL_geowat.py -> well_weighting.py -> plotting.py /
+    gridded.py) and the shapefiles between them. The stages form a small DAG:
+
+        extract -> lithology -> weighting -> bias
+                                          -> grid
+                                          -> plots
+                                          -> export
+
+    Within a run the well table is passed from stage to stage in memory, every table output is also stored as a
+    Feather file in the work folder. Each output is cached under a key that hashes the stage parameters, the source
+    files of the stage code, the input files (size and modification time), the database state and the content of the
+    upstream outputs. Changing for example only the weighting scheme therefore reruns weighting and the stages below
+    it, while extract and lithology come from the cache. A stage whose output is cached is not loaded at all unless a
+    stage that has to run needs it.
+
+    Usage:
+        python pipeline.py config.json                              (run everything that is not cached)
+        python pipeline.py config.json --targets plots              (only plots and what it needs)
+        python pipeline.py config.json --set weighting.scheme=cell  (override a parameter)
+        python pipeline.py config.json --dry-run                    (show which stages would run)
+        python pipeline.py --write-config config.json               (write the default configuration)
+"""
+
+import argparse
+import copy
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+
+from geowat_cache import tables_in_sql
+from geowat_db import build_mean_gwh_query, extract_mean_gwh
+from instrumentation import stage
+
+#   default configuration, one section per stage plus the folders. Paths left at None switch the step off
+default_config = {
+    'work_dir': 'pipeline_work',
+    'output_dir': 'pipeline_output',
+    'extract': {'table': '_gwh_yearly_tb', 'value_col': 'gw_head_m', 'country': None, 'bbox': None,
+                'year_range': None, 'min_years': None, 'snapshot': None},
+    'lithology': {'glim_path': None, 'scheme': 'litho_4class', 'max_workers': 4},
+    'weighting': {'scheme': 'nearest_neighbour', 'options': {}},
+    'bias': {'observed': 'mean_gwh_m', 'simulated': 'sim_gw_mea', 'simulation_raster': None, 'band': 1},
+    'grid': {'resolution_deg': 0.5, 'attributes': ['mean_gwh_m']},
+    'plots': {'boundary_path': None, 'dense': None},
+    'export': {'shapefile': False},
+}
+
+#   func(inputs, params, out_dir) returns a DataFrame, deps are the upstream stages, modules the source files whose
+#   content is part of the cache key and artifacts tells whether the stage writes files into out_dir
+StageSpec = namedtuple('StageSpec', ['func', 'deps', 'modules', 'artifacts'])
+
+#   config keys that are paths of input files, their size and modification time go into the cache key
+path_params = ('snapshot', 'glim_path', 'simulation_raster', 'boundary_path')
+
+
+def _extract(inputs, params, out_dir):
+    from snapshot import connect_backend
+    connection, cursor = connect_backend(params.get('snapshot'))
+    try:
+        wells = extract_mean_gwh(cursor, table=params['table'], value_col=params['value_col'],
+                                 country=params['country'], bbox=params['bbox'], year_range=params['year_range'],
+                                 min_years=params['min_years'])
+    finally:
+        connection.close()
+    #   the later scripts know the mean as mean_gwh_m (the shapefile name of mean_gwh_mbsl)
+    return wells.rename(columns={'mean_gwh_mbsl': 'mean_gwh_m'})
+
+
+def _lithology(inputs, params, out_dir):
+    from litho_reclass import glim_su_class, litho_4class
+    from raster_sampling import sample_raster
+    wells = inputs['extract'].copy()
+    if params['glim_path'] is None:
+        wells['glim_raw'] = -1
+    else:
+        wells['glim_raw'] = sample_raster(params['glim_path'], wells['x_wgs84'].values, wells['y_wgs84'].values,
+                                          max_workers=params['max_workers']).astype('int64')
+    classifiers = {'litho_4class': litho_4class, 'glim_su': glim_su_class}
+    wells['litho_class'] = classifiers[params['scheme']](wells['glim_raw'].values)
+    return wells
+
+
+def _weighting(inputs, params, out_dir):
+    from declustering import compute_weights
+    return compute_weights(inputs['lithology'].copy(), scheme=params['scheme'], **params['options'])
+
+
+def _bias(inputs, params, out_dir):
+    import matplotlib
+    matplotlib.use('Agg')
+    from bias_evaluation import evaluate_pairs
+    from gridded import plot_bias_cdf
+    from raster_sampling import sample_raster
+    wells = inputs['weighting']
+    if params['simulation_raster'] is not None:
+        wells = wells.copy()
+        wells[params['simulated']] = sample_raster(params['simulation_raster'], wells['x_wgs84'].values,
+                                                   wells['y_wgs84'].values, band=params['band'],
+                                                   fill_value=np.nan)
+    if params['simulated'] not in wells.columns:
+        raise ValueError(f"No '{params['simulated']}' column, set bias.simulation_raster in the configuration")
+    bias = wells[params['observed']] - wells[params['simulated']]
+    plot_bias_cdf(bias.values, os.path.join(out_dir, 'bias_cdf.png'), label=f"{params['observed']} - "
+                                                                          f"{params['simulated']}")
+    metrics = evaluate_pairs(wells, [(params['observed'], params['simulated'])])
+    metrics.to_csv(os.path.join(out_dir, 'bias_metrics.csv'), index=False)
+    return metrics
+
+
+def _grid(inputs, params, out_dir):
+    from grid_aggregation import write_grid_geotiff
+    from gridded import grid_well_statistics
+    layers, transform = grid_well_statistics(inputs['weighting'], params['attributes'],
+                                             resolution_deg=params['resolution_deg'])
+    write_grid_geotiff(layers, transform, os.path.join(out_dir, 'wells_grid.tif'))
+    return _file_table(out_dir)
+
+
+def _plots(inputs, params, out_dir):
+    import matplotlib
+    matplotlib.use('Agg')
+    from plotting import plot_litho_class, plot_mean_gwh, plot_n_years, plot_well_weight
+    from map_rendering import load_boundary_lines
+    wells = inputs['weighting']
+    boundary_lines = [] if params['boundary_path'] is None else load_boundary_lines(params['boundary_path'])
+    for plot in (plot_n_years, plot_well_weight, plot_mean_gwh, plot_litho_class):
+        plot(wells, boundary_lines, out_dir, dense=params['dense'])
+    return _file_table(out_dir)
+
+
+def _export(inputs, params, out_dir):
+    import geopandas as gpd
+    from geowat_export import write_geoparquet
+    wells = inputs['weighting']
+    write_geoparquet(wells, os.path.join(out_dir, 'wells.parquet'))
+    if params['shapefile']:
+        gpd.GeoDataFrame(wells, geometry=gpd.points_from_xy(wells['x_wgs84'], wells['y_wgs84']),
+                         crs='EPSG:4326').to_file(os.path.join(out_dir, 'wells.shp'))
+    return _file_table(out_dir)
+
+
+pipeline_stages = {
+    'extract': StageSpec(_extract, (), ('geowat_db.py', 'snapshot.py'), False),
+    'lithology': StageSpec(_lithology, ('extract',), ('raster_sampling.py', 'litho_reclass.py'), False),
+    'weighting': StageSpec(_weighting, ('lithology',), ('declustering.py', 'grid_aggregation.py'), False),
+    'bias': StageSpec(_bias, ('weighting',), ('bias_evaluation.py', 'ecdf.py', 'gridded.py', 'raster_sampling.py'),
+                      True),
+    'grid': StageSpec(_grid, ('weighting',), ('grid_aggregation.py', 'gridded.py'), True),
+    'plots': StageSpec(_plots, ('weighting',), ('plotting.py', 'map_rendering.py', 'grid_aggregation.py'), True),
+    'export': StageSpec(_export, ('weighting',), ('geowat_export.py',), True),
+}
+
+
+def _file_table(out_dir):
+    #   output of the stages that write files: name and size of every file
+    names = sorted(os.listdir(out_dir))
+    return pd.DataFrame({'file': names, 'bytes': [os.path.getsize(os.path.join(out_dir, name)) for name in names]})
+
+
+def _hash(obj):
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def content_hash(df):
+    """
+    Hash of the content of a DataFrame (column names, dtypes and values), independent of where it is stored.
+    """
+    h = hashlib.sha256(json.dumps([[str(col), str(dtype)] for col, dtype in df.dtypes.items()]).encode('utf-8'))
+    h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return h.hexdigest()
+
+
+def _file_fingerprint(path):
+    if path is None or not os.path.exists(path):
+        return path
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime]
+
+
+def _code_fingerprint(spec):
+    #   source of the stage function, its place in the DAG and the modules it uses, but not the rest of pipeline.py,
+    #   so editing one stage (or the runner) does not invalidate the other stages
+    here = os.path.dirname(os.path.abspath(__file__))
+    h = hashlib.sha256(inspect.getsource(spec.func).encode('utf-8'))
+    h.update(repr((spec.deps, spec.modules, spec.artifacts)).encode('utf-8'))
+    for module in spec.modules:
+        with open(os.path.join(here, module), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def _database_fingerprint(params):
+    #   state of the database tables used by the extraction: the snapshot file, or the pg_stat counters of the server.
+    #   When the counters can not be read the extraction is cached for one day
+    from snapshot import _server_token, connect_backend, snapshot_env_var
+    snapshot_path = params.get('snapshot') or os.environ.get(snapshot_env_var)
+    if snapshot_path:
+        return _file_fingerprint(snapshot_path)
+    sql_cmd, _ = build_mean_gwh_query(table=params['table'], value_col=params['value_col'])
+    connection, cursor = connect_backend()
+    try:
+        token = {table: _server_token(cursor, table) for table in tables_in_sql(sql_cmd)}
+    finally:
+        connection.close()
+    if any(value is None for value in token.values()):
+        return time.strftime('%Y-%m-%d')
+    return token
+
+
+class Pipeline:
+    """
+    Runs the pipeline stages with caching, see the module docstring.
+
+    Parameters:
+    - config (dict): Configuration like default_config, missing values are taken from default_config.
+    """
+
+    def __init__(self, config=None):
+        self.config = copy.deepcopy(default_config)
+        for key, value in (config or {}).items():
+            if isinstance(value, dict) and isinstance(self.config.get(key), dict):
+                self.config[key].update(value)
+            else:
+                self.config[key] = value
+        self.work_dir = self.config['work_dir']
+        self._outputs = {}
+        self._manifests = {}
+        self._keys = {}
+
+    def _stage_dir(self, name):
+        return os.path.join(self.work_dir, name)
+
+    def _manifest_path(self, name, key):
+        return os.path.join(self._stage_dir(name), f'{key}.json')
+
+    def _load_manifest(self, name, key):
+        path = self._manifest_path(name, key)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def key(self, name):
+        """
+        Cache key of a stage, which needs the content hashes of the upstream outputs (so upstream stages that are
+        not cached are run first).
+        """
+        if name in self._keys:
+            return self._keys[name]
+        spec = pipeline_stages[name]
+        params = self.config[name]
+        key_parts = {'stage': name, 'params': params, 'code': _code_fingerprint(spec),
+                     'files': {param: _file_fingerprint(params[param]) for param in path_params if param in params},
+                     'upstream': {dep: self.manifest(dep)['content_hash'] for dep in spec.deps}}
+        if name == 'extract':
+            key_parts['database'] = _database_fingerprint(params)
+        self._keys[name] = _hash(key_parts)[:24]
+        return self._keys[name]
+
+    def manifest(self, name):
+        """
+        Manifest (content hash, rows, run time) of a stage output, the stage is run when it is not cached.
+        """
+        if name not in self._manifests:
+            key = self.key(name)
+            manifest = self._load_manifest(name, key)
+            if manifest is None:
+                self.output(name)
+                manifest = self._load_manifest(name, key)
+            self._manifests[name] = manifest
+        return self._manifests[name]
+
+    def output(self, name):
+        """
+        Output DataFrame of a stage, from memory, from the cache or by running the stage.
+        """
+        if name in self._outputs:
+            return self._outputs[name]
+        spec = pipeline_stages[name]
+        key = self.key(name)
+        table_path = os.path.join(self._stage_dir(name), f'{key}.feather')
+        if self._load_manifest(name, key) is not None and os.path.exists(table_path):
+            self._outputs[name] = feather.read_table(table_path).to_pandas()
+            return self._outputs[name]
+
+        inputs = {dep: self.output(dep) for dep in spec.deps}
+        out_dir = os.path.join(self._stage_dir(name), key)
+        if spec.artifacts:
+            #   start from an empty folder, so the file table only lists the files of this run
+            shutil.rmtree(out_dir, ignore_errors=True)
+            os.makedirs(out_dir)
+        os.makedirs(self._stage_dir(name), exist_ok=True)
+        print(f"Running stage {name} ({key})")
+        with stage(f'pipeline.{name}', rows_in=max([len(df) for df in inputs.values()], default=None)) as st:
+            start = time.perf_counter()
+            result = spec.func(inputs, self.config[name], out_dir).reset_index(drop=True)
+            st.set(rows_out=len(result))
+        feather.write_feather(result, table_path)
+        manifest = {'stage': name, 'key': key, 'content_hash': content_hash(result), 'rows': len(result),
+                    'seconds': round(time.perf_counter() - start, 3),
+                    'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'upstream': {dep: self.key(dep)
+                                                                                 for dep in spec.deps}}
+        with open(self._manifest_path(name, key), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        self._outputs[name] = result
+        return result
+
+    def _ordered(self, targets):
+        #   targets and everything they depend on, upstream first
+        order = []
+
+        def visit(name):
+            for dep in pipeline_stages[name].deps:
+                visit(dep)
+            if name not in order:
+                order.append(name)
+        for target in targets:
+            visit(target)
+        return order
+
+    def status(self, targets=None):
+        """
+        Which stages are cached, without running anything. The default targets are the same as for run(). A stage
+        below one that is not cached is reported as 'pending' because its key is only known once the upstream output
+        exists.
+
+        Returns:
+        - DataFrame: stage, status ('cached', 'run' or 'pending') and key.
+        """
+        rows = []
+        unknown = set()
+        for name in self._ordered(targets or self._default_targets()):
+            if any(dep in unknown for dep in pipeline_stages[name].deps):
+                unknown.add(name)
+                rows.append({'stage': name, 'status': 'pending', 'key': None})
+                continue
+            key = self.key(name)
+            cached = self._load_manifest(name, key) is not None
+            if not cached:
+                unknown.add(name)
+            rows.append({'stage': name, 'status': 'cached' if cached else 'run', 'key': key})
+        return pd.DataFrame(rows)
+
+    def run(self, targets=None, force=()):
+        """
+        Bring the target stages up to date.
+
+        Parameters:
+        - targets (list of str): Stages to produce, when None all stages except bias without a simulation_raster.
+          Stages they depend on run only when their output is needed and not cached.
+        - force (list of str): Stages to rerun even when cached (their downstream stages rerun if the output
+          changes).
+
+        Returns:
+        - DataFrame: Manifest of every target stage.
+        """
+        targets = targets or self._default_targets()
+        for name in force:
+            key = self.key(name)
+            if os.path.exists(self._manifest_path(name, key)):
+                os.remove(self._manifest_path(name, key))
+            self._manifests.pop(name, None)
+            self._outputs.pop(name, None)
+        manifests = []
+        for name in self._ordered(targets):
+            manifest = self.manifest(name)
+            if pipeline_stages[name].artifacts:
+                self._publish(name, manifest['key'])
+            manifests.append(manifest)
+        return pd.DataFrame(manifests)
+
+    def _default_targets(self):
+        return [name for name in pipeline_stages if self._is_enabled(name)]
+
+    def _is_enabled(self, name):
+        #   stages that can not run without an input file are skipped unless asked for explicitly
+        if name == 'bias':
+            return self.config['bias']['simulation_raster'] is not None
+        return True
+
+    def _publish(self, name, key):
+        #   copy the files of the current run of an artifact stage to the output folder
+        target = os.path.join(self.config['output_dir'], name)
+        shutil.rmtree(target, ignore_errors=True)
+        shutil.copytree(os.path.join(self._stage_dir(name), key), target)
+
+
+def _parse_override(text):
+    #   stage.key=value, the value is read as JSON when possible (numbers, null, lists) and as a string otherwise
+    path, _, value = text.partition('=')
+    try:
+        value = json.loads(value)
+    except json.JSONDecodeError:
+        pass
+    return path.split('.'), value
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the geowat processing stages with cached intermediates.")
+    parser.add_argument('config', nargs='?', help="JSON configuration, see default_config")
+    parser.add_argument('--targets', nargs='+', choices=list(pipeline_stages), help="stages to produce")
+    parser.add_argument('--force', nargs='+', default=[], choices=list(pipeline_stages), help="stages to rerun")
+    parser.add_argument('--set', dest='overrides', action='append', default=[], metavar='STAGE.KEY=VALUE',
+                        help="override a configuration value")
+    parser.add_argument('--dry-run', action='store_true', help="only show which stages would run")
+    parser.add_argument('--write-config', metavar='JSON', help="write the default configuration and stop")
+    args = parser.parse_args()
+
+    if args.write_config:
+        with open(args.write_config, 'w') as f:
+            json.dump(default_config, f, indent=2)
+        raise SystemExit(0)
+
+    config = {}
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+    for override in args.overrides:
+        keys, value = _parse_override(override)
+        section = config
+        for key in keys[:-1]:
+            section = section.setdefault(key, {})
+        section[keys[-1]] = value
+
+    pipeline = Pipeline(config)
+    if args.dry_run:
+        print(pipeline.status(args.targets).to_string(index=False))
+    else:
+        print(pipeline.run(args.targets, force=args.force)[['stage', 'key', 'rows', 'seconds', 'created']]
+              .to_string(index=False))
@@ -2,60 +2,109 @@ import geopandas as gpd
 import matplotlib.pyplot as plt
 import os
 
-# Load the shapefile for wells data
-wells_shapefile_path = '/scratch/depfg/otoo0001/data/Daniel_develop/Hygs/shapefile/output/gwh_data_updated.shp'
-gdf = gpd.read_file(wells_shapefile_path)
-
-# Load the shapefile for boundary 
-boundary_shapefile_path = "/scratch/depfg/otoo0001/data/shapefiles/WB_countries_Admin0_10m/WB_countries_Admin0_10m.shp"  
-boundary_gdf = gpd.read_file(boundary_shapefile_path)
-
-# Create a folder to save plots if it doesn't exist
-save_folder = '/scratch/depfg/otoo0001/data/Daniel_develop/Hygs/shapefile/output/plots/'
-os.makedirs(save_folder, exist_ok=True)
+from instrumentation import file_bytes, instrumented, stage
+from map_rendering import draw_boundary, load_boundary_lines, plot_categories, plot_values
 
 # Function to save and display plots
-def save_and_display_plot(fig, title, filename):
+def save_and_display_plot(fig, title, filename, save_folder):
     plt.axis('off')  # Turn off x and y axes
     plt.tight_layout()
     plt.savefig(os.path.join(save_folder, filename))
     plt.close(fig)
 
 # Plot 1: Scatter plot of n_years vs. x and y coordinates with boundary
-fig1 = plt.figure(figsize=(10, 8))
-plt.scatter(gdf['x_wgs84'], gdf['y_wgs84'], c=gdf['n_years'], cmap='viridis', s=20, alpha=0.7)
-plt.colorbar(label='Number of years', orientation='horizontal', pad=0.1)
-boundary_gdf.plot(ax=plt.gca(), edgecolor='black', linewidth=1, facecolor='none')  # No facecolor for the boundary
-save_and_display_plot(fig1, 'Scatter plot of n_years with Boundary', 'scatter_n_years.png')
-
-# Plot 2: Scatter plot of well_weight vs. x and y coordinates with boundary (using legend)
-fig2 = plt.figure(figsize=(10, 8))
-# Since well_weight ranges from 0 to 1, we use custom markers with labels
-for i, weight in enumerate(gdf['weight'].unique()):
-    subset = gdf[gdf['weight'] == weight]
-    plt.scatter(subset['x_wgs84'], subset['y_wgs84'], label=f'well_weight {weight:.2f}', s=20, alpha=0.7)
-plt.legend(title='Well Weight', loc='best')
-boundary_gdf.plot(ax=plt.gca(), edgecolor='black', linewidth=1, facecolor='none')  # No facecolor for the boundary
-save_and_display_plot(fig2, 'Scatter plot of well_weight with Boundary', 'scatter_well_weight.png')
+@instrumented()
+def plot_n_years(gdf, boundary_lines, save_folder, dense=None):
+    fig1 = plt.figure(figsize=(10, 8))
+    points = plot_values(plt.gca(), gdf['x_wgs84'], gdf['y_wgs84'], gdf['n_years'], cmap='viridis', s=20, alpha=0.7,
+                         dense=dense)
+    plt.colorbar(points, label='Number of years', orientation='horizontal', pad=0.1)
+    draw_boundary(plt.gca(), boundary_lines, edgecolor='black', linewidth=1)
+    save_and_display_plot(fig1, 'Scatter plot of n_years with Boundary', 'scatter_n_years.png', save_folder)
+
+# Plot 2: Scatter plot of well_weight vs. x and y coordinates with boundary
+@instrumented()
+def plot_well_weight(gdf, boundary_lines, save_folder, dense=None):
+    fig2 = plt.figure(figsize=(10, 8))
+    # well_weight is a continuous value, so it gets a colorbar instead of a legend entry per value. The scale runs
+    # from 0 to the largest weight: 1 for the normalized schemes, about 1/n for the 'cell' weights that sum to 1
+    max_weight = gdf['weight'].max()
+    points = plot_values(plt.gca(), gdf['x_wgs84'], gdf['y_wgs84'], gdf['weight'], cmap='viridis', s=20, alpha=0.7,
+                         vmin=0, vmax=max_weight if max_weight > 0 else 1, dense=dense)
+    plt.colorbar(points, label='Well Weight', orientation='horizontal', pad=0.1)
+    draw_boundary(plt.gca(), boundary_lines, edgecolor='black', linewidth=1)
+    save_and_display_plot(fig2, 'Scatter plot of well_weight with Boundary', 'scatter_well_weight.png', save_folder)
 
 # Plot 3: Scatter plot of mean_gwh_m vs. x and y coordinates with boundary
-fig3 = plt.figure(figsize=(10, 8))
-plt.scatter(gdf['x_wgs84'], gdf['y_wgs84'], c=gdf['mean_gwh_m'], cmap='inferno', s=20, alpha=0.7, vmin=-20, vmax=170)
-plt.colorbar(label='mean_gwh_m')
-boundary_gdf.plot(ax=plt.gca(), edgecolor='black', linewidth=1, facecolor='none')  # No facecolor for the boundary
-save_and_display_plot(fig3, 'Scatter plot of mean_gwh_m with Boundary', 'scatter_mean_gwh_m.png')
+@instrumented()
+def plot_mean_gwh(gdf, boundary_lines, save_folder, dense=None):
+    fig3 = plt.figure(figsize=(10, 8))
+    points = plot_values(plt.gca(), gdf['x_wgs84'], gdf['y_wgs84'], gdf['mean_gwh_m'], cmap='inferno', s=20,
+                         alpha=0.7, vmin=-20, vmax=170, dense=dense)
+    plt.colorbar(points, label='mean_gwh_m')
+    draw_boundary(plt.gca(), boundary_lines, edgecolor='black', linewidth=1)
+    save_and_display_plot(fig3, 'Scatter plot of mean_gwh_m with Boundary', 'scatter_mean_gwh_m.png', save_folder)
 
 # Plot 4: Scatter plot of litho_class vs. x and y coordinates with boundary (using legend)
-fig4 = plt.figure(figsize=(10, 8))
+@instrumented()
+def plot_litho_class(gdf, boundary_lines, save_folder, dense=None):
+    fig4 = plt.figure(figsize=(10, 8))
+
+    # Define colors for litho_class
+    colors = { -1: 'grey', 1: 'tab:blue', 2: 'tab:orange', 3: 'tab:green', 4: 'tab:red' }
+    legend_labels = { -1: '-1 (Grey)', 1: '1 (Blue)', 2: '2 (Orange)', 3: '3 (Green)', 4: '4 (Red)' }
+
+    # Shapefiles cut the column name to 10 characters
+    litho_column = 'litho_class' if 'litho_class' in gdf.columns else 'litho_clas'
+    handles = plot_categories(plt.gca(), gdf['x_wgs84'], gdf['y_wgs84'], gdf[litho_column], colors,
+                              labels=legend_labels, s=20, alpha=0.7, dense=dense)
+
+    plt.legend(handles=handles, title='litho_class', loc='best')
+    draw_boundary(plt.gca(), boundary_lines, edgecolor='black', linewidth=1)
+    save_and_display_plot(fig4, 'Scatter plot of litho_class with Boundary', 'scatter_litho_class.png', save_folder)
+
+def main(wells_shapefile_path, boundary_shapefile_path, save_folder, dense=None):
+    """
+    Make the four well maps. Every layer is drawn in one call, the boundary is simplified and cached (in
+    ~/.cache/geowat) the first time, and more than 200000 wells are drawn as a density image (see
+    map_rendering.py).
+
+    Parameters:
+    - wells_shapefile_path (str): Wells (shapefile or GeoParquet) with the n_years, weight, mean_gwh_m and
+      litho_class columns.
+    - boundary_shapefile_path (str): Country boundaries.
+    - save_folder (str): Folder for the png files.
+    - dense (bool): Force the density image (True) or the scatter (False), by default chosen on the number of wells.
+    """
+    # Load the wells data, only the attributes are needed
+    with stage('read_wells', path=wells_shapefile_path) as st:
+        if wells_shapefile_path.endswith('.parquet'):
+            gdf = gpd.read_parquet(wells_shapefile_path)
+        else:
+            gdf = gpd.read_file(wells_shapefile_path, ignore_geometry=True)
+        st.set(rows_out=len(gdf), bytes_fetched=file_bytes(wells_shapefile_path))
+
+    # Load the boundary lines (simplified, cached after the first run)
+    with stage('load_boundary_lines', path=boundary_shapefile_path) as st:
+        boundary_lines = load_boundary_lines(boundary_shapefile_path)
+        st.set(rows_out=len(boundary_lines))
+
+    # Create a folder to save plots if it doesn't exist
+    os.makedirs(save_folder, exist_ok=True)
+
+    plot_n_years(gdf, boundary_lines, save_folder, dense=dense)
+    plot_well_weight(gdf, boundary_lines, save_folder, dense=dense)
+    plot_mean_gwh(gdf, boundary_lines, save_folder, dense=dense)
+    plot_litho_class(gdf, boundary_lines, save_folder, dense=dense)
+
+if __name__ == '__main__':
+    # Load the shapefile for wells data
+    wells_shapefile_path = '/scratch/depfg/otoo0001/data/Daniel_develop/Hygs/shapefile/output/gwh_data_updated.shp'
 
-# Define colors for litho_class
-colors = { -1: 'grey', 1: 'tab:blue', 2: 'tab:orange', 3: 'tab:green', 4: 'tab:red' }
-legend_labels = { -1: '-1 (Grey)', 1: '1 (Blue)', 2: '2 (Orange)', 3: '3 (Green)', 4: '4 (Red)' }
+    # Load the shapefile for boundary
+    boundary_shapefile_path = "/scratch/depfg/otoo0001/data/shapefiles/WB_countries_Admin0_10m/WB_countries_Admin0_10m.shp"
 
-for litho_class, color in colors.items():
-    subset = gdf[gdf['litho_class'] == litho_class]
-    plt.scatter(subset['x_wgs84'], subset['y_wgs84'], c=color, label=legend_labels[litho_class], s=20, alpha=0.7)
+    # Folder to save plots
+    save_folder = '/scratch/depfg/otoo0001/data/Daniel_develop/Hygs/shapefile/output/plots/'
 
-plt.legend(title='litho_class', loc='best')
-boundary_gdf.plot(ax=plt.gca(), edgecolor='black', linewidth=1, facecolor='none')  # No facecolor for the boundary
-save_and_display_plot(fig4, 'Scatter plot of litho_class with Boundary', 'scatter_litho_class.png')
+    main(wells_shapefile_path, boundary_shapefile_path, save_folder)
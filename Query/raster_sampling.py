@@ -0,0 +1,120 @@
+"""
+    Batched point sampling of rasters (GLiM lithology, DEM, recharge, ...). All coordinates are converted to pixel
+    indices in one numpy step, the points are grouped by the raster block they fall in and every block is read only
+    once, optionally spread over a few threads. This replaces looping over src.sample() one well at a time.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+
+def coords_to_pixels(transform, x, y):
+    """
+    Convert map coordinates to (row, col) pixel indices with the inverse of the raster transform.
+
+    Parameters:
+    - transform (Affine): Raster transform (src.transform).
+    - x, y (array): Coordinates in the raster CRS.
+
+    Returns:
+    - tuple: (rows, cols) as int64 arrays, -1 for coordinates that are not finite.
+    """
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    inv = ~transform
+    col_f = inv.a * x + inv.b * y + inv.c
+    row_f = inv.d * x + inv.e * y + inv.f
+    finite = np.isfinite(col_f) & np.isfinite(row_f)
+    rows = np.full(len(x), -1, dtype='int64')
+    cols = np.full(len(x), -1, dtype='int64')
+    rows[finite] = np.floor(row_f[finite]).astype('int64')
+    cols[finite] = np.floor(col_f[finite]).astype('int64')
+    return rows, cols
+
+
+def _read_blocks(raster_path, band, blocks, block_shape, rows, cols, out):
+    #   each worker opens its own dataset, rasterio datasets can not be shared between threads
+    block_h, block_w = block_shape
+    with rasterio.open(raster_path, 'r') as src:
+        for block_row, block_col, idx in blocks:
+            row_off = block_row * block_h
+            col_off = block_col * block_w
+            window = Window(col_off, row_off, min(block_w, src.width - col_off), min(block_h, src.height - row_off))
+            data = src.read(band, window=window)
+            out[idx] = data[rows[idx] - row_off, cols[idx] - col_off]
+
+
+def sample_raster(raster_path, x, y, band=1, fill_value=None, max_workers=None):
+    """
+    Sample a raster band at many points, reading every raster block that contains points exactly once.
+
+    Parameters:
+    - raster_path (str): Path to the raster.
+    - x, y (array): Point coordinates in the raster CRS.
+    - band (int): Band number (1-based, like rasterio).
+    - fill_value: Value for points outside the raster, defaults to the raster nodata value (or 0 without one).
+    - max_workers (int): Read blocks with this many threads, None or 1 reads in the calling thread.
+
+    Returns:
+    - numpy array: Sampled values with the data type of the band.
+    """
+    with rasterio.open(raster_path, 'r') as src:
+        transform = src.transform
+        height, width = src.height, src.width
+        block_shape = src.block_shapes[band - 1]
+        dtype = src.dtypes[band - 1]
+        if fill_value is None:
+            fill_value = src.nodata if src.nodata is not None else 0
+
+    rows, cols = coords_to_pixels(transform, x, y)
+    out = np.full(len(rows), fill_value, dtype=dtype)
+    inside = np.flatnonzero((rows >= 0) & (rows < height) & (cols >= 0) & (cols < width))
+    if len(inside) == 0:
+        return out
+
+    #   group the points per block: sort on block id and cut the sorted index where the id changes
+    block_h, block_w = block_shape
+    n_block_cols = -(-width // block_w)
+    block_ids = (rows[inside] // block_h) * n_block_cols + cols[inside] // block_w
+    order = np.argsort(block_ids, kind='stable')
+    sorted_ids = block_ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    groups = np.split(inside[order], starts[1:])
+    blocks = [(int(block_id) // n_block_cols, int(block_id) % n_block_cols, idx)
+              for block_id, idx in zip(sorted_ids[starts], groups)]
+
+    if not max_workers or max_workers <= 1 or len(blocks) == 1:
+        _read_blocks(raster_path, band, blocks, block_shape, rows, cols, out)
+        return out
+
+    #   hand every thread a contiguous run of blocks, neighbouring blocks are usually close together in the file
+    batches = [batch for batch in np.array_split(np.arange(len(blocks)), max_workers) if len(batch)]
+    with ThreadPoolExecutor(max_workers=len(batches)) as pool:
+        futures = [pool.submit(_read_blocks, raster_path, band, [blocks[i] for i in batch], block_shape, rows, cols,
+                               out) for batch in batches]
+        for future in futures:
+            future.result()
+    return out
+
+
+def apply_lookup_table(values, lut, fill_value=-1):
+    """
+    Reclassify integer codes with a lookup array, new_value = lut[code], in one vectorized step.
+
+    Parameters:
+    - values (array): Integer codes, floats are allowed when they hold whole numbers or NaN.
+    - lut (numpy array): Lookup array indexed by code.
+    - fill_value: Result for NaN and for codes outside the lookup array.
+
+    Returns:
+    - numpy array: Reclassified values with the data type of lut.
+    """
+    values = np.asarray(values)
+    out = np.full(values.shape, fill_value, dtype=lut.dtype)
+    valid = np.isfinite(values) if values.dtype.kind == 'f' else np.ones(values.shape, dtype=bool)
+    valid[valid] = (values[valid] >= 0) & (values[valid] < len(lut))
+    out[valid] = lut[values[valid].astype('int64')]
+    return out
@@ -0,0 +1,390 @@
+"""
+    Local snapshot of the gerbil tables in a DuckDB database file, so analysis can run offline (for example on the
+    cluster) at local disk speed instead of over the VPN.
+
+    The tables are copied with COPY ... TO STDOUT through Parquet (see geowat_export.py) and refreshed incrementally:
+    tables whose pg_stat_all_tables counters did not change are skipped, and for tables with an id_gerbil column only
+    the wells whose rows changed (compared with a per-well row count and hash computed by the database) are fetched
+    again. Other tables are reloaded completely when they changed.
+
+    connect_snapshot returns a (connection, cursor) pair that accepts the same %s style SQL as psycopg2, so the query
+    functions in geowat_db.py (extract_mean_gwh, iter_query_chunks, stream_mean_per_well, query_to_dataframe) run
+    unchanged on either backend. The PostGIS functions used by spatial_query.py are only available on the server.
+
+    Usage:
+        python snapshot.py /scratch/geowat/gerbil.duckdb                  (create or refresh all tables)
+        python snapshot.py /scratch/geowat/gerbil.duckdb --full           (reload everything)
+        python snapshot.py /scratch/geowat/gerbil.duckdb --geoparquet out (also write GeoParquet files)
+"""
+
+import argparse
+import os
+import re
+import tempfile
+import time
+
+import duckdb
+import numpy as np
+import pandas as pd
+import psycopg2
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from geowat_cache import probe_sql
+from geowat_db import (connect_to_dtbase, db_config_from_env, gerbil_schema, monthly_tables, yearly_tables)
+from geowat_export import _prepare_table, copy_query_to_parquet
+
+#   tables mirrored by default
+snapshot_tables = ('_lookup_tb',) + yearly_tables + monthly_tables + ('_bore_litho_tb', 'litho_classes_tb')
+
+#   environment variable with the path of the snapshot, connect_backend uses it instead of the server when set
+snapshot_env_var = 'GEOWAT_SNAPSHOT'
+
+#   wells fetched per COPY during an incremental refresh
+refresh_batch_size = 100000
+
+#   schema in the DuckDB file with the refresh bookkeeping
+meta_schema = 'snapshot'
+
+#   duckdb column types and the postgres type oid they correspond to, so cursor.description looks the same on both
+#   backends (geowat_db.pg_type_dtypes)
+duckdb_type_oids = {'BOOLEAN': 16, 'BIGINT': 20, 'HUGEINT': 1700, 'SMALLINT': 21, 'INTEGER': 23, 'FLOAT': 700,
+                    'DOUBLE': 701, 'VARCHAR': 25, 'DATE': 1082, 'TIMESTAMP': 1114}
+
+#   per-well fingerprint of a table, the hash is order independent so it does not depend on the row order
+fingerprint_sql = ("SELECT id_gerbil, COUNT(*) AS n_rows, SUM(hashtext(t::text)::bigint)::bigint AS row_hash "
+                   "FROM {schema}.{table} t GROUP BY id_gerbil")
+
+
+class SnapshotError(psycopg2.DatabaseError):
+    """
+    Error raised by a snapshot cursor, a psycopg2.DatabaseError so callers handle both backends the same way.
+    """
+
+
+def _translate_sql(sql_cmd, params=None):
+    #   psycopg2 placeholders to duckdb ones: %s -> ?, %(name)s -> $name and %% -> %. Like psycopg2 the SQL is left
+    #   alone when there are no params, so a literal LIKE 'a%%' means the same on both backends
+    if params is None:
+        return sql_cmd
+    return re.sub(r"%\((\w+)\)s|%s|%%", lambda m: '$' + m.group(1) if m.group(1) else ('?' if m.group(0) == '%s'
+                                                                                       else '%'), sql_cmd)
+
+
+def _type_oid(duck_type):
+    name = str(duck_type)
+    return duckdb_type_oids.get(name, 1700 if name.startswith('DECIMAL') else 25)
+
+
+class SnapshotCursor:
+    """
+    DB-API cursor on a snapshot with the psycopg2 conventions used in this repository (%s placeholders, itersize,
+    description with postgres type oids).
+    """
+
+    def __init__(self, connection, name=None):
+        self.connection = connection
+        self.name = name
+        self.itersize = 2000
+        self._cur = connection._duck.cursor()
+        self.description = None
+        self.rowcount = -1
+
+    def execute(self, sql_cmd, params=None):
+        try:
+            if params is None:
+                self._cur.execute(sql_cmd)
+            else:
+                self._cur.execute(_translate_sql(sql_cmd, params),
+                                  list(params) if isinstance(params, (tuple, list)) else params)
+        except duckdb.Error as e:
+            raise SnapshotError(str(e)) from e
+        self.description = [(elt[0], _type_oid(elt[1]), None, None, None, None, None)
+                            for elt in (self._cur.description or [])]
+
+    def fetchone(self):
+        return self._cur.fetchone()
+
+    def fetchmany(self, size=None):
+        return self._cur.fetchmany(size or self.itersize)
+
+    def fetchall(self):
+        return self._cur.fetchall()
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany()
+            if not rows:
+                return
+            yield from rows
+
+    def close(self):
+        self._cur.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SnapshotConnection:
+    """
+    Connection to a snapshot file that behaves like a psycopg2 connection for the query functions. Transactions are
+    not needed for reading, commit and rollback do nothing.
+
+    Parameters:
+    - path (str): DuckDB file written by refresh_snapshot.
+    - readonly (bool): Open the file read-only, so several processes can read it at the same time.
+    """
+
+    def __init__(self, path, readonly=True):
+        self.path = path
+        self.readonly = readonly
+        self._duck = duckdb.connect(path, read_only=readonly)
+        self.closed = 0
+
+    def cursor(self, name=None):
+        #   a named (server-side) cursor is just a normal cursor, duckdb streams the result anyway
+        return SnapshotCursor(self, name=name)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def set_session(self, readonly=None, **kwargs):
+        pass
+
+    def close(self):
+        self._duck.close()
+        self.closed = 1
+
+
+def connect_snapshot(path, readonly=True):
+    """
+    Open a snapshot, the counterpart of geowat_db.connect_to_dtbase.
+
+    Returns:
+    - tuple: (connection, cursor).
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No snapshot at '{path}', create one with refresh_snapshot")
+    connection = SnapshotConnection(path, readonly=readonly)
+    print("Successfully opened snapshot : " + str(path))
+    return connection, connection.cursor()
+
+
+def connect_backend(snapshot_path=None):
+    """
+    Connect to the snapshot when a path is given or GEOWAT_SNAPSHOT is set, otherwise to the database server with
+    the GEOWAT_DB_* settings.
+
+    Returns:
+    - tuple: (connection, cursor).
+    """
+    snapshot_path = snapshot_path or os.environ.get(snapshot_env_var)
+    if snapshot_path:
+        return connect_snapshot(snapshot_path)
+    return connect_to_dtbase(**db_config_from_env())
+
+
+def _server_token(cursor, table):
+    #   insert/update/delete counters of the table, None when the statistics can not be read
+    try:
+        cursor.execute(probe_sql['stats'], (gerbil_schema, table))
+        row = cursor.fetchone()
+    except psycopg2.Error:
+        cursor.connection.rollback()
+        return None
+    return None if row is None else ','.join(str(val) for val in row)
+
+
+def _server_columns(cursor, table):
+    cursor.execute("SELECT * FROM %s.%s LIMIT 0" % (gerbil_schema, table))
+    return [elt[0] for elt in cursor.description]
+
+
+def _init_meta(duck):
+    duck.execute("CREATE SCHEMA IF NOT EXISTS %s" % gerbil_schema)
+    duck.execute("CREATE SCHEMA IF NOT EXISTS %s" % meta_schema)
+    duck.execute("CREATE TABLE IF NOT EXISTS %s.tables (table_name VARCHAR PRIMARY KEY, token VARCHAR, "
+                 "n_rows BIGINT, refreshed_at DOUBLE, mode VARCHAR)" % meta_schema)
+
+
+def _local_meta(duck, table):
+    row = duck.execute("SELECT token, n_rows FROM %s.tables WHERE table_name = ?" % meta_schema, [table]).fetchone()
+    return (None, None) if row is None else row
+
+
+def _full_reload(connection, duck, table, tmp_dir, with_fingerprint):
+    tmp_path = os.path.join(tmp_dir, f'{table}.parquet')
+    copy_query_to_parquet(connection, "SELECT * FROM %s.%s" % (gerbil_schema, table), tmp_path, geometry=False)
+    duck.execute("CREATE OR REPLACE TABLE %s.%s AS SELECT * FROM read_parquet(?)" % (gerbil_schema, table),
+                 [tmp_path])
+    if with_fingerprint:
+        #   same (repeatable read) transaction as the copy, so the fingerprints match the copied rows
+        fingerprints = _server_fingerprints(connection, table)
+        duck.execute("CREATE OR REPLACE TABLE %s.fp_%s AS SELECT * FROM fingerprints" % (meta_schema, table))
+    os.remove(tmp_path)
+    return duck.execute("SELECT COUNT(*) FROM %s.%s" % (gerbil_schema, table)).fetchone()[0]
+
+
+def _server_fingerprints(connection, table):
+    cursor = connection.cursor()
+    try:
+        cursor.execute(fingerprint_sql.format(schema=gerbil_schema, table=table))
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    return pd.DataFrame(rows, columns=['id_gerbil', 'n_rows', 'row_hash']).astype('int64')
+
+
+def _incremental_refresh(connection, duck, table, tmp_dir):
+    #   compare the per-well fingerprints, fetch the new and changed wells and drop the deleted ones
+    fingerprints = _server_fingerprints(connection, table)
+    changed = duck.execute("SELECT s.id_gerbil FROM fingerprints s LEFT JOIN %s.fp_%s l USING (id_gerbil) "
+                           "WHERE l.id_gerbil IS NULL OR l.n_rows != s.n_rows OR l.row_hash != s.row_hash "
+                           "UNION ALL SELECT l.id_gerbil FROM %s.fp_%s l ANTI JOIN fingerprints s USING (id_gerbil)"
+                           % (meta_schema, table, meta_schema, table)).fetchnumpy()['id_gerbil']
+    if len(changed) == 0:
+        return 0
+
+    tmp_paths = []
+    for start in range(0, len(changed), refresh_batch_size):
+        ids = [int(val) for val in changed[start:start + refresh_batch_size]]
+        tmp_path = os.path.join(tmp_dir, f'{table}_{start}.parquet')
+        copy_query_to_parquet(connection, "SELECT * FROM %s.%s WHERE id_gerbil = ANY(%%s)" % (gerbil_schema, table),
+                              tmp_path, params=(ids,), geometry=False)
+        tmp_paths.append(tmp_path)
+
+    changed_ids = pd.DataFrame({'id_gerbil': changed.astype('int64')})
+    duck.execute("BEGIN TRANSACTION")
+    try:
+        duck.execute("DELETE FROM %s.%s WHERE id_gerbil IN (SELECT id_gerbil FROM changed_ids)"
+                     % (gerbil_schema, table))
+        duck.execute("INSERT INTO %s.%s BY NAME SELECT * FROM read_parquet(?)" % (gerbil_schema, table),
+                     [tmp_paths])
+        duck.execute("CREATE OR REPLACE TABLE %s.fp_%s AS SELECT * FROM fingerprints" % (meta_schema, table))
+        duck.execute("COMMIT")
+    except duckdb.Error:
+        duck.execute("ROLLBACK")
+        raise
+    finally:
+        for tmp_path in tmp_paths:
+            os.remove(tmp_path)
+    return len(changed)
+
+
+def refresh_snapshot(snapshot_path, tables=snapshot_tables, full=False, connection=None):
+    """
+    Create or update a local snapshot of gerbil tables.
+
+    Parameters:
+    - snapshot_path (str): DuckDB file, created when it does not exist.
+    - tables (list of str): Tables in the gerbil schema to mirror.
+    - full (bool): Reload every table completely instead of refreshing incrementally.
+    - connection: Open database connection, one is made with the GEOWAT_DB_* settings when None. Its session
+      settings are changed during the refresh and restored afterwards.
+
+    Returns:
+    - DataFrame: Per table the refresh mode ('skipped', 'full' or 'incremental'), the number of wells fetched
+      again (incremental only), the number of local rows and the time taken.
+    """
+    own_connection = connection is None
+    if own_connection:
+        connection, _ = connect_to_dtbase(**db_config_from_env())
+    #   one repeatable read transaction per table, so the fingerprints and the copied rows see the same data. The
+    #   settings of a connection from the caller are put back at the end (None means the server default)
+    previous_session = {'readonly': connection.readonly, 'isolation_level': connection.isolation_level}
+    connection.set_session(readonly=True, isolation_level='REPEATABLE READ')
+    os.makedirs(os.path.dirname(os.path.abspath(snapshot_path)), exist_ok=True)
+    duck = duckdb.connect(snapshot_path)
+    cursor = connection.cursor()
+    report = []
+    try:
+        _init_meta(duck)
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(snapshot_path))) as tmp_dir:
+            for table in tables:
+                start = time.perf_counter()
+                token = _server_token(cursor, table)
+                local_token, n_rows = _local_meta(duck, table)
+                with_fingerprint = 'id_gerbil' in _server_columns(cursor, table)
+                has_fingerprints = duck.execute(
+                    "SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = ? AND table_name = ?",
+                    [meta_schema, f'fp_{table}']).fetchone()[0] > 0
+                n_wells = np.nan
+
+                if not full and token is not None and token == local_token:
+                    mode = 'skipped'
+                elif not full and with_fingerprint and has_fingerprints and n_rows is not None:
+                    mode = 'incremental'
+                    n_wells = _incremental_refresh(connection, duck, table, tmp_dir)
+                    n_rows = duck.execute("SELECT COUNT(*) FROM %s.%s" % (gerbil_schema, table)).fetchone()[0]
+                else:
+                    mode = 'full'
+                    n_rows = _full_reload(connection, duck, table, tmp_dir, with_fingerprint)
+                connection.rollback()
+
+                duck.execute("INSERT OR REPLACE INTO %s.tables VALUES (?, ?, ?, ?, ?)" % meta_schema,
+                             [table, token, n_rows, time.time(), mode])
+                report.append({'table': table, 'mode': mode, 'wells_fetched': n_wells, 'n_rows': n_rows,
+                               'seconds': time.perf_counter() - start})
+                print("%s: %s (%s rows)" % (table, mode, n_rows))
+    finally:
+        cursor.close()
+        duck.close()
+        if own_connection:
+            connection.close()
+        elif not connection.closed:
+            connection.rollback()
+            connection.set_session(**{key: 'DEFAULT' if value is None else value
+                                      for key, value in previous_session.items()})
+    return pd.DataFrame(report)
+
+
+def export_geoparquet(snapshot_path, output_dir, tables=None, x_col='x_wgs84', y_col='y_wgs84'):
+    """
+    Write snapshot tables to (Geo)Parquet files, tables with coordinate columns get a point geometry.
+
+    Parameters:
+    - snapshot_path (str): DuckDB file written by refresh_snapshot.
+    - output_dir (str): Folder for the <table>.parquet files.
+    - tables (list of str): Tables to export, all mirrored tables when None.
+    - x_col, y_col (str): Coordinate columns used for the geometry.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    duck = duckdb.connect(snapshot_path, read_only=True)
+    try:
+        if tables is None:
+            tables = [row[0] for row in duck.execute("SELECT table_name FROM %s.tables" % meta_schema).fetchall()]
+        for table in tables:
+            reader = duck.execute("SELECT * FROM %s.%s" % (gerbil_schema, table)).fetch_record_batch()
+            geometry = x_col in reader.schema.names and y_col in reader.schema.names
+            writer = None
+            for batch in reader:
+                batch_table = _prepare_table(pa.Table.from_batches([batch]), geometry, x_col, y_col)
+                if writer is None:
+                    writer = pq.ParquetWriter(os.path.join(output_dir, f'{table}.parquet'), batch_table.schema)
+                writer.write_table(batch_table)
+            if writer is None:
+                pq.write_table(_prepare_table(reader.schema.empty_table(), geometry, x_col, y_col),
+                               os.path.join(output_dir, f'{table}.parquet'))
+            else:
+                writer.close()
+    finally:
+        duck.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Create or refresh a local DuckDB snapshot of the gerbil tables.")
+    parser.add_argument('snapshot_path', help="DuckDB file of the snapshot")
+    parser.add_argument('--tables', nargs='+', default=list(snapshot_tables), help="tables to mirror")
+    parser.add_argument('--full', action='store_true', help="reload all tables completely")
+    parser.add_argument('--geoparquet', metavar='DIR', help="also write the tables as (Geo)Parquet to DIR")
+    args = parser.parse_args()
+
+    print(refresh_snapshot(args.snapshot_path, tables=args.tables, full=args.full))
+    if args.geoparquet:
+        export_geoparquet(args.snapshot_path, args.geoparquet, tables=args.tables)
@@ -0,0 +1,231 @@
+"""
+    Spatial queries on the well locations that run inside PostGIS, so a regional extraction only touches the wells
+    in the region instead of pulling whole tables and filtering in python. Supported are bounding boxes
+    (ST_MakeEnvelope), arbitrary polygons (ST_Intersects) and the k nearest wells to a point (KNN <-> ordering). All
+    values are passed as query parameters and the results come back as GeoDataFrames.
+
+    The well geometry is built from x_wgs84/y_wgs84 by default. With a GiST index on that same expression (see
+    spatial_index_sql) PostgreSQL answers these queries from the index.
+"""
+
+import re
+
+import geopandas as gpd
+import psycopg2
+import shapely
+
+from geowat_db import gerbil_schema, lookup_columns, query_to_dataframe
+
+#   geometry of a well when the table has no geometry column of its own
+point_geometry_sql = "ST_SetSRID(ST_MakePoint(x_wgs84, y_wgs84), 4326)"
+
+#   default columns returned by the spatial queries
+spatial_columns = ['id_gerbil', 'country_name'] + lookup_columns
+
+
+def _geometry_sql(geom_col):
+    if geom_col is None:
+        return point_geometry_sql
+    if not geom_col.isidentifier():
+        raise ValueError(f"Invalid column name '{geom_col}'")
+    return geom_col
+
+
+def _polygon_wkb(polygon):
+    #   accept a shapely geometry, a GeoSeries/GeoDataFrame (all shapes together) or WKT
+    if isinstance(polygon, (gpd.GeoDataFrame, gpd.GeoSeries)):
+        polygon = polygon.to_crs('EPSG:4326').union_all() if polygon.crs is not None else polygon.union_all()
+    elif isinstance(polygon, str):
+        polygon = shapely.from_wkt(polygon)
+    return psycopg2.Binary(shapely.to_wkb(polygon))
+
+
+def build_spatial_query(bbox=None, polygon=None, nearest=None, k=10, columns=None, country=None, geom_col=None,
+                        table='_lookup_tb'):
+    """
+    Build a parameterized PostGIS query for wells in a bounding box and/or polygon, optionally ordered by distance
+    to a point.
+
+    Parameters:
+    - bbox (tuple): (xmin, ymin, xmax, ymax) in WGS84 degrees.
+    - polygon: Shapely geometry, GeoSeries/GeoDataFrame or WKT in WGS84, wells intersecting it are returned.
+    - nearest (tuple): (x, y) in WGS84 degrees, return the k wells closest to this point with their distance_m.
+    - k (int): Number of wells for nearest.
+    - columns (list of str): Columns to return, spatial_columns when None.
+    - country (str or list of str): Only wells in these countries.
+    - geom_col (str): Geometry column of the table, the point is built from x_wgs84/y_wgs84 when None.
+    - table (str): Table in the gerbil schema with the well locations.
+
+    Returns:
+    - tuple: (sql_cmd, params) ready to be passed to cursor.execute.
+    """
+    columns = columns or spatial_columns
+    for col in columns + [table]:
+        if not col.isidentifier():
+            raise ValueError(f"Invalid column or table name '{col}'")
+    geom = _geometry_sql(geom_col)
+
+    select = list(columns)
+    select_params = []
+    where = []
+    where_params = []
+    order = ""
+    order_params = []
+
+    if bbox is not None:
+        #   && compares bounding boxes and is answered by the GiST index
+        where.append("%s && ST_MakeEnvelope(%%s, %%s, %%s, %%s, 4326)" % geom)
+        where_params.extend(float(val) for val in bbox)
+    if polygon is not None:
+        where.append("ST_Intersects(%s, ST_GeomFromWKB(%%s, 4326))" % geom)
+        where_params.append(_polygon_wkb(polygon))
+    if country is not None:
+        if isinstance(country, str):
+            country = [country]
+        where.append("country_name IN (%s)" % ", ".join(["%s"] * len(country)))
+        where_params.extend(country)
+    if nearest is not None:
+        x, y = float(nearest[0]), float(nearest[1])
+        #   <-> orders by (planar) distance using the index, the exact distance on the sphere is returned in meters
+        select.append("ST_Distance(%s::geography, ST_SetSRID(ST_MakePoint(%%s, %%s), 4326)::geography) AS distance_m"
+                      % geom)
+        select_params.extend([x, y])
+        order = " ORDER BY %s <-> ST_SetSRID(ST_MakePoint(%%s, %%s), 4326) LIMIT %%s" % geom
+        order_params.extend([x, y, int(k)])
+
+    sql_cmd = "SELECT %s FROM %s.%s" % (", ".join(select), gerbil_schema, table)
+    if where:
+        sql_cmd += " WHERE " + " AND ".join(where)
+    sql_cmd += order
+    return sql_cmd, tuple(select_params + where_params + order_params)
+
+
+def query_wells(cursor, bbox=None, polygon=None, nearest=None, k=10, columns=None, country=None, geom_col=None,
+                table='_lookup_tb', cache=None):
+    """
+    Run a spatial query (see build_spatial_query) and return the wells as a GeoDataFrame.
+
+    Parameters:
+    - cursor: Open database cursor.
+    - cache (QueryCache): Optional result cache, see geowat_db.query_to_dataframe.
+    - other parameters: See build_spatial_query.
+
+    Returns:
+    - GeoDataFrame: Wells with point geometry from x_wgs84/y_wgs84 (EPSG:4326).
+    """
+    sql_cmd, params = build_spatial_query(bbox=bbox, polygon=polygon, nearest=nearest, k=k, columns=columns,
+                                          country=country, geom_col=geom_col, table=table)
+    df = query_to_dataframe(cursor, sql_cmd, params, cache=cache)
+    geometry = gpd.points_from_xy(df['x_wgs84'], df['y_wgs84'], crs='EPSG:4326')
+    return gpd.GeoDataFrame(df, geometry=geometry)
+
+
+def wells_in_bbox(cursor, xmin, ymin, xmax, ymax, **kwargs):
+    """
+    Wells inside a bounding box in WGS84 degrees, see query_wells for the keyword arguments.
+    """
+    return query_wells(cursor, bbox=(xmin, ymin, xmax, ymax), **kwargs)
+
+
+def wells_in_polygon(cursor, polygon, **kwargs):
+    """
+    Wells intersecting a polygon (shapely geometry, GeoSeries/GeoDataFrame or WKT), see query_wells.
+    """
+    return query_wells(cursor, polygon=polygon, **kwargs)
+
+
+def nearest_wells(cursor, x, y, k=10, **kwargs):
+    """
+    The k wells closest to a point in WGS84 degrees, with their distance in meters, see query_wells.
+    """
+    return query_wells(cursor, nearest=(x, y), k=k, **kwargs)
+
+
+def spatial_index_sql(table='_lookup_tb', geom_col=None):
+    """
+    SQL that creates a GiST index on the well geometry used by the spatial queries, plus ANALYZE so the planner
+    knows about it. Run it on a database where you have write rights (for example a local PostGIS copy).
+
+    Returns:
+    - list of str: SQL commands.
+    """
+    if not table.isidentifier():
+        raise ValueError(f"Invalid table name '{table}'")
+    geom = _geometry_sql(geom_col)
+    index_name = '%s_geom_gist' % table.strip('_')
+    return ["CREATE INDEX IF NOT EXISTS %s ON %s.%s USING GIST ((%s))" % (index_name, gerbil_schema, table, geom),
+            "ANALYZE %s.%s" % (gerbil_schema, table)]
+
+
+def _normalize_sql_expression(expression):
+    #   lower case without spaces, quotes, schema names in front of functions, type casts (numeric or real
+    #   coordinates are stored as (x_wgs84)::double precision) and parentheses around the whole expression, so our
+    #   geometry SQL and the index definition written back by PostgreSQL can be compared
+    expression = re.sub(r'\b\w+\.(?=\w+\()', '', re.sub(r'[\s"]', '', expression.lower()))
+    expression = re.sub(r'::\w+(\(\d+(,\d+)*\))?(\[\])?', '', expression)
+    while True:
+        #   parentheses around a single name or number that are not a function call
+        stripped = re.sub(r'(?<![\w)])\(([\w.]+)\)', r'\1', expression)
+        if stripped == expression:
+            break
+        expression = stripped
+    while expression.startswith('(') and expression.endswith(')'):
+        depth = 0
+        for i, char in enumerate(expression):
+            depth += {'(': 1, ')': -1}.get(char, 0)
+            if depth == 0 and i < len(expression) - 1:
+                return expression
+        expression = expression[1:-1]
+    return expression
+
+
+def _gist_index_keys(indexdef):
+    #   key expressions of a GiST index definition from pg_indexes, empty for other or partial indexes
+    match = re.search(r'\bUSING gist \((.*)\)\s*$', indexdef, re.IGNORECASE | re.DOTALL)
+    if match is None or re.search(r'\)\s+WHERE\s', indexdef, re.IGNORECASE):
+        return []
+    keys, depth, start = [], 0, 0
+    text = match.group(1)
+    for i, char in enumerate(text + ','):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            keys.append(_normalize_sql_expression(text[start:i]))
+            start = i + 1
+    return keys
+
+
+def ensure_spatial_index(connection, table='_lookup_tb', geom_col=None, create=False):
+    """
+    Check whether the table has a GiST index on the geometry expression that the spatial queries use and create it
+    when asked. A GiST index on another column or expression does not count, the queries can not use it.
+
+    Parameters:
+    - connection: Open database connection.
+    - table (str): Table in the gerbil schema.
+    - geom_col (str): Geometry column, None for the x_wgs84/y_wgs84 point expression.
+    - create (bool): Create the index when it is missing, otherwise only print the recommended SQL.
+
+    Returns:
+    - bool: True when a matching GiST index exists (or was created).
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT indexdef FROM pg_indexes WHERE schemaname = %s AND tablename = %s",
+                       (gerbil_schema, table))
+        geom = _normalize_sql_expression(_geometry_sql(geom_col))
+        if any(geom in _gist_index_keys(row[0]) for row in cursor.fetchall()):
+            return True
+        sql_cmds = spatial_index_sql(table=table, geom_col=geom_col)
+        if not create:
+            print("No spatial index on %s.%s, create one with:\n%s" % (gerbil_schema, table,
+                                                                       ";\n".join(sql_cmds) + ";"))
+            return False
+        for sql_cmd in sql_cmds:
+            cursor.execute(sql_cmd)
+        connection.commit()
+        return True
+    finally:
+        cursor.close()
@@ -0,0 +1,363 @@
+"""
+    Per-well statistics of the monthly tables (_gwh_monthly_tb, _gwe_monthly_tb, _gws_monthly_tb): trends (OLS and
+    Sen's slope), the monthly climatology and seasonal amplitude, anomalies and gap statistics.
+
+    All series are packed into one ragged array (RaggedSeries): the values of every well one after the other, sorted
+    by time, with an offsets array marking where each well starts. The values stay integer centimeters as in the
+    database (int16 when they fit, otherwise int32), time is counted in months. Every statistic is computed for all
+    wells at once with segment reductions (reduceat, bincount) instead of a groupby per well, and well_statistics
+    splits the wells over a thread pool.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from geowat_db import default_itersize, gerbil_schema, iter_query_chunks, monthly_tables
+
+#   wells per task in well_statistics
+default_chunk_wells = 50000
+
+#   maximum number of slope pairs held in memory at once by sens_slope
+default_pair_budget = 2000000
+
+
+class RaggedSeries:
+    """
+    Monthly series of many wells in flat arrays.
+
+    Parameters:
+    - ids (array): id_gerbil of every well, length n_wells.
+    - offsets (array): Start of every well in times/values plus the total length at the end, length n_wells + 1.
+    - times (array): Month index (year * 12 + month - 1) of every value, sorted within a well.
+    - values (array): Integer values in centimeters.
+    """
+
+    def __init__(self, ids, offsets, times, values):
+        self.ids = np.asarray(ids, dtype='int64')
+        self.offsets = np.asarray(offsets, dtype='int64')
+        self.times = np.asarray(times, dtype='int32')
+        self.values = np.asarray(values)
+        if len(self.offsets) != len(self.ids) + 1 or self.offsets[-1] != len(self.values):
+            raise ValueError("offsets must have one entry per well plus the total number of values")
+
+    @classmethod
+    def from_arrays(cls, ids, years, months, values):
+        """
+        Pack unsorted long-format arrays (one row per well-month) into a RaggedSeries. Rows with a missing value are
+        left out.
+        """
+        ids = np.asarray(ids, dtype='int64')
+        times = np.asarray(years, dtype='int32') * 12 + np.asarray(months, dtype='int32') - 1
+        values = pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+        valid = ~np.isnan(values)
+        ids, times, values = ids[valid], times[valid], values[valid]
+
+        order = np.lexsort((times, ids))
+        ids, times, values = ids[order], times[order], values[order]
+        starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]]) if len(ids) else np.zeros(0, dtype='int64')
+        offsets = np.append(starts, len(ids))
+
+        #   centimeters fit in int16 for heads and depths, elevations need int32
+        dtype = 'int16' if len(values) == 0 or (values.min() >= -32768 and values.max() <= 32767) else 'int32'
+        return cls(ids[starts], offsets, times, np.rint(values).astype(dtype))
+
+    @classmethod
+    def from_frame(cls, df, id_col='id_gerbil', year_col='year', month_col='month', value_col='gw_head_m'):
+        """
+        Pack a long-format DataFrame (one row per well-month) into a RaggedSeries.
+        """
+        return cls.from_arrays(df[id_col].to_numpy(), df[year_col].to_numpy(), df[month_col].to_numpy(),
+                               df[value_col].to_numpy())
+
+    @property
+    def n_wells(self):
+        return len(self.ids)
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def well_index(self):
+        """
+        Position of the well (0 .. n_wells - 1) of every value.
+        """
+        return np.repeat(np.arange(self.n_wells), self.lengths)
+
+    def slice(self, start, stop):
+        """
+        Wells start .. stop - 1 as a new RaggedSeries that shares the arrays.
+        """
+        first, last = self.offsets[start], self.offsets[stop]
+        return RaggedSeries(self.ids[start:stop], self.offsets[start:stop + 1] - first, self.times[first:last],
+                            self.values[first:last])
+
+    def series(self, i):
+        """
+        (times, values) of well i.
+        """
+        return self.times[self.offsets[i]:self.offsets[i + 1]], self.values[self.offsets[i]:self.offsets[i + 1]]
+
+
+def load_monthly(connection, table='_gwh_monthly_tb', value_col='gw_head_m', year_col='year', month_col='month',
+                 itersize=default_itersize):
+    """
+    Stream a monthly table from the database (or a snapshot) into a RaggedSeries, only the four needed columns are
+    kept in memory as numpy arrays.
+
+    Parameters:
+    - connection: Open database connection (geowat_db or snapshot).
+    - table (str): One of monthly_tables.
+    - value_col, year_col, month_col (str): Column names.
+    - itersize (int): Rows per chunk.
+
+    Returns:
+    - RaggedSeries: All wells of the table.
+    """
+    if table not in monthly_tables:
+        raise ValueError(f"Unknown monthly table '{table}', expected one of {monthly_tables}")
+    for col in (value_col, year_col, month_col):
+        if not col.isidentifier():
+            raise ValueError(f"Invalid column name '{col}'")
+
+    sql_cmd = "SELECT id_gerbil, %s, %s, %s FROM %s.%s WHERE %s IS NOT NULL" % (
+        year_col, month_col, value_col, gerbil_schema, table, value_col)
+    parts = {'ids': [], 'years': [], 'months': [], 'values': []}
+    for chunk in iter_query_chunks(connection, sql_cmd, itersize=itersize):
+        parts['ids'].append(chunk['id_gerbil'].to_numpy(dtype='int64'))
+        parts['years'].append(chunk[year_col].to_numpy(dtype='int32'))
+        parts['months'].append(chunk[month_col].to_numpy(dtype='int32'))
+        parts['values'].append(chunk[value_col].to_numpy(dtype='float64', na_value=np.nan))
+    arrays = {key: np.concatenate(val) if val else np.zeros(0) for key, val in parts.items()}
+    return RaggedSeries.from_arrays(arrays['ids'], arrays['years'], arrays['months'], arrays['values'])
+
+
+def _segment_reduce(ufunc, x, offsets, empty=np.nan):
+    #   ufunc.reduceat over every well, wells without values get the empty value
+    out = np.full(len(offsets) - 1, empty, dtype='float64')
+    nonempty = np.flatnonzero(np.diff(offsets) > 0)
+    if len(nonempty):
+        out[nonempty] = ufunc.reduceat(x, offsets[nonempty])
+    return out
+
+
+def _first_times(series):
+    #   first month of every well (0 for wells without values)
+    first = np.zeros(series.n_wells, dtype='int32')
+    nonempty = series.lengths > 0
+    first[nonempty] = series.times[series.offsets[:-1][nonempty]]
+    return first
+
+
+def ols_trend(series):
+    """
+    Least squares trend of every well.
+
+    Returns:
+    - DataFrame: ols_slope (meters per year), ols_intercept (meters at the first month of the well) and ols_r2, NaN
+      for wells with fewer than 2 distinct months.
+    """
+    n = series.lengths.astype('float64')
+    #   time relative to the first month of every well keeps the sums small and precise
+    t = (series.times - np.repeat(_first_times(series), series.lengths)).astype('float64')
+    v = series.values.astype('float64')
+    st = _segment_reduce(np.add, t, series.offsets, 0.)
+    sv = _segment_reduce(np.add, v, series.offsets, 0.)
+    stt = _segment_reduce(np.add, t * t, series.offsets, 0.)
+    stv = _segment_reduce(np.add, t * v, series.offsets, 0.)
+    svv = _segment_reduce(np.add, v * v, series.offsets, 0.)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var_t = n * stt - st * st
+        var_v = n * svv - sv * sv
+        cov = n * stv - st * sv
+        slope = np.where(var_t > 0, cov / var_t, np.nan)
+        intercept = (sv - slope * st) / n
+        r2 = np.where((var_t > 0) & (var_v > 0), cov * cov / (var_t * var_v), np.nan)
+    return pd.DataFrame({'ols_slope': slope * 12. / 100., 'ols_intercept': intercept / 100., 'ols_r2': r2})
+
+
+def _pair_groups(lengths, pair_budget):
+    #   split the wells into consecutive groups with at most pair_budget pairs each (a single longer well gets its
+    #   own group)
+    pairs = lengths.astype('int64') * (lengths - 1) // 2
+    bounds = [0]
+    total = 0
+    cum = np.cumsum(pairs)
+    while bounds[-1] < len(lengths):
+        stop = int(np.searchsorted(cum, total + pair_budget, side='right'))
+        stop = max(stop, bounds[-1] + 1)
+        bounds.append(min(stop, len(lengths)))
+        total = cum[bounds[-1] - 1]
+    return bounds
+
+
+def _sens_slope_group(times, values, offsets):
+    #   all pairs (i, j), i < j, within every well: element i is paired with the elements after it in its well
+    lengths = np.diff(offsets)
+    well = np.repeat(np.arange(len(lengths)), lengths)
+    ends = np.repeat(offsets[1:], lengths)
+    partners = ends - np.arange(len(times)) - 1
+    first = np.repeat(np.arange(len(times)), partners)
+    pair_start = np.repeat(np.cumsum(partners) - partners, partners)
+    second = first + 1 + (np.arange(len(first)) - pair_start)
+
+    dt = (times[second] - times[first]).astype('float64')
+    keep = dt > 0
+    slopes = (values[second][keep].astype('float64') - values[first][keep]) / dt[keep]
+    pair_well = well[first[keep]]
+
+    #   median per well: sort the slopes within every well and pick the middle one (or two). One float sort on
+    #   well * span + slope is much faster than a lexsort, the rounding error is far below a millimeter per year
+    median = np.full(len(lengths), np.nan)
+    if len(slopes) == 0:
+        return median
+    span = 2. * np.abs(slopes).max() + 1.
+    keys = pair_well * span + slopes
+    keys.sort()
+    counts = np.bincount(pair_well, minlength=len(lengths))
+    starts = np.cumsum(counts) - counts
+    has = np.flatnonzero(counts > 0)
+    lo = starts[has] + (counts[has] - 1) // 2
+    hi = starts[has] + counts[has] // 2
+    median[has] = (keys[lo] + keys[hi]) / 2. - has * span
+    return median
+
+
+def sens_slope(series, pair_budget=default_pair_budget):
+    """
+    Theil-Sen slope (median of all pairwise slopes) of every well, robust against outliers and jumps.
+
+    Parameters:
+    - series (RaggedSeries): Monthly series.
+    - pair_budget (int): Maximum number of pairwise slopes in memory at once, the wells are processed in groups.
+
+    Returns:
+    - numpy array: Slope in meters per year, NaN for wells with fewer than 2 distinct months.
+    """
+    slopes = np.full(series.n_wells, np.nan)
+    bounds = _pair_groups(series.lengths, pair_budget)
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        part = series.slice(start, stop)
+        slopes[start:stop] = _sens_slope_group(part.times, part.values, part.offsets)
+    return slopes * 12. / 100.
+
+
+def climatology(series):
+    """
+    Mean value per calendar month of every well.
+
+    Returns:
+    - numpy array: (n_wells, 12) in meters, NaN for months without values.
+    """
+    key = series.well_index() * 12 + series.times % 12
+    n = np.bincount(key, minlength=series.n_wells * 12)
+    total = np.bincount(key, weights=series.values.astype('float64'), minlength=series.n_wells * 12)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (total / n / 100.).reshape(series.n_wells, 12)
+
+
+def seasonal_amplitude(clim, min_months=12):
+    """
+    Difference between the highest and lowest monthly mean of every well.
+
+    Parameters:
+    - clim (array): Climatology from climatology().
+    - min_months (int): Calendar months that need a value, NaN for wells with fewer.
+
+    Returns:
+    - numpy array: Amplitude in meters.
+    """
+    covered = np.isfinite(clim).sum(axis=1)
+    filled_max = np.where(np.isfinite(clim), clim, -np.inf).max(axis=1)
+    filled_min = np.where(np.isfinite(clim), clim, np.inf).min(axis=1)
+    return np.where(covered >= max(min_months, 1), filled_max - filled_min, np.nan)
+
+
+def anomalies(series, clim=None):
+    """
+    Deviation of every value from the climatology of its well and calendar month.
+
+    Returns:
+    - numpy array: float32 anomalies in meters, aligned with series.values (use series.offsets to split them).
+    """
+    clim = climatology(series) if clim is None else clim
+    return (series.values / 100. - clim[series.well_index(), series.times % 12]).astype('float32')
+
+
+def gap_statistics(series):
+    """
+    Coverage of every series.
+
+    Returns:
+    - DataFrame: n_months (values), first_month and last_month (as 'YYYY-MM'), span_months, completeness
+      (n_months / span_months), n_gaps (number of holes of at least one month) and longest_gap (months).
+    """
+    lengths = series.lengths
+    nonempty = lengths > 0
+    first = np.full(series.n_wells, -1, dtype='int64')
+    last = np.full(series.n_wells, -1, dtype='int64')
+    first[nonempty] = series.times[series.offsets[:-1][nonempty]]
+    last[nonempty] = series.times[series.offsets[1:][nonempty] - 1]
+    span = np.where(nonempty, last - first + 1, 0)
+
+    #   months missing between consecutive values, the first value of every well has no predecessor
+    missing = np.diff(series.times.astype('int64'), prepend=0) - 1
+    missing[series.offsets[:-1][nonempty]] = 0
+    missing = np.maximum(missing, 0)
+    n_gaps = _segment_reduce(np.add, (missing > 0).astype('int64'), series.offsets, 0.)
+    longest = _segment_reduce(np.maximum, missing, series.offsets, 0.)
+
+    def month_label(months):
+        labels = np.char.add(np.char.add((months // 12).astype(str), '-'),
+                             np.char.zfill((months % 12 + 1).astype(str), 2))
+        return np.where(months >= 0, labels, None)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        completeness = np.where(span > 0, lengths / span, np.nan)
+    return pd.DataFrame({'n_months': lengths.astype('int32'), 'first_month': month_label(first),
+                         'last_month': month_label(last), 'span_months': span.astype('int32'),
+                         'completeness': completeness, 'n_gaps': n_gaps.astype('int32'),
+                         'longest_gap': longest.astype('int32')})
+
+
+def _chunk_statistics(series, min_months, pair_budget):
+    clim = climatology(series)
+    stats = gap_statistics(series)
+    stats.insert(0, 'id_gerbil', series.ids)
+    stats['mean_m'] = _segment_reduce(np.add, series.values.astype('float64'), series.offsets) / \
+        np.maximum(series.lengths, 1) / 100.
+    stats = pd.concat([stats, ols_trend(series)], axis=1)
+    stats['sen_slope'] = sens_slope(series, pair_budget=pair_budget)
+    stats['seasonal_amplitude'] = seasonal_amplitude(clim, min_months=min_months)
+    for month in range(12):
+        stats[f'clim_{month + 1:02d}'] = clim[:, month]
+    return stats
+
+
+def well_statistics(series, min_months=12, max_workers=None, chunk_wells=default_chunk_wells,
+                    pair_budget=default_pair_budget):
+    """
+    All per-well statistics in one table: gap statistics, mean, OLS trend, Sen's slope, seasonal amplitude and the
+    12 monthly climatology values. The wells are split into chunks that run in a thread pool.
+
+    Parameters:
+    - series (RaggedSeries): Monthly series, for example from load_monthly.
+    - min_months (int): Calendar months needed for the seasonal amplitude.
+    - max_workers (int): Number of threads, None lets the executor decide, 1 runs everything in this thread.
+    - chunk_wells (int): Wells per chunk.
+    - pair_budget (int): Pairwise slopes in memory per chunk, see sens_slope.
+
+    Returns:
+    - DataFrame: One row per well, values in meters and trends in meters per year.
+    """
+    bounds = list(range(0, series.n_wells, chunk_wells)) + [series.n_wells]
+    chunks = [series.slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])] or [series]
+    if max_workers == 1 or len(chunks) == 1:
+        frames = [_chunk_statistics(chunk, min_months, pair_budget) for chunk in chunks]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            frames = list(pool.map(_chunk_statistics, chunks, [min_months] * len(chunks),
+                                   [pair_budget] * len(chunks)))
+    return pd.concat(frames, ignore_index=True)